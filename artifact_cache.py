@@ -0,0 +1,83 @@
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+from typing import Any, Optional
+
+ARTIFACT_CACHE_VERSION = 1
+# recordings are far larger than this and never rewritten once closed, they are identified by size and mtime instead
+CONTENT_HASH_LIMIT = 256 * 1024 * 1024
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def file_digest(path: str) -> Optional[str]:
+    try:
+        stat = os.stat(path)
+        if stat.st_size > CONTENT_HASH_LIMIT:
+            return f"{stat.st_size}:{stat.st_mtime_ns}"
+        digest = hashlib.sha1()
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(HASH_BLOCK_SIZE), b""):
+                digest.update(block)
+        return digest.hexdigest()
+    except OSError:
+        return None
+
+
+def artifact_key(kind: str, input_paths: [str], params: Any = None) -> Optional[str]:
+    """
+    Address of an artifact made from the given files with the given parameters, or None if an input is missing. The
+    inputs are identified by their content, so an input that is written again with the same content keeps the key.
+    """
+    digests = [file_digest(path) for path in input_paths]
+    if any(digest is None for digest in digests):
+        return None
+    description = json.dumps([ARTIFACT_CACHE_VERSION, kind, digests, params], sort_keys=True, default=str)
+    return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+
+def artifact_path(base_path: str, key: str, suffix: str) -> str:
+    """
+    Where the artifact with this key is kept. The key is part of the name, so an artifact that exists is up to date.
+    """
+    return f"{base_path}.{key[:16]}{suffix}"
+
+
+def prune_artifacts(base_path: str, suffix: str, keep_keys: {str}):
+    """
+    Remove the artifacts kept at base_path with this suffix whose key is not one of keep_keys, along with their
+    unfinished parts. Artifacts made from earlier inputs or parameters are never looked up again.
+    """
+    keep = {key[:16] for key in keep_keys}
+    name = re.compile(re.escape(base_path) + r"\.([0-9a-f]{16})(\.part)?" + re.escape(suffix))
+    for path in glob.glob(glob.escape(base_path) + ".*" + glob.escape(suffix)):
+        match = name.fullmatch(path)
+        if match is None or match.group(1) in keep:
+            continue
+        try:
+            os.remove(path)
+            logging.debug("removed stale artifact %s", path)
+        except OSError as err:
+            logging.warn("cannot remove artifact %s: %s", path, err)
+
+
+def load_artifact(path: str, key: str) -> Optional[Any]:
+    try:
+        with open(path, 'r') as file:
+            saved = json.load(file)
+        if saved.get("key") != key:
+            return None
+        return saved["value"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def store_artifact(path: str, key: str, value: Any):
+    try:
+        with open(path + ".tmp", 'w') as file:
+            json.dump({"key": key, "value": value}, file)
+        os.replace(path + ".tmp", path)
+    except OSError as err:
+        logging.warn("cannot write artifact %s: %s", path, err)
@@ -0,0 +1,190 @@
+import argparse
+import asyncio
+import logging
+import os
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from energy_map import GRAPH_ASPECT, GRAPH_WIDTH, HEAT_INTERVAL, EnergyMap, sc_color
+from session import Session, Video
+
+parser = argparse.ArgumentParser(description='Benchmark parts of the recording pipeline on synthetic input')
+subparsers = parser.add_subparsers(dest='benchmark', required=True)
+progress_bar_parser = subparsers.add_parser('progress_bar', help='classic vs fast progress bar compositing')
+progress_bar_parser.add_argument('--duration', type=float, default=120, help='length of the synthetic clip in seconds')
+progress_bar_parser.add_argument('--resolution', type=str, default="1920x1080", help='resolution of the clip')
+progress_bar_parser.add_argument('--session_duration', type=float, default=4 * 60 * 60,
+                                 help='length of the session the clip is taken from, which sets the bar speed')
+energy_graph_parser = subparsers.add_parser('energy_graph', help='matplotlib vs numpy energy graph rendering')
+energy_graph_parser.add_argument('--duration', type=float, default=10 * 60 * 60, help='length of the session in seconds')
+energy_graph_parser.add_argument('--width', type=int, default=1920, help='width of the video the graph is put on')
+energy_graph_parser.add_argument('--danmaku_rate', type=float, default=5, help='danmaku per second on average')
+energy_graph_parser.add_argument('--super_chats', type=int, default=500, help='number of super chats')
+energy_graph_parser.add_argument('--repeat', type=int, default=5, help='renders per path, the best one is reported')
+
+
+def synthetic_session(work_dir: str, duration: float, resolution: str) -> Session:
+    flv_path = os.path.join(work_dir, "bench.flv")
+    subprocess.run(
+        ["ffmpeg", "-y", "-v", "error",
+         "-f", "lavfi", "-i", f"testsrc2=size={resolution}:rate=30",
+         "-f", "lavfi", "-i", "sine=frequency=440",
+         "-t", str(duration), "-c:v", "libx264", "-preset", "ultrafast", "-g", "60", "-c:a", "aac", flv_path],
+        check=True
+    )
+    session = Session({
+        "EventTimestamp": "2021-01-01T00:00:00+08:00",
+        "EventData": {"SessionId": "benchmark", "RoomId": 0, "Name": "benchmark", "Title": "benchmark",
+                      "AreaNameParent": "", "AreaNameChild": ""}
+    })
+    video = Video({"EventData": {"RelativePath": flv_path, "SessionId": "benchmark", "RoomId": 0,
+                                 "Duration": duration}})
+    asyncio.run(video.query_meta())
+    session.videos = [video]
+    session.duration = video.video_length_flv
+    session.resolution = video.video_resolution_x, video.video_resolution_y
+    session.generate_concat()
+    asyncio.run(session.process_danmaku())
+
+    # an energy graph of the same size and style as the one from danmaku_energy_map
+    he_graph = Image.new('RGBA', (960, 60), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(he_graph)
+    for x in range(960):
+        height = int(30 + 25 * ((x * 7919) % 97) / 97 * (1 if x % 160 < 80 else 0.4))
+        draw.line([(x, 60), (x, 60 - height)], fill=(240, 228, 66, 192))
+    he_graph.save(session.output_path()['he_graph'])
+    return session
+
+
+def run_progress_bar(session: Session, fast: bool, clip_duration: float) -> float:
+    session.room_config.fast_progress_bar = fast
+    if fast:
+        session.render_progress_bar()
+    argv = ["ffmpeg", "-y", "-v", "error"] + session.danmaku_inputs() + \
+        ["-t", str(clip_duration), "-filter_complex", session.danmaku_filter(), "-map", "[out_sub]", "-f", "null", "-"]
+    start = time.monotonic()
+    subprocess.run(argv, check=True)
+    return time.monotonic() - start
+
+
+def benchmark_progress_bar(args):
+    with tempfile.TemporaryDirectory() as work_dir:
+        session = synthetic_session(work_dir, args.duration, args.resolution)
+        clip_duration = session.duration
+        # only the first part of a long session is encoded, the bar moves as slowly as it would in the full video
+        session.duration = max(args.session_duration, clip_duration)
+        print(f"progress bar compositing, first {clip_duration:.0f}s of a {session.duration:.0f}s session "
+              f"at {args.resolution}, without encoding:")
+        results = {}
+        for name, fast in [("classic", False), ("fast", True)]:
+            results[name] = run_progress_bar(session, fast, clip_duration)
+            print(f"  {name:8s} {results[name]:8.2f}s  {clip_duration / results[name]:6.1f}x realtime")
+        print(f"  speedup  {results['classic'] / results['fast']:8.2f}x")
+
+
+def synthetic_energy_map(duration: float, danmaku_rate: float, super_chat_count: int) -> EnergyMap:
+    rng = np.random.default_rng(0)
+    length = int(duration) + 1
+    # a steady chat with bursts of a few minutes, summed over the heat window
+    rate = np.full(length, danmaku_rate, dtype=float)
+    for center in rng.uniform(0, duration, size=max(1, int(duration / 1800))):
+        rate += danmaku_rate * 8 * np.exp(-0.5 * ((np.arange(length) - center) / rng.uniform(20, 120)) ** 2)
+    counts = rng.poisson(rate)
+    energy_map = EnergyMap()
+    energy_map.heat = np.convolve(counts * rng.uniform(3, 6), np.ones(2 * HEAT_INTERVAL), mode='same')
+    energy_map.end_time = duration
+    energy_map.super_chats = [
+        (float(time), str(rng.choice([30, 50, 100, 500, 1000, 2000])), "", "", 60.0)
+        for time in np.sort(rng.uniform(0, duration, size=super_chat_count))
+    ]
+    energy_map.detect(length)
+    return energy_map
+
+
+def draw_matplotlib(energy_map: EnergyMap, graph_path: str):
+    # the graph as danmaku_energy_map plots it, the renderer energy_map replaced. matplotlib is only needed here, it is
+    # in requirements-benchmark.txt
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=(16, 1), frameon=False, dpi=60)
+    ax = fig.add_axes((0, 0, 1, 1))
+    heat_ratio, heat_average = energy_map.heat_ratio, energy_map.heat_average
+    heat_time = np.arange(len(heat_ratio))
+    change_pos_list = [0]
+    begin_pos_lists = ([], [])
+    begin_pos_lists[0 if heat_ratio[0] - heat_average[0] < 0 else 1].append(0)
+    for i in range(1, len(heat_time) - 1):
+        prev_diff = heat_ratio[i - 1] - heat_average[i - 1]
+        after_diff = heat_ratio[i + 1] - heat_average[i + 1]
+        if prev_diff * after_diff < 0:
+            change_pos_list.append(i)
+            begin_pos_lists[1 if prev_diff < 0 else 0].append(len(change_pos_list) - 1)
+    change_pos_list.append(len(heat_time) - 1)
+    for begin_pos_list, color in zip(begin_pos_lists, ["#f0e442c0", "#e69f00c0"]):
+        for begin_pos_i in begin_pos_list:
+            begin_pos = change_pos_list[begin_pos_i]
+            end_pos = change_pos_list[begin_pos_i + 1]
+            if end_pos < len(heat_time) - 1:
+                end_pos += 1
+            ax.fill_between(heat_time[begin_pos:end_pos], heat_ratio[begin_pos:end_pos], color=color,
+                            edgecolor="none")
+    if len(energy_map.super_chats) != 0:
+        height = min(heat_ratio) + 0.1 * (max(heat_ratio) - min(heat_ratio))
+        for time, price, _, _, _ in sorted(energy_map.super_chats, key=lambda sc: int(sc[1])):
+            ax.scatter(time, height, s=75, c=[[rgb / 255.0 for rgb in sc_color(int(price))]])
+    ax.set_xlim(heat_time[0], heat_time[-1])
+    ax.set_ylim(min(heat_ratio), max(heat_ratio))
+    ax.set_frame_on(False)
+    fig.savefig(graph_path, transparent=True)
+
+
+def best_time(func, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.monotonic()
+        func()
+        times += [time.monotonic() - start]
+    return min(times)
+
+
+def benchmark_energy_graph(args):
+    energy_map = synthetic_energy_map(args.duration, args.danmaku_rate, args.super_chats)
+    height = max(1, round(args.width / GRAPH_ASPECT))
+    with tempfile.TemporaryDirectory() as work_dir:
+        old_path = os.path.join(work_dir, "matplotlib.png")
+        new_path = os.path.join(work_dir, "numpy.png")
+
+        def old_graph():
+            # plotted at 960x60, then scaled to the video width for the progress bar
+            draw_matplotlib(energy_map, old_path)
+            with Image.open(old_path) as graph:
+                graph.convert('RGBA').resize((args.width, height), Image.LANCZOS)
+
+        def new_graph():
+            Image.fromarray(energy_map.render_graph(args.width, height), 'RGBA').save(new_path)
+
+        print(f"energy graph of a {args.duration:.0f}s session with {len(energy_map.he_range)} high energy ranges and "
+              f"{len(energy_map.super_chats)} super chats, {args.width}x{height}:")
+        results = {"matplotlib": best_time(old_graph, args.repeat), "numpy": best_time(new_graph, args.repeat)}
+        for name, result in results.items():
+            print(f"  {name:10s} {result * 1000:8.1f}ms")
+        print(f"  speedup    {results['matplotlib'] / results['numpy']:8.2f}x")
+        # both at the size matplotlib plots, to see how close the two drawings are
+        with Image.open(old_path) as graph:
+            old_alpha = np.asarray(graph.convert('RGBA'))[:, :, 3].astype(int)
+        new_alpha = energy_map.render_graph(GRAPH_WIDTH, round(GRAPH_WIDTH / GRAPH_ASPECT))[:, :, 3].astype(int)
+        difference = np.abs(old_alpha - new_alpha)
+        print(f"  coverage difference at {GRAPH_WIDTH}px: mean {difference.mean() / 255:.2%}, "
+              f"{(difference > 64).mean():.2%} of the pixels off by more than a quarter")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARN)
+    arguments = parser.parse_args()
+    if arguments.benchmark == 'progress_bar':
+        benchmark_progress_bar(arguments)
+    elif arguments.benchmark == 'energy_graph':
+        benchmark_energy_graph(arguments)
@@ -24,6 +24,8 @@ from requests.adapters import HTTPAdapter
 from urllib3 import Retry
 import xml.etree.ElementTree as ET
 
+from chunk_reader import ChunkReader
+
 
 # From https://github.com/biliup/biliup/blob/c11324a133b10db8c3f3c2c7f87ee295034e4375/biliup/plugins/bili_webup.py
 
@@ -468,28 +470,35 @@ class BiliBili:
 
     @staticmethod
     async def _upload(params, file, chunk_size, afunc, tasks=3):
-        params['chunk'] = -1
+        # one buffer more than there are senders, so the next chunk is read while they are all sending
+        reader = ChunkReader(file, chunk_size, tasks + 1)
 
         async def upload_chunk():
             while True:
-                chunks_data = file.read(chunk_size)
-                if not chunks_data:
+                chunk = await reader.next()
+                if chunk is None:
                     return
-                params['chunk'] += 1
-                params['size'] = len(chunks_data)
-                params['partNumber'] = params['chunk'] + 1
-                params['start'] = params['chunk'] * chunk_size
-                params['end'] = params['start'] + params['size']
                 clone = params.copy()
-                for i in range(10):
-                    try:
-                        await afunc(session, chunks_data, clone)
-                        break
-                    except (asyncio.TimeoutError, aiohttp.ClientError) as e:
-                        print(f"retry chunk{clone['chunk']} >> {i + 1}. {e}")
-
-        async with aiohttp.ClientSession() as session:
-            await asyncio.gather(*[upload_chunk() for _ in range(tasks)])
+                clone['chunk'] = chunk.index
+                clone['size'] = len(chunk.data)
+                clone['partNumber'] = chunk.index + 1
+                clone['start'] = chunk.index * chunk_size
+                clone['end'] = clone['start'] + clone['size']
+                try:
+                    for i in range(10):
+                        try:
+                            await afunc(session, chunk.data, clone)
+                            break
+                        except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                            print(f"retry chunk{clone['chunk']} >> {i + 1}. {e}")
+                finally:
+                    reader.release(chunk)
+
+        try:
+            async with aiohttp.ClientSession() as session:
+                await asyncio.gather(*[upload_chunk() for _ in range(tasks)])
+        finally:
+            reader.close()
 
     def submit(self, submit_api=None):
         if not self.video.title:
@@ -0,0 +1,78 @@
+import asyncio
+import queue
+import threading
+from typing import BinaryIO, Optional
+
+
+class Chunk:
+    index: int
+    buffer: bytearray
+    data: memoryview
+
+    def __init__(self, index: int, buffer: bytearray, size: int):
+        self.index = index
+        self.buffer = buffer
+        self.data = memoryview(buffer)[:size]
+
+
+class ChunkReader:
+    """
+    Reads a file chunk by chunk on its own thread, into a fixed pool of buffers, so the disk is read while earlier
+    chunks are still being sent, and the event loop never waits on it. A chunk is a view of its buffer rather than a
+    copy, and goes back to the pool once released. Reading ahead stops while every buffer is in use, so memory stays
+    at the size of the pool. Created on the loop the chunks are taken from, and closed on it before that loop is.
+    """
+
+    def __init__(self, file: BinaryIO, chunk_size: int, buffers: int):
+        self.file = file
+        self.loop = asyncio.get_event_loop()
+        self.chunks: asyncio.Queue = asyncio.Queue()
+        self.free: queue.Queue = queue.Queue()
+        self.stopped = threading.Event()
+        for _ in range(buffers):
+            self.free.put(bytearray(chunk_size))
+        self.thread = threading.Thread(target=self.read_ahead, daemon=True)
+        self.thread.start()
+
+    def read_ahead(self):
+        index = 0
+        while True:
+            buffer = self.free.get()
+            # released buffers can still be queued ahead of the None of close
+            if buffer is None or self.stopped.is_set():
+                return
+            try:
+                size = self.file.readinto(buffer)
+            except OSError as err:
+                self.loop.call_soon_threadsafe(self.chunks.put_nowait, err)
+                return
+            if not size:
+                self.loop.call_soon_threadsafe(self.chunks.put_nowait, None)
+                return
+            self.loop.call_soon_threadsafe(self.chunks.put_nowait, Chunk(index, buffer, size))
+            index += 1
+
+    async def next(self) -> Optional[Chunk]:
+        """
+        The next chunk of the file, None once it is all read.
+        """
+        chunk = await self.chunks.get()
+        if chunk is None or isinstance(chunk, Exception):
+            # left for the other readers
+            self.chunks.put_nowait(chunk)
+        if isinstance(chunk, Exception):
+            raise chunk
+        return chunk
+
+    def release(self, chunk: Chunk):
+        chunk.data.release()
+        self.free.put(chunk.buffer)
+
+    def close(self):
+        """
+        Stop reading ahead and wait for the thread, so it does not post to the loop once that is closed. At most the
+        read in progress is waited for.
+        """
+        self.stopped.set()
+        self.free.put(None)
+        self.thread.join()
@@ -63,6 +63,11 @@ class CommentTask:
         self.sessdata = verify.sessdata
         self.csrf = verify.csrf
         self.error_count = 0
+        self.approved = False  # the video passed review, known once it could be looked up
+        self.review_trials = 0
+
+    def expiry(self) -> float:
+        return (self.start_date + datetime.timedelta(hours=HOURS_THRESHOLD)).timestamp()
 
     def to_dict(self):
         return vars(self)
@@ -84,7 +89,7 @@ class CommentTask:
         comment_task = CommentTask(upload_task.sc_path, upload_task.he_path, upload_task.session_id, upload_task.verify)
         return comment_task
 
-    def post_comment(self, session_dict: {str: str}) -> bool:
+    def post_comment(self, session_dict: {str: str}, published: bool = False) -> bool:
         if (datetime.datetime.now(datetime.timezone.utc) - self.start_date).total_seconds() / 60 / 60 > HOURS_THRESHOLD:
             return True
         if self.session_id not in session_dict:
@@ -92,10 +97,12 @@ class CommentTask:
         if self.error_count > ERROR_THRESHOLD:
             return True
         bvid = session_dict[self.session_id]
-        try:
-            video.get_video_info(bvid)
-        except bilibili_api.exceptions.BilibiliApiException:  # Video not published yet
-            return False
+        if not published:
+            try:
+                video.get_video_info(bvid)
+            except bilibili_api.exceptions.BilibiliApiException:  # Video not published yet
+                return False
+        self.approved = True
         print(f"posting comments on {bvid}")
         self.error_count += 1
         verify = Verify(self.sessdata, self.csrf)
@@ -0,0 +1,271 @@
+import heapq
+import json
+import logging
+import math
+import re
+import xml.etree.ElementTree as ET
+from typing import Any, Iterator, Optional, Tuple
+
+from artifact_cache import artifact_key, file_digest, load_artifact, store_artifact
+
+DANMAKU_TAGS = ['d', 'sc', 'gift', 'guard']
+# guards are left out of the energy map, as in danmaku_tools
+ENERGY_MAP_TAGS = ['d', 'sc', 'gift']
+SEGMENT_CACHE_SUFFIX = ".danmaku.json"
+ASS_DIALOGUE = re.compile(r"^(Dialogue: [^,]*),(\d+):(\d\d):(\d\d)\.(\d\d),(\d+):(\d\d):(\d\d)\.(\d\d),")
+
+
+def get_time(child: ET.Element) -> float:
+    if child.tag == 'd':
+        return float(child.attrib['p'].split(',')[0])
+    else:
+        return float(child.attrib['ts'])
+
+
+def set_time(child: ET.Element, new_time: float):
+    if child.tag == 'd':
+        parameters = child.attrib['p'].split(',')
+        child.set('p', ','.join([str(new_time)] + parameters[1:]))
+    else:
+        child.set('ts', str(new_time))
+
+
+def get_value(child: ET.Element) -> float:
+    # same weights as danmaku_tools: one per danmaku, gifts and super chats by their price
+    if child.tag == 'd':
+        return 1
+    raw_data = json.loads(child.attrib['raw'])
+    if child.tag == 'gift':
+        return raw_data['total_coin'] / 1000 / 10
+    elif child.tag == 'sc':
+        return raw_data['price'] / 10
+    elif child.tag == 'guard':
+        return raw_data['price'] / 1000 / 10
+    return 0
+
+
+def is_lottery(child: ET.Element) -> bool:
+    if child.tag != 'd':
+        return False
+    danmaku_raw = json.loads(child.attrib['raw'])
+    if type(danmaku_raw) is not list:  # mostly broadcasting messages
+        return False
+    return danmaku_raw[0][5] == 0
+
+
+def get_super_chat(child: ET.Element) -> (float, str, str, str, float):
+    raw_data = json.loads(child.attrib['raw'])
+    return (
+        float(child.attrib['ts']), child.attrib['price'], raw_data["message"].replace('\n', '\t'),
+        raw_data["user_info"]['uname'], raw_data['time']
+    )
+
+
+def write_root(root: ET.Element, output_path: str):
+    ET.ElementTree(root).write(output_path, encoding='UTF-8', xml_declaration=True)
+
+
+class SegmentDanmaku:
+    """
+    Danmaku of a single recorded segment, cleaned and summarised as soon as the segment is closed. Session end only
+    has to merge these results instead of going through the whole session's danmaku again. Comments and super chats
+    are kept as plain tuples for the energy map, so the XML is parsed only once.
+    """
+    xml_path: str
+    clean_xml_path: str
+    danmaku_count: int
+    density: [float]
+    comments: [(float, str)]
+    super_chats: [(float, str, str, str, float)]  # time, price, message, user name, paid duration
+    last_time: Optional[float]
+
+    def __init__(self, xml_path: str, clean_xml_path: str):
+        self.xml_path = xml_path
+        self.clean_xml_path = clean_xml_path
+        self.danmaku_count = 0
+        self.density = []
+        self.comments = []
+        self.super_chats = []
+        self.last_time = None
+
+    def to_dict(self):
+        return vars(self)
+
+    @staticmethod
+    def from_dict(save_dict: {str: Any}) -> 'SegmentDanmaku':
+        segment = SegmentDanmaku(save_dict['xml_path'], save_dict['clean_xml_path'])
+        for key, value in save_dict.items():
+            segment.__setattr__(key, value)
+        segment.comments = [tuple(comment) for comment in segment.comments]
+        segment.super_chats = [tuple(super_chat) for super_chat in segment.super_chats]
+        return segment
+
+    @staticmethod
+    def load(xml_path: str, clean_xml_path: str) -> Optional['SegmentDanmaku']:
+        """
+        SegmentDanmaku.process with its result cached next to the XML and keyed by the content of the XML, so a
+        segment that is prepared again, e.g. when its session is resumed, is not parsed and cleaned again.
+        """
+        key = artifact_key("segment_danmaku", [xml_path])
+        if key is None:
+            return SegmentDanmaku.process(xml_path, clean_xml_path)
+        cache_path = xml_path.rpartition('.')[0] + SEGMENT_CACHE_SUFFIX
+        saved = load_artifact(cache_path, key)
+        if saved is not None and saved["clean_xml"] == file_digest(clean_xml_path):
+            logging.debug("segment danmaku cache hit: %s", xml_path)
+            return SegmentDanmaku.from_dict(saved["segment"])
+        segment = SegmentDanmaku.process(xml_path, clean_xml_path)
+        if segment is not None:
+            store_artifact(cache_path, key, {"clean_xml": file_digest(clean_xml_path), "segment": segment.to_dict()})
+        return segment
+
+    @staticmethod
+    def process(xml_path: str, clean_xml_path: str) -> Optional['SegmentDanmaku']:
+        try:
+            root = ET.parse(xml_path).getroot()
+        except (OSError, ET.ParseError) as err:
+            logging.warn("danmaku %s unreadable: %s", xml_path, err)
+            return None
+        segment = SegmentDanmaku(xml_path, clean_xml_path)
+        clean_root = ET.Element('i')
+        for child in root:
+            try:
+                if is_lottery(child):
+                    continue
+                if child.tag in DANMAKU_TAGS:
+                    segment.add_density(get_time(child), get_value(child))
+                    segment.danmaku_count += 1
+                if child.tag in ENERGY_MAP_TAGS:
+                    segment.add_energy_input(child)
+            except (KeyError, IndexError, TypeError, ValueError):
+                logging.debug("malformed danmaku in %s: %s", xml_path, child.attrib)
+            clean_root.append(child)
+        write_root(clean_root, clean_xml_path)
+        return segment
+
+    def add_energy_input(self, child: ET.Element):
+        time = get_time(child)
+        self.last_time = time if self.last_time is None else max(self.last_time, time)
+        if child.tag == 'd' and child.text is not None:
+            self.comments += [(time, child.text)]
+        elif child.tag == 'sc':
+            self.super_chats += [get_super_chat(child)]
+
+    def add_density(self, time: float, value: float):
+        second = max(int(time), 0)
+        if second >= len(self.density):
+            self.density += [0.0] * (second + 1 - len(self.density))
+        self.density[second] += value
+
+
+def iter_segment(xml_path: str, offset: float, keep_others: bool) -> Iterator[Tuple[float, int, ET.Element]]:
+    """
+    Stream the top level elements of a segment XML with their rebased time, each one is dropped from memory as soon
+    as the next one is read. Elements that are not danmaku are only kept if keep_others is set, and stay after the
+    danmaku before them. A truncated file, e.g. from a crashed recorder, yields what could be read.
+    """
+    depth = 0
+    root = None
+    last_time = offset
+    try:
+        for event, element in ET.iterparse(xml_path, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = element
+                depth += 1
+                continue
+            depth -= 1
+            if depth != 1:
+                continue
+            try:
+                if element.tag in DANMAKU_TAGS:
+                    last_time = get_time(element) + offset
+                    if offset != 0:
+                        set_time(element, last_time)
+                    yield last_time, 0, element
+                elif keep_others:
+                    yield last_time, 1, element
+            except (KeyError, IndexError, ValueError):
+                logging.debug("malformed danmaku in %s: %s", xml_path, element.attrib)
+            root.clear()
+    except (OSError, ET.ParseError) as err:
+        logging.warn("danmaku %s read up to the error: %s", xml_path, err)
+
+
+def merge_segments(xml_paths: [Optional[str]], offsets: [float], output_path: str):
+    """
+    Merge segment XMLs into one, shifting every danmaku by the start offset of its segment. Segments without danmaku
+    are passed as None and only contribute their offset. The segments are parsed incrementally and k-way merged by
+    rebased time while the output is written, so memory does not grow with the number of danmaku.
+    """
+    segments = [
+        (xml_path, offset) for xml_path, offset in zip(xml_paths, offsets) if xml_path is not None
+    ]
+    segments = [
+        iter_segment(xml_path, offset, keep_others=idx == 0) for idx, (xml_path, offset) in enumerate(segments)
+    ]
+    with open(output_path, 'w', encoding='UTF-8') as file:
+        file.write("<?xml version='1.0' encoding='UTF-8'?>\n<i>\n")
+        for _, _, element in heapq.merge(*segments, key=lambda item: item[:2]):
+            element.tail = "\n"
+            file.write(ET.tostring(element, encoding='unicode'))
+        file.write("</i>")
+
+
+def merge_density(densities: [[float]], durations: [float]) -> [float]:
+    merged = []
+    for density, duration in zip(densities, durations):
+        length = int(math.ceil(duration))
+        merged += (density + [0.0] * length)[:length]
+    return merged
+
+
+def peak_time(density: [float], window: int = 60) -> float:
+    """
+    The centre of the busiest window, used as the high energy time when the energy map is not available.
+    """
+    if len(density) == 0:
+        return 0
+    window = min(window, len(density))
+    current = sum(density[:window])
+    best, best_start = current, 0
+    for start in range(1, len(density) - window + 1):
+        current += density[start + window - 1] - density[start - 1]
+        if current > best:
+            best, best_start = current, start
+    return float(best_start + window // 2)
+
+
+def ass_time(centiseconds: int) -> str:
+    seconds, centiseconds = divmod(centiseconds, 100)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}.{centiseconds:02d}"
+
+
+def merge_ass(ass_paths: [str], offsets: [float], output_path: str):
+    """
+    Join the subtitles made from every segment's danmaku into one, shifting each segment's events by its start
+    offset. The header is taken from the first segment, the segments are made with the same resolution and style.
+    """
+    with open(output_path, 'w', encoding='utf-8') as output:
+        for idx, (ass_path, offset) in enumerate(zip(ass_paths, offsets)):
+            shift = int(round(offset * 100))
+            section = None
+            in_events = False
+            with open(ass_path, 'r', encoding='utf-8-sig') as file:
+                for line in file:
+                    line = line.rstrip("\r\n") + "\n"
+                    if not in_events:
+                        if idx == 0:
+                            output.write(line)
+                        if line.startswith("["):
+                            section = line.strip().lower()
+                        # everything up to the Format line of the events is header
+                        in_events = section == "[events]" and line.startswith("Format:")
+                        continue
+                    match = ASS_DIALOGUE.match(line)
+                    if match is None:
+                        continue
+                    times = [int(part) for part in match.groups()[1:]]
+                    start = ((times[0] * 60 + times[1]) * 60 + times[2]) * 100 + times[3] + shift
+                    end = ((times[4] * 60 + times[5]) * 60 + times[6]) * 100 + times[7] + shift
+                    output.write(f"{match.group(1)},{ass_time(start)},{ass_time(end)}," + line[match.end():])
@@ -0,0 +1,173 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Optional
+
+from job_scheduler import BENCHMARK, Job, job_scheduler
+from process_runner import run_process
+
+ENCODER_BENCHMARK_FILE = "encoder_benchmark.json"
+BENCHMARK_SECONDS = 5
+BENCHMARK_FPS = 30
+BENCHMARK_BITRATE = "6000K"
+BENCHMARK_TIMEOUT = 5 * 60
+# how long the benchmark waits for the other jobs to finish, after that it measures alongside them
+BENCHMARK_IDLE_TIMEOUT = 10 * 60
+# encoder presets from the best to the worst output quality, the first one that keeps up with MIN_SPEED is used
+ENCODER_CANDIDATES = [
+    ("h264_nvenc", "slow"),
+    ("libx264", "medium"),
+    ("h264_nvenc", "medium"),
+    ("libx264", "fast"),
+    ("h264_nvenc", "fast"),
+    ("libx264", "veryfast"),
+]
+MIN_SPEED = 1.0
+STARTUP_RESOLUTION = (1920, 1080)
+FALLBACK_ENCODER = ("libx264", "medium")
+
+
+async def _run(*args) -> (int, str):
+    process = await asyncio.create_subprocess_exec(
+        *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+    )
+    stdout, _ = await process.communicate()
+    return process.returncode, stdout.decode('utf-8', errors='replace')
+
+
+async def ffmpeg_version() -> str:
+    _, output = await _run("ffmpeg", "-hide_banner", "-version")
+    return output.split("\n")[0].strip()
+
+
+async def supported_encoders() -> {str}:
+    _, output = await _run("ffmpeg", "-hide_banner", "-encoders")
+    encoders = set()
+    for line in output.split("\n"):
+        parts = line.split()
+        # capability flags like "V....D" come before the encoder name
+        if len(parts) >= 2 and len(parts[0]) == 6 and parts[0][0] == 'V':
+            encoders.add(parts[1])
+    return encoders
+
+
+async def benchmark_encoder(encoder: str, preset: str, resolution: (int, int)) -> Optional[float]:
+    """
+    Encode a synthetic clip and return the frames per second reached, or None if the encoder does not work here,
+    e.g. nvenc without a usable GPU.
+    """
+    width, height = resolution
+    result = await run_process([
+        "ffmpeg", "-v", "error", "-y",
+        "-f", "lavfi", "-i", f"testsrc2=size={width}x{height}:rate={BENCHMARK_FPS}",
+        "-t", str(BENCHMARK_SECONDS), "-c:v", encoder, "-preset", preset, "-b:v", BENCHMARK_BITRATE,
+        "-f", "null", "-"
+    ], timeout=BENCHMARK_TIMEOUT)
+    if not result.succeeded:
+        return None
+    return BENCHMARK_SECONDS * BENCHMARK_FPS / result.wall_time
+
+
+class EncoderTable:
+    """
+    Frames per second that every supported encoder and preset reaches on this machine, measured per resolution and
+    kept on disk until the ffmpeg build changes.
+    """
+
+    def __init__(self, path: str = ENCODER_BENCHMARK_FILE):
+        self.path = path
+        self.version: Optional[str] = None
+        self.encoders: Optional[{str}] = None
+        self.results: {str: {str: Optional[float]}} = dict()
+        self.running: {str: asyncio.Future} = dict()
+
+    @staticmethod
+    def resolution_key(resolution: (int, int)) -> str:
+        return f"{resolution[0]}x{resolution[1]}"
+
+    @staticmethod
+    def candidate_key(encoder: str, preset: str) -> str:
+        return f"{encoder}:{preset}"
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as file:
+                saved = json.load(file)
+        except (OSError, ValueError):
+            return
+        if saved.get("version") == self.version:
+            self.results = saved.get("results", {})
+
+    def store(self):
+        try:
+            with open(self.path + ".tmp", 'w') as file:
+                json.dump({"version": self.version, "results": self.results}, file, indent=2)
+            os.replace(self.path + ".tmp", self.path)
+        except OSError as err:
+            logging.warn("cannot write encoder benchmark %s: %s", self.path, err)
+
+    async def probe(self, resolution: (int, int)) -> {str: Optional[float]}:
+        if self.encoders is None:
+            self.version = await ffmpeg_version()
+            self.encoders = await supported_encoders()
+            logging.info("ffmpeg supports encoders: %s",
+                         ", ".join(sorted({encoder for encoder, _ in ENCODER_CANDIDATES} & self.encoders)))
+            self.load()
+        key = self.resolution_key(resolution)
+        if key in self.results:
+            return self.results[key]
+        if key not in self.running:
+            self.running[key] = asyncio.ensure_future(self._benchmark(resolution))
+        return await asyncio.shield(self.running[key])
+
+    async def _benchmark(self, resolution: (int, int)) -> {str: Optional[float]}:
+        key = self.resolution_key(resolution)
+        results = dict()
+        # one slot for all the candidates, so no other job starts between them
+        job = Job(BENCHMARK, f"encoder benchmark {key}")
+        try:
+            await asyncio.wait_for(job_scheduler.acquire(job), BENCHMARK_IDLE_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.warn("no idle moment for the encoder benchmark at %s in %ds, measured alongside other jobs and "
+                         "not stored", key, BENCHMARK_IDLE_TIMEOUT)
+            job = None
+        try:
+            # one at a time, so the candidates do not compete with each other for the CPU
+            for encoder, preset in ENCODER_CANDIDATES:
+                if encoder not in self.encoders:
+                    continue
+                fps = await benchmark_encoder(encoder, preset, resolution)
+                results[self.candidate_key(encoder, preset)] = fps
+                logging.info("encoder %s -preset %s at %s: %s", encoder, preset, key,
+                             "unavailable" if fps is None else f"{fps:.1f} fps")
+            self.results[key] = results
+            if job is not None:
+                self.store()
+        finally:
+            if job is not None:
+                job_scheduler.release(job)
+            # a failed benchmark is run again by the next probe, rather than failing every one after it
+            del self.running[key]
+        return results
+
+    async def select(self, resolution: (int, int), encoder: Optional[str] = None,
+                     preset: Optional[str] = None) -> (str, str):
+        if encoder is not None:
+            return encoder, preset if preset is not None else "medium"
+        results = await self.probe(resolution)
+        measured = [
+            (encoder, preset, results[self.candidate_key(encoder, preset)])
+            for encoder, preset in ENCODER_CANDIDATES
+            if results.get(self.candidate_key(encoder, preset)) is not None
+        ]
+        if len(measured) == 0:
+            return FALLBACK_ENCODER
+        for encoder, preset, fps in measured:
+            if fps >= BENCHMARK_FPS * MIN_SPEED:
+                return encoder, preset
+        encoder, preset, _ = max(measured, key=lambda candidate: candidate[2])
+        return encoder, preset
+
+
+encoder_table = EncoderTable()
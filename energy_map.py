@@ -0,0 +1,545 @@
+import bisect
+import json
+import math
+import operator
+import os
+import random
+import re
+import threading
+from collections import Counter
+from datetime import timedelta
+from typing import Optional
+
+import jieba
+import numpy as np
+import srt
+from PIL import Image
+from scipy.ndimage import convolve
+from scipy.stats import halfnorm
+from textrank4zh import TextRank4Sentence
+
+# the same analysis as danmaku_tools.danmaku_energy_map, run on danmaku already parsed by SegmentDanmaku
+HEAT_INTERVAL = 2
+SHORT_SIGMA = 50
+LONG_SIGMA = 1000
+FILTER_SHIFT = 45
+# the smoothed heat of a second keeps changing until the heat this much later is known, mostly through the long filter
+SETTLE_SECONDS = 4 * LONG_SIGMA + FILTER_SHIFT + HEAT_INTERVAL
+TEXT_LIMIT = 900
+SEG_CHAR = '\n\n\n\n'
+TEXT_RANK_SAMPLES = 1000
+SC_SRT_LIMIT = 100
+# the graph of danmaku_tools is 16x1 inches at 60 dpi
+GRAPH_WIDTH = 960
+GRAPH_ASPECT = 16
+LOW_AREA_COLOR = (0xf0, 0xe4, 0x42, 0xc0)
+HIGH_AREA_COLOR = (0xe6, 0x9f, 0x00, 0xc0)
+# radius of the super chat dots relative to the graph height, matplotlib's s=75 marker with its edge on a 1 inch graph
+SC_DOT_RADIUS = (math.sqrt(75) / 2 + 0.5) / 72
+
+class RegexRules:
+    """
+    The he_regex_rules of a room, one "pattern replacement" pair per line, compiled into a single alternation so a
+    danmaku is rewritten in one pass instead of once per rule. Where several rules match at the same position the
+    first one wins. Rules that chain, where a later rule rewrites what an earlier one wrote, and rules that cannot be
+    combined, e.g. because a pattern refers back to its own groups, are applied one after another as before.
+    """
+    rules: [(str, str)]
+
+    def __init__(self, rules: [(str, str)]):
+        self.rules = rules
+        self.patterns = [re.compile(pattern) for pattern, _ in rules]
+        self.combined: Optional[re.Pattern] = None
+        if len(rules) == 0 or any(re.search(r"\\[1-9]|\(\?P=", pattern) for pattern, _ in rules) or self.chained():
+            return
+        try:
+            # without groups around the rules, re skips the positions where none of them can start
+            self.combined = re.compile("|".join(f"(?:{pattern})" for pattern, _ in rules))
+        except re.error:  # e.g. two rules with a group of the same name
+            self.combined = None
+
+    def chained(self) -> bool:
+        """
+        Whether a later rule can match what an earlier one replaced, which only the rules applied one after another
+        rewrite again. A replacement that takes groups of its match can be anything, so it is taken to chain.
+        """
+        for i, (_, replacement) in enumerate(self.rules):
+            if re.search(r"\\(\d|g<)", replacement):
+                return True
+            # what re writes for it, with its escapes resolved
+            text = re.match("", "").expand(replacement)
+            if any(pattern.search(text) for pattern in self.patterns[i + 1:]):
+                return True
+        return False
+
+    @staticmethod
+    def load(path: str) -> 'RegexRules':
+        rules = []
+        with open(path, 'r') as file:
+            for line in file:
+                line = line.strip().split()
+                assert len(line) == 2
+                rules += [(line[0], line[1])]
+        return RegexRules(rules)
+
+    def replace(self, match: re.Match) -> str:
+        # the alternation took the first rule that matches here, matching it again gives its own groups
+        for pattern, (_, replacement) in zip(self.patterns, self.rules):
+            rule_match = pattern.match(match.string, match.start())
+            if rule_match is not None:
+                return rule_match.expand(replacement)
+        return match.group()
+
+    def apply(self, danmaku: str) -> str:
+        if self.combined is not None:
+            return self.combined.sub(self.replace, danmaku)
+        for pattern, (_, replacement) in zip(self.patterns, self.rules):
+            danmaku = pattern.sub(replacement, danmaku)
+        return danmaku
+
+
+_tokenizers: {str: (float, jieba.Tokenizer)} = dict()
+_regex_rules: {str: (float, RegexRules)} = dict()
+_cache_lock = threading.Lock()
+
+
+def _cached(cache: dict, path: str, load):
+    # kept for every session of the rooms sharing the file, and loaded again once the file changes
+    mtime = os.stat(path).st_mtime
+    with _cache_lock:
+        if path not in cache or cache[path][0] != mtime:
+            cache[path] = mtime, load(path)
+        return cache[path][1]
+
+
+def _load_tokenizer(user_dict: Optional[str]) -> jieba.Tokenizer:
+    tokenizer = jieba.Tokenizer()
+    if user_dict is not None:
+        tokenizer.load_userdict(user_dict)
+    return tokenizer
+
+
+_default_tokenizer = _load_tokenizer(None)
+
+
+def get_tokenizer(user_dict: Optional[str]) -> jieba.Tokenizer:
+    # every user dictionary gets its own tokenizer, so rooms do not leak keywords into each other
+    if user_dict is None:
+        return _default_tokenizer
+    return _cached(_tokenizers, user_dict, _load_tokenizer)
+
+
+def get_regex_rules(regex_rules: Optional[str]) -> RegexRules:
+    if regex_rules is None:
+        return RegexRules([])
+    return _cached(_regex_rules, regex_rules, RegexRules.load)
+
+
+def half_gaussian_filter(value, sigma):
+    space = np.linspace(-4, 4, sigma * 8)
+    neg_space = np.linspace(4 * 10, -4 * 10, sigma * 8)
+    kernel = (halfnorm.pdf(space) + halfnorm.pdf(neg_space)) / sigma
+    offset_value = np.concatenate((value, np.zeros(FILTER_SHIFT)))
+    return convolve(offset_value, kernel)[FILTER_SHIFT:]
+
+
+def convert_time(secs):
+    minutes = secs // 60
+    reminder_secs = secs % 60
+    return f"{minutes}:{reminder_secs:02d}"
+
+
+def segment_text(text):
+    lines = text.split('\n')
+    new_text = ""
+    new_segment = ""
+    for line in lines:
+        if len(new_segment) + len(line) < TEXT_LIMIT:
+            new_segment += line + "\n"
+        elif len(line) <= TEXT_LIMIT:  # longer lines are dropped
+            new_text += new_segment + SEG_CHAR
+            new_segment = line + "\n"
+    new_text += new_segment
+    return new_text
+
+
+class EnergyMap:
+    """
+    Heat of the danmaku over the session, one value per second: IDF-weighted keyword counts in a 4 second window,
+    smoothed by a short and a long half gaussian. High energy ranges are where the short one is above the long one.
+
+    The map is built while the stream is recorded, one closed segment at a time. Only the heat is kept for the whole
+    session. A high energy range is summarised as soon as it closes, and the comments and word counts are dropped
+    once no range that can still change needs them. A segment is weighted with the IDF known when it is added, so
+    only a session of a single segment is analysed exactly like danmaku_tools does.
+    """
+    user_dict: Optional[str]
+    regex_rules: Optional[str]
+    heat: np.ndarray
+    document_frequency: Counter
+    comments: [(float, str)]  # only the ones some high energy range may still need
+    wordcount_slices: {int: Counter}
+    super_chats: [(float, str, str, str, float)]
+    comment_count: int
+    end_time: float
+    last_time: Optional[float]
+    summaries: {(int, int): (str, [str])}
+    heat_ratio: np.ndarray
+    heat_average: np.ndarray
+    he_points: [[int], [float]]
+    he_range: [(int, int)]
+
+    def __init__(self, user_dict: Optional[str] = None, regex_rules: Optional[str] = None):
+        self.user_dict = user_dict
+        self.regex_rules = regex_rules
+        self.tokenizer: Optional[jieba.Tokenizer] = None
+        self.rules: Optional[RegexRules] = None
+        self.heat = np.zeros(0)
+        self.document_frequency = Counter()
+        self.comments = []
+        self.wordcount_slices = dict()
+        self.super_chats = []
+        self.comment_count = 0
+        self.end_time = 0.0
+        self.last_time = None
+        self.summaries = dict()
+        self.heat_ratio = np.zeros(0)
+        self.heat_average = np.zeros(0)
+        self.he_points = [[], []]
+        self.he_range = []
+        self.lock = threading.Lock()
+
+    def add_segment(self, comments: [(float, str)], super_chats: [(float, str, str, str, float)],
+                    last_time: Optional[float], offset: float, length: float):
+        """
+        Add the danmaku of the next segment, whose times are relative to its start at offset.
+        """
+        with self.lock:
+            # loading the dictionaries takes a while, so it is done with the first segment and not at session start
+            if self.tokenizer is None:
+                self.tokenizer = get_tokenizer(self.user_dict)
+                self.rules = get_regex_rules(self.regex_rules)
+            comments = sorted([(time + offset, text) for time, text in comments], key=lambda comment: comment[0])
+            self.comments = sorted(self.comments + comments, key=lambda comment: comment[0])
+            self.super_chats = sorted(self.super_chats + [
+                (time + offset, price, message, user, duration)
+                for time, price, message, user, duration in super_chats
+            ], key=lambda super_chat: super_chat[0])
+            self.comment_count += len(comments)
+            self.end_time = max(self.end_time, offset + length)
+            if last_time is not None:
+                self.last_time = last_time + offset if self.last_time is None else \
+                    max(self.last_time, last_time + offset)
+            heat_length = int(max(self.end_time, self.last_time or 0)) + 1
+            if heat_length > len(self.heat):
+                self.heat = np.concatenate((self.heat, np.zeros(heat_length - len(self.heat))))
+
+            words = [list(self.tokenizer.cut(self.rules.apply(text))) for _, text in comments]
+            times = np.array([time for time, _ in comments], dtype=float)
+            slices: {int: [[str]]} = dict()
+            for time, danmaku_words in zip(times, words):
+                if time >= 0:
+                    slices.setdefault(int(time), []).append(danmaku_words)
+            for second, danmaku_slice in slices.items():
+                # the same words as cutting the danmaku of the second joined by spaces, as danmaku_tools does, since
+                # jieba never joins words across a space
+                wordcount = Counter(word for danmaku_words in danmaku_slice for word in danmaku_words)
+                if len(danmaku_slice) > 1:
+                    wordcount[" "] += len(danmaku_slice) - 1
+                previous = self.wordcount_slices.get(second, Counter())
+                self.document_frequency.update(wordcount.keys() - previous.keys())
+                self.wordcount_slices[second] = previous + wordcount
+            if len(comments) > 0:
+                idf = self.idf()
+                values = np.array([sum(idf.get(word, 0) for word in danmaku_words) for danmaku_words in words])
+                # a danmaku only adds to the seconds whose window it falls in
+                first = max(0, int(times[0]) - HEAT_INTERVAL)
+                end = min(len(self.heat), int(times[-1]) + HEAT_INTERVAL + 1)
+                self.heat[first:end] += self.window_heat(times, values, np.arange(first, end, dtype=float))
+            open_start = self.detect(len(self.heat))
+            self.settle(int(self.end_time) - SETTLE_SECONDS, open_start)
+
+    def idf(self) -> {str: float}:
+        # every second up to the last danmaku is a document
+        documents = int(self.last_time) + 1 if self.last_time is not None else len(self.heat)
+        return {word: math.log(documents / (1 + count)) for word, count in self.document_frequency.items()}
+
+    @staticmethod
+    def window_heat(times: np.ndarray, values: np.ndarray, centers: np.ndarray) -> np.ndarray:
+        # sum of the danmaku values in [center - HEAT_INTERVAL, center + HEAT_INTERVAL) for every center
+        order = np.argsort(times, kind='stable')
+        times, values = times[order], values[order]
+        prefix = np.concatenate(([0.0], np.cumsum(values)))
+        start = np.searchsorted(times, centers - HEAT_INTERVAL, side='left')
+        end = np.searchsorted(times, centers + HEAT_INTERVAL, side='left')
+        return prefix[end] - prefix[start]
+
+    def detect(self, length: int) -> int:
+        """
+        Smooth the heat of the first length seconds and find the high energy ranges in it. Returns the start of the
+        range still open at the end, or -1.
+        """
+        heat = self.heat[:length]
+        heat_gaussian = half_gaussian_filter(heat, sigma=SHORT_SIGMA)
+        heat_gaussian2 = half_gaussian_filter(heat, sigma=LONG_SIGMA) * 1.2
+        self.heat_average = np.sqrt(heat_gaussian2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.heat_ratio = np.nan_to_num(heat_gaussian / self.heat_average)
+        self.he_points, self.he_range, open_start = self.find_high_energy(heat_gaussian, heat_gaussian2)
+        return open_start
+
+    def settle(self, settled_time: int, open_start: int):
+        """
+        Summarise the high energy ranges that closed, and drop the comments and word counts that no range can need
+        any more. A range that ended after settled_time may still move, so what it covers is kept.
+        """
+        keep_from = settled_time if open_start == -1 else min(settled_time, open_start)
+        summaries = dict()
+        for start, end in self.he_range:
+            summaries[(start, end)] = self.summaries.get((start, end)) or self.summarise(start, end)
+            if end >= settled_time:
+                keep_from = min(keep_from, start)
+        self.summaries = summaries
+        if keep_from <= 0:
+            return
+        times = [time for time, _ in self.comments]
+        self.comments = self.comments[bisect.bisect_right(times, keep_from - 1):]
+        self.wordcount_slices = {
+            second: wordcount for second, wordcount in self.wordcount_slices.items() if second >= keep_from
+        }
+
+    @staticmethod
+    def find_high_energy(heat_gaussian: np.ndarray, heat_gaussian2: np.ndarray) \
+            -> ([[int], [float]], [(int, int)], int):
+        he_points = [[], []]
+        he_range = []
+        cur_highest = -1
+        highest_idx = -1
+        he_start = -1
+        for i in range(len(heat_gaussian)):
+            ratio = heat_gaussian[i] / np.sqrt(heat_gaussian2[i]) if heat_gaussian2[i] > 0 else 0
+            if highest_idx != -1:
+                if heat_gaussian[i] < heat_gaussian2[i]:
+                    he_points[0] += [highest_idx]
+                    he_points[1] += [cur_highest]
+                    he_range += [(he_start, i)]
+                    highest_idx = -1
+                    he_start = -1
+                elif ratio > cur_highest:
+                    cur_highest = ratio
+                    highest_idx = i
+            elif heat_gaussian[i] > heat_gaussian2[i]:
+                cur_highest = ratio
+                highest_idx = i
+                he_start = i
+        # a high energy range still open at the end is usually just saying goodbye, so it is left out
+        return he_points, he_range, he_start
+
+    def he_time(self) -> int:
+        if len(self.he_points[0]) == 0:
+            return 0
+        return self.he_points[0][int(np.argmax(self.he_points[1]))]
+
+    def comments_in_range(self, start: int, end: int) -> [str]:
+        times = [time for time, _ in self.comments]
+        return [
+            text for _, text in self.comments[bisect.bisect_right(times, start):bisect.bisect_right(times, end)]
+            if text.replace(" ", "").replace("哈", "") != ""
+        ]
+
+    def find_keywords(self, start: int, end: int, n_keys: int = 3) -> [str]:
+        he_window = sum([self.wordcount_slices.get(second, Counter()) for second in range(start, end + 1)], Counter())
+        idf = self.idf()
+        word_importance = {word: count * idf[word] for word, count in he_window.items() if word != ' '}
+        return [word for word, _ in sorted(word_importance.items(), key=operator.itemgetter(1))[-n_keys:][::-1]]
+
+    def summarise(self, start: int, end: int) -> (str, [str]):
+        comment_list = self.comments_in_range(start, end)
+        if len(comment_list) > TEXT_RANK_SAMPLES:
+            comment_list = random.sample(comment_list, TEXT_RANK_SAMPLES)
+        text_rank = TextRank4Sentence()
+        text_rank.analyze("\n".join(comment_list), lower=True, source='no_filter')
+        key_sentences = text_rank.get_key_sentences(num=1, sentence_min_len=1)
+        return key_sentences[0]['sentence'] if len(key_sentences) > 0 else "", self.find_keywords(start, end)
+
+    def he_map_text(self) -> str:
+        if len(self.he_points[0]) == 0:
+            return segment_text("没有高能...\n")
+        # only ranges that moved since the last segment was added are summarised here
+        summaries = [self.summaries.get(he_range) or self.summarise(*he_range) for he_range in self.he_range]
+        highest_id = int(np.argmax(self.he_points[1]))
+        text = f"全场最高能：{convert_time(self.he_points[0][highest_id])}\t{summaries[highest_id][0]}\n\n其他高能："
+        for (start, end), (sentence, keywords) in zip(self.he_range, summaries):
+            text += f"\n {convert_time(start)} - {convert_time(end)}\t{sentence}\t({','.join(keywords)})"
+        return segment_text(text + "\n")
+
+    def area_masks(self) -> (np.ndarray, np.ndarray):
+        """
+        The seconds drawn in the areas below and above the average, which are split where the ratio crosses the
+        average as in danmaku_tools. The second an area starts at also closes the area before it.
+        """
+        diff = self.heat_ratio - self.heat_average
+        change = np.zeros(len(diff), dtype=bool)
+        change[1:-1] = diff[:-2] * diff[2:] < 0
+        starts = np.flatnonzero(change)
+        high_areas = np.concatenate(([diff[0] >= 0], diff[starts - 1] < 0))
+        area = np.cumsum(change)
+        high = high_areas[area]
+        closing_high = change & high_areas[np.maximum(area - 1, 0)]
+        closing_low = change & ~high_areas[np.maximum(area - 1, 0)]
+        return ~high | closing_low, high | closing_high
+
+    def render_graph(self, width: int, height: int) -> np.ndarray:
+        """
+        Draw the graph straight into a height x width RGBA image: the heat ratio as a filled area, coloured by whether
+        it is above its average, and a dot for every super chat, the same graph danmaku_tools plots.
+        """
+        ratio = self.heat_ratio
+        span = max(len(ratio) - 1, 1)
+        low = ratio.min()
+        scale = height / (ratio.max() - low) if ratio.max() > low else 0.0
+        # premultiplied colour and alpha, so layers are composited with one multiply-add each
+        image = np.zeros((height, width, 4))
+
+        # the curve is sampled every second, or at every column centre when there are fewer seconds than columns.
+        # A pixel is covered by the share of the samples of its column that reach above it, counted with one
+        # histogram over column and row of the top of every sample
+        if span >= width:
+            seconds = np.arange(len(ratio))
+            values = ratio
+            columns = np.minimum((seconds * width / span).astype(int), width - 1)
+        else:
+            centers = (np.arange(width) + 0.5) * span / width
+            seconds = np.minimum(np.rint(centers).astype(int), len(ratio) - 1)
+            values = np.interp(centers, np.arange(len(ratio)), ratio)
+            columns = np.arange(width)
+        samples = np.maximum(np.bincount(columns, minlength=width), 1)[:, None]
+        tops = np.clip((values - low) * scale, 0.0, height)
+        top_rows = np.minimum(tops.astype(int), height - 1)
+        for mask, color in zip(self.area_masks(), [LOW_AREA_COLOR, HIGH_AREA_COLOR]):
+            bins = (columns * height + top_rows)[mask[seconds]]
+            ending = np.bincount(bins, minlength=width * height).reshape(width, height)
+            partial = np.bincount(bins, weights=(tops - top_rows)[mask[seconds]],
+                                  minlength=width * height).reshape(width, height)
+            above = ending.sum(axis=1, keepdims=True) - np.cumsum(ending, axis=1)
+            coverage = (above + partial) / samples
+            self.composite(image, coverage.T[::-1], color)
+
+        if len(self.super_chats) != 0:
+            radius = SC_DOT_RADIUS * height
+            y = height * 0.9
+            row_range = slice(max(0, int(y - radius - 1)), min(height, int(y + radius + 2)))
+            rows = np.arange(height)[row_range][:, None] + 0.5
+            # expensive super chats are drawn last so cheaper ones do not cover them
+            for time, price, _, _, _ in sorted(self.super_chats, key=lambda sc: int(sc[1])):
+                x = time * width / span
+                column_range = slice(max(0, int(x - radius - 1)), max(0, min(width, int(x + radius + 2))))
+                cols = np.arange(width)[column_range][None, :] + 0.5
+                coverage = np.clip(radius + 0.5 - np.hypot(cols - x, rows - y), 0.0, 1.0)
+                self.composite(image[row_range, column_range], coverage, sc_color(int(price)) + (255,))
+
+        alpha = image[:, :, 3:]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            image[:, :, :3] = np.where(alpha > 0, image[:, :, :3] / alpha, 0.0)
+        return np.rint(image * 255).astype(np.uint8)
+
+    @staticmethod
+    def composite(image: np.ndarray, coverage: np.ndarray, color: (int, int, int, int)):
+        alpha = coverage[:, :, None] * (color[3] / 255)
+        source = np.array(color[:3] + (255,)) / 255
+        image *= 1 - alpha
+        image += alpha * source
+
+    def write(self, paths: {str: str}, graph_width: int = GRAPH_WIDTH):
+        """
+        Finish the map at the last danmaku and write the high energy ranges, their summary and the graph, which is
+        rendered graph_width wide, usually the width of the video it is put on.
+        """
+        with self.lock:
+            self.detect(int(self.last_time if self.last_time is not None else self.end_time) + 1)
+            with open(paths['he_range'], "w") as file:
+                json.dump(self.he_range, file)
+            with open(paths['he_file'], "w") as file:
+                file.write(self.he_map_text())
+            graph = self.render_graph(graph_width, max(1, round(graph_width / GRAPH_ASPECT)))
+            Image.fromarray(graph, 'RGBA').save(paths['he_graph'])
+
+
+def write_density_graph(path: str, density: [float], super_chats: [(float, str, str, str, float)],
+                        graph_width: int = GRAPH_WIDTH):
+    """
+    The graph of the danmaku density alone, smoothed as the heat is, for the progress bar when the energy map failed.
+    """
+    graph = EnergyMap()
+    graph.heat = np.array(density if len(density) > 0 else [0.0], dtype=float)
+    graph.super_chats = super_chats
+    graph.detect(len(graph.heat))
+    image = graph.render_graph(graph_width, max(1, round(graph_width / GRAPH_ASPECT)))
+    Image.fromarray(image, 'RGBA').save(path)
+
+
+def sc_color(price: int) -> (int, int, int):
+    if price < 50:
+        return 42, 96, 178
+    elif price < 100:
+        return 66, 125, 158
+    elif price < 500:
+        return 226, 181, 43
+    elif price < 1000:
+        return 224, 148, 67
+    elif price < 2000:
+        return 229, 77, 77
+    return 171, 26, 50
+
+
+def sc_list_text(super_chats: [(float, str, str, str, float)]) -> str:
+    if len(super_chats) == 0:
+        return "没有醒目留言..."
+    sc_text = "醒目留言列表："
+    for time, price, message, user, _ in super_chats:
+        sc_text += f"\n {convert_time(int(time))} ¥{price} {user}: {message}"
+    return segment_text(sc_text + "\n")
+
+
+def sc_srt_text(super_chats: [(float, str, str, str, float)]) -> str:
+    """
+    Super chats as subtitles, every one stays on screen for 60% of its paid time and the newest is shown first.
+    """
+    def display_sc(start, end, sc_list):
+        content = "\n".join([sc[3] for sc in sorted(sc_list, key=lambda x: (-float(x[0]), -int(x[2])))])
+        if len(content) >= SC_SRT_LIMIT:
+            content = content[:SC_SRT_LIMIT - 2] + "…"
+        return srt.Subtitle(index=0, start=timedelta(seconds=start), end=timedelta(seconds=end), content=content)
+
+    def flush_sc(active_sc, start_time: float, end_time: float):
+        current_sc = sorted(active_sc, key=lambda x: x[1])
+        subtitle_list = []
+        while len(current_sc) > 0 and current_sc[0][1] < end_time:
+            if current_sc[0][1] - start_time > 1:
+                subtitle_list += [display_sc(start_time, current_sc[0][1], current_sc)]
+                start_time = current_sc[0][1]
+            current_sc.pop(0)
+        if end_time - start_time > 1:
+            subtitle_list += [display_sc(start_time, end_time, current_sc)]
+            start_time = end_time
+        return current_sc, subtitle_list, start_time
+
+    active_sc = []
+    subtitles = []
+    cur_time = 0
+    for time, price, message, user, duration in super_chats:
+        content = f"¥{price} {user}: {message}".replace("绑架", "**")
+        active_sc, new_subtitles, cur_time = flush_sc(active_sc, cur_time, time)  # flush all the previous ones
+        active_sc += [(time, time + duration * 0.6, price, content)]
+        subtitles += new_subtitles
+    if len(active_sc) > 0:
+        _, new_subtitles, _ = flush_sc(active_sc, cur_time, max([sc[1] for sc in active_sc]))
+        subtitles += new_subtitles
+    return srt.compose(subtitles)
+
+
+def write_super_chats(paths: {str: str}, super_chats: [(float, str, str, str, float)]):
+    with open(paths['sc_file'], "w") as file:
+        file.write(sc_list_text(super_chats))
+    with open(paths['sc_srt'], "w") as file:
+        file.write(sc_srt_text(super_chats))
@@ -0,0 +1,119 @@
+import datetime
+import gzip
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from typing import Iterator, Tuple
+
+JOURNAL_DIR = "event_journal"
+JOURNAL_FILE = "events.jsonl"
+JOURNAL_MAX_BYTES = 16 * 1024 * 1024
+JOURNAL_MAX_FILES = 30
+
+
+class EventJournal:
+    """
+    Appends every recorder event as it arrives to a file of JSON lines, together with the time it was received. The
+    file is rotated once it is JOURNAL_MAX_BYTES large, rotated files are compressed in the background, and only the
+    latest JOURNAL_MAX_FILES of them are kept. Rotated files left uncompressed by a failure or a crash are compressed
+    again when the journal is opened.
+    """
+
+    def __init__(self, directory: str = JOURNAL_DIR, max_bytes: int = JOURNAL_MAX_BYTES,
+                 max_files: int = JOURNAL_MAX_FILES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.path = os.path.join(directory, JOURNAL_FILE)
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.file = open(self.path, 'a', encoding='utf-8')
+        leftovers = [
+            os.path.join(directory, file_name) for file_name in sorted(os.listdir(directory))
+            if file_name.startswith("events-") and file_name.endswith(".jsonl")
+        ]
+        if len(leftovers) > 0:
+            threading.Thread(target=self.compress_all, args=(leftovers,), daemon=True).start()
+
+    def append(self, update_json: dict):
+        line = json.dumps({"t": time.time(), "e": update_json}, ensure_ascii=False, separators=(',', ':')) + "\n"
+        with self.lock:
+            try:
+                self.file.write(line)
+                self.file.flush()
+                if self.file.tell() >= self.max_bytes:
+                    self.rotate()
+            except OSError as err:
+                logging.warn("cannot write event journal %s: %s", self.path, err)
+
+    def rotate(self):
+        self.file.close()
+        rotated_path = os.path.join(
+            self.directory, f"events-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')}.jsonl"
+        )
+        os.replace(self.path, rotated_path)
+        self.file = open(self.path, 'a', encoding='utf-8')
+        threading.Thread(target=self.compress, args=(rotated_path,), daemon=True).start()
+
+    def compress_all(self, rotated_paths: [str]):
+        logging.info("compressing %d event journal files left uncompressed", len(rotated_paths))
+        for rotated_path in rotated_paths:
+            self.compress(rotated_path)
+
+    def compress(self, rotated_path: str):
+        try:
+            # a crash after the compressed file was written leaves both
+            if not os.path.exists(rotated_path + ".gz"):
+                with open(rotated_path, 'rb') as source, gzip.open(rotated_path + ".gz.tmp", 'wb') as target:
+                    shutil.copyfileobj(source, target)
+                os.replace(rotated_path + ".gz.tmp", rotated_path + ".gz")
+            os.remove(rotated_path)
+        except OSError as err:
+            logging.warn("cannot compress event journal %s: %s", rotated_path, err)
+        with self.lock:
+            for old_path in rotated_files(self.directory)[:-self.max_files]:
+                try:
+                    os.remove(old_path)
+                except OSError as err:
+                    logging.warn("cannot remove event journal %s: %s", old_path, err)
+
+
+def rotated_files(directory: str) -> [str]:
+    """
+    The rotated journal files in the order they were written, compressed or not. A file that was compressed is
+    listed once, as its compressed copy.
+    """
+    file_names = set(os.listdir(directory))
+    return [
+        os.path.join(directory, file_name) for file_name in sorted(file_names)
+        if file_name.startswith("events-") and (
+            file_name.endswith(".jsonl.gz") or file_name.endswith(".jsonl") and file_name + ".gz" not in file_names
+        )
+    ]
+
+
+def journal_files(directory: str) -> [str]:
+    """
+    The journal files in the order they were written, the file being written last.
+    """
+    current = os.path.join(directory, JOURNAL_FILE)
+    return rotated_files(directory) + ([current] if os.path.exists(current) else [])
+
+
+def read_journal(paths: [str]) -> Iterator[Tuple[float, dict]]:
+    """
+    The events of the given journal files with the time they were received. A line cut short by a crash is skipped.
+    """
+    for path in paths:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, 'rt', encoding='utf-8') as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    logging.warn("unreadable line in event journal %s", path)
+                    continue
+                yield entry["t"], entry["e"]
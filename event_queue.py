@@ -0,0 +1,108 @@
+import asyncio
+import collections
+import logging
+import time
+import traceback
+from typing import Callable, Optional
+
+import dateutil.parser
+
+# ids of the latest events, a redelivered event older than these is not recognised anymore
+EVENT_ID_HISTORY = 10000
+
+
+def validate_event(update_json) -> Optional[str]:
+    """
+    What is wrong with a recorder event, or None if it can be queued.
+    """
+    if not isinstance(update_json, dict):
+        return "event is not an object"
+    for key in ["EventType", "EventTimestamp", "EventData"]:
+        if key not in update_json:
+            return f"{key} missing"
+    event_data = update_json["EventData"]
+    if not isinstance(event_data, dict):
+        return "EventData is not an object"
+    if not isinstance(event_data.get("RoomId"), int):
+        return "RoomId missing"
+    if not isinstance(event_data.get("SessionId"), str):
+        return "SessionId missing"
+    try:
+        dateutil.parser.isoparse(update_json["EventTimestamp"])
+    except (TypeError, ValueError):
+        return "EventTimestamp invalid"
+    return None
+
+
+class EventStats:
+    received: int
+    duplicated: int
+    processed: int
+    failed: int
+    total_wait: float
+    max_wait: float
+
+    def __init__(self):
+        self.received = 0
+        self.duplicated = 0
+        self.processed = 0
+        self.failed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def to_dict(self):
+        return {
+            "received": self.received,
+            "duplicated": self.duplicated,
+            "processed": self.processed,
+            "failed": self.failed,
+            "average_wait": self.total_wait / self.processed if self.processed > 0 else 0.0,
+            "max_wait": self.max_wait
+        }
+
+
+class EventQueue:
+    """
+    Takes recorder events as they arrive and hands them to handler on the loop of the manager, so the webhook of the
+    recorder is answered right away, and events are handled on the same loop as the sessions they change. The handler
+    does not wait for anything, and callbacks run in the order they were scheduled, so the events of a room are handled
+    in order. An event delivered twice, going by its EventId, is only handled once.
+
+    put is only called from the thread the webhook is served on, and the handling side only runs on the loop, so each
+    counter of the stats has a single writer.
+    """
+
+    def __init__(self, handler: Callable[[dict], object], loop: asyncio.AbstractEventLoop):
+        self.handler = handler
+        self.loop = loop
+        self.event_ids: {str: None} = collections.OrderedDict()
+        self.stats = EventStats()
+
+    def put(self, update_json: dict) -> bool:
+        event_id = update_json.get("EventId")
+        self.stats.received += 1
+        if event_id is not None:
+            if event_id in self.event_ids:
+                self.stats.duplicated += 1
+                return False
+            self.event_ids[event_id] = None
+            while len(self.event_ids) > EVENT_ID_HISTORY:
+                self.event_ids.popitem(last=False)
+        self.loop.call_soon_threadsafe(self.handle, time.monotonic(), update_json)
+        return True
+
+    def handle(self, queued_at: float, update_json: dict):
+        wait = time.monotonic() - queued_at
+        try:
+            self.handler(update_json)
+        except Exception:
+            logging.error("%s of session %s failed: %s", update_json["EventType"],
+                          update_json["EventData"]["SessionId"], traceback.format_exc())
+            self.stats.failed += 1
+        self.stats.processed += 1
+        self.stats.total_wait += wait
+        self.stats.max_wait = max(self.stats.max_wait, wait)
+
+    def to_dict(self):
+        stats = self.stats
+        return dict(stats.to_dict(), queued=stats.received - stats.duplicated - stats.processed)
@@ -0,0 +1,207 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import shutil
+import time
+from typing import Optional
+
+CPU_COUNT = os.cpu_count() or 1
+# a job that waited longer than this is logged together with the queue it waited in
+LOG_WAIT_SECONDS = 1.0
+
+
+class JobClass:
+    name: str
+    limit: int
+    priority: int
+    niceness: int
+    io_class: int  # ionice scheduling class, 2 is best-effort
+    io_level: int
+    shared: bool
+    exclusive: bool  # starts only when no other job runs, and no other job starts while it runs
+
+    def __init__(self, name: str, limit: int, priority: int, niceness: int, io_class: int, io_level: int,
+                 shared: bool = True, exclusive: bool = False):
+        self.name = name
+        self.limit = limit
+        self.priority = priority
+        self.niceness = niceness
+        self.io_class = io_class
+        self.io_level = io_level
+        self.shared = shared
+        self.exclusive = exclusive
+
+
+# lower priority runs first. Remuxing the early video is cheap and gates the first upload, so it is never held back
+# by the shared limit and runs with a normal nice value while the heavy jobs yield the CPU and the disk to it
+REMUX = JobClass("remux", 2, 0, 0, 2, 0, shared=False)
+# probing reads every packet of a segment, a burst of closed segments is read a few at a time
+PROBE = JobClass("probe", 2, 1, 5, 2, 4)
+THUMBNAIL = JobClass("thumbnail", 2, 1, 5, 2, 4)
+DANMAKU = JobClass("danmaku", max(1, CPU_COUNT // 2), 2, 10, 2, 4)
+TRANSCODE = JobClass("transcode", max(1, CPU_COUNT // 4), 3, 15, 2, 7)
+# measuring encoder speed, which any other job running at the same time would skew
+BENCHMARK = JobClass("benchmark", 1, 0, 0, 2, 0, exclusive=True)
+JOB_CLASSES = [REMUX, PROBE, THUMBNAIL, DANMAKU, TRANSCODE, BENCHMARK]
+SHARED_LIMIT = max(2, CPU_COUNT // 2)
+
+
+class JobStats:
+    running: int
+    queued: int
+    finished: int
+    total_wait: float
+    max_wait: float
+
+    def __init__(self):
+        self.running = 0
+        self.queued = 0
+        self.finished = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def to_dict(self):
+        return {
+            "running": self.running,
+            "queued": self.queued,
+            "finished": self.finished,
+            "average_wait": self.total_wait / self.finished if self.finished > 0 else 0.0,
+            "max_wait": self.max_wait
+        }
+
+
+class Job:
+    job_class: JobClass
+    name: str
+    queued_at: float
+    started_at: Optional[float]
+
+    def __init__(self, job_class: JobClass, name: str):
+        self.job_class = job_class
+        self.name = name
+        self.queued_at = time.monotonic()
+        self.started_at = None
+
+    def command_prefix(self) -> [str]:
+        prefix = []
+        if self.job_class.niceness != 0 and shutil.which("nice") is not None:
+            prefix += ["nice", "-n", str(self.job_class.niceness)]
+        if shutil.which("ionice") is not None:
+            # -t runs the command anyway where the I/O priority cannot be set, e.g. in a restricted container
+            prefix += ["ionice", "-t", "-c", str(self.job_class.io_class), "-n", str(self.job_class.io_level)]
+        return prefix
+
+    def wrap(self, argv: [str]) -> [str]:
+        return self.command_prefix() + argv
+
+
+class JobSlot:
+    def __init__(self, scheduler: 'JobScheduler', job: Job):
+        self.scheduler = scheduler
+        self.job = job
+
+    async def __aenter__(self) -> Job:
+        await self.scheduler.acquire(self.job)
+        return self.job
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.scheduler.release(self.job)
+
+
+class JobScheduler:
+    """
+    Limits how many external processes of each class run at once, over all sessions. Heavy classes also share a
+    global limit, and when a slot frees up the waiting job of the most urgent class gets it. An exclusive job waits
+    until nothing else runs, and holds every other job back while it runs.
+    """
+
+    def __init__(self, job_classes: [JobClass] = None, shared_limit: int = SHARED_LIMIT):
+        self.stats: {str: JobStats} = {job_class.name: JobStats() for job_class in job_classes or JOB_CLASSES}
+        self.shared_limit = shared_limit
+        self.shared_running = 0
+        self.exclusive_running = 0
+        self.waiting: [(int, int, Job, asyncio.Future)] = []
+        self.counter = itertools.count()
+
+    def job(self, job_class: JobClass, name: str) -> JobSlot:
+        return JobSlot(self, Job(job_class, name))
+
+    def can_start(self, job_class: JobClass) -> bool:
+        if self.exclusive_running > 0 or self.stats[job_class.name].running >= job_class.limit:
+            return False
+        if job_class.exclusive:
+            return all(stats.running == 0 for stats in self.stats.values())
+        return not job_class.shared or self.shared_running < self.shared_limit
+
+    def start(self, job: Job):
+        stats = self.stats[job.job_class.name]
+        stats.running += 1
+        if job.job_class.shared:
+            self.shared_running += 1
+        if job.job_class.exclusive:
+            self.exclusive_running += 1
+        job.started_at = time.monotonic()
+        wait = job.started_at - job.queued_at
+        stats.total_wait += wait
+        stats.max_wait = max(stats.max_wait, wait)
+        if wait > LOG_WAIT_SECONDS:
+            logging.info("%s job %s started after waiting %.1fs, %d more queued",
+                         job.job_class.name, job.name, wait, stats.queued)
+
+    def dispatch(self):
+        blocked = []
+        while len(self.waiting) > 0:
+            entry = heapq.heappop(self.waiting)
+            _, _, job, future = entry
+            if future.done():  # cancelled while waiting
+                continue
+            if self.can_start(job.job_class):
+                self.stats[job.job_class.name].queued -= 1
+                self.start(job)
+                future.set_result(None)
+            else:
+                blocked += [entry]
+        for entry in blocked:
+            heapq.heappush(self.waiting, entry)
+
+    async def acquire(self, job: Job):
+        stats = self.stats[job.job_class.name]
+        if len(self.waiting) == 0 and self.can_start(job.job_class):
+            self.start(job)
+            return
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self.waiting, (job.job_class.priority, next(self.counter), job, future))
+        stats.queued += 1
+        self.dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if job.started_at is not None:
+                self.release(job)
+            else:
+                stats.queued -= 1
+            raise
+
+    def release(self, job: Job):
+        stats = self.stats[job.job_class.name]
+        stats.running -= 1
+        stats.finished += 1
+        if job.job_class.shared:
+            self.shared_running -= 1
+        if job.job_class.exclusive:
+            self.exclusive_running -= 1
+        logging.debug("%s job %s finished in %.1fs", job.job_class.name, job.name, time.monotonic() - job.started_at)
+        self.dispatch()
+
+    def to_dict(self):
+        return {
+            "shared_running": self.shared_running,
+            "shared_limit": self.shared_limit,
+            "exclusive_running": self.exclusive_running,
+            "classes": {name: stats.to_dict() for name, stats in self.stats.items()}
+        }
+
+
+job_scheduler = JobScheduler()
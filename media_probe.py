@@ -0,0 +1,191 @@
+import json
+import logging
+import os
+from typing import Any, Optional
+
+from job_scheduler import PROBE
+from process_runner import run_process
+
+PROBE_CACHE_SUFFIX = ".probe.json"
+PROBE_CACHE_VERSION = 1
+PROBE_TIMEOUT = 10 * 60
+
+
+class MediaInfo:
+    duration: float
+    width: int
+    height: int
+    video_codec: Optional[str]
+    audio_codec: Optional[str]
+    bit_rate: Optional[int]
+    video_bit_rate: Optional[int]
+    audio_bit_rate: Optional[int]
+    keyframes: [float]
+
+    def __init__(self):
+        self.duration = 0.0
+        self.width = 0
+        self.height = 0
+        self.video_codec = None
+        self.audio_codec = None
+        self.bit_rate = None
+        self.video_bit_rate = None
+        self.audio_bit_rate = None
+        self.keyframes = []
+
+    @property
+    def keyframe_count(self) -> int:
+        return len(self.keyframes)
+
+    @property
+    def resolution(self) -> str:
+        return f"{self.width}x{self.height}"
+
+    def to_dict(self):
+        return vars(self)
+
+    @staticmethod
+    def from_dict(save_dict: {str: Any}) -> 'MediaInfo':
+        media_info = MediaInfo()
+        for key, value in save_dict.items():
+            media_info.__setattr__(key, value)
+        return media_info
+
+    @staticmethod
+    def from_ffprobe(probe_json: dict, keyframes: [float]) -> 'MediaInfo':
+        media_info = MediaInfo()
+        probe_format = probe_json.get("format", {})
+        if "duration" not in probe_format:
+            raise ValueError("duration unknown")
+        media_info.duration = float(probe_format["duration"])
+        media_info.bit_rate = _optional_int(probe_format.get("bit_rate"))
+        for stream in probe_json.get("streams", []):
+            if stream.get("codec_type") == "video" and media_info.video_codec is None:
+                media_info.video_codec = stream.get("codec_name")
+                media_info.width = int(stream.get("width", 0))
+                media_info.height = int(stream.get("height", 0))
+                media_info.video_bit_rate = _optional_int(stream.get("bit_rate"))
+            elif stream.get("codec_type") == "audio" and media_info.audio_codec is None:
+                media_info.audio_codec = stream.get("codec_name")
+                media_info.audio_bit_rate = _optional_int(stream.get("bit_rate"))
+        media_info.keyframes = keyframes
+        return media_info
+
+
+def _optional_int(value) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def cache_path(media_path: str) -> str:
+    return media_path + PROBE_CACHE_SUFFIX
+
+
+def _cache_key(media_path: str) -> dict:
+    stat = os.stat(media_path)
+    return {"path": os.path.abspath(media_path), "size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+
+def load_cached(media_path: str) -> Optional[MediaInfo]:
+    try:
+        with open(cache_path(media_path), 'r') as file:
+            cache = json.load(file)
+        if cache.get("version") != PROBE_CACHE_VERSION or cache.get("key") != _cache_key(media_path):
+            return None
+        return MediaInfo.from_dict(cache["info"])
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def store_cached(media_path: str, key: dict, media_info: MediaInfo):
+    path = cache_path(media_path)
+    try:
+        with open(path + ".tmp", 'w') as file:
+            json.dump({"version": PROBE_CACHE_VERSION, "key": key, "info": media_info.to_dict()}, file)
+        os.replace(path + ".tmp", path)
+    except OSError as err:
+        logging.warn("cannot write probe cache %s: %s", path, err)
+
+
+class FfprobeOutput:
+    """
+    The JSON output of ffprobe, taken line by line. Packets are consumed as they stream in, so only video keyframe
+    timestamps are kept instead of buffering the whole packet dump.
+    """
+
+    def __init__(self):
+        self.remaining_lines: [str] = []
+        self.keyframes: [float] = []
+        self.in_packets = False
+        self.packet_buffer = ""
+        self.error: Optional[ValueError] = None
+
+    def feed(self, line: str):
+        if self.error is not None:
+            return
+        try:
+            self.feed_line(line)
+        except ValueError as err:
+            # kept for later, the output is still read to its end so ffprobe is not blocked on a full pipe
+            self.error = err
+
+    def feed_line(self, line: str):
+        stripped = line.strip()
+        if self.in_packets:
+            if self.packet_buffer == "" and stripped.startswith("]"):
+                self.in_packets = False
+                self.remaining_lines.append(line)
+                return
+            self.packet_buffer += stripped
+            if self.packet_buffer.count("{") != self.packet_buffer.count("}"):
+                return
+            packet = json.loads(self.packet_buffer.rstrip(","))
+            self.packet_buffer = ""
+            if packet.get("codec_type") == "video" and "K" in packet.get("flags", "") \
+                    and packet.get("pts_time", "N/A") != "N/A":
+                self.keyframes.append(float(packet["pts_time"]))
+            return
+        if stripped == '"packets": [':
+            self.in_packets = True
+        self.remaining_lines.append(line)
+
+    def media_info(self) -> MediaInfo:
+        if self.error is not None:
+            raise self.error
+        return MediaInfo.from_ffprobe(json.loads("\n".join(self.remaining_lines)), self.keyframes)
+
+
+async def run_ffprobe(media_path: str) -> MediaInfo:
+    # one pass gives both the container/stream metadata and the packet list. It reads the whole file, so it is a
+    # scheduled job, and a timeout keeps a hung ffprobe from holding the segment and its session forever
+    output = FfprobeOutput()
+    result = await run_process([
+        "ffprobe", "-v", "error", "-of", "json=compact=1",
+        "-show_format", "-show_streams", "-show_entries", "packet=codec_type,pts_time,flags",
+        media_path
+    ], timeout=PROBE_TIMEOUT, job_class=PROBE, job_name=f"probe {media_path}", on_output=output.feed)
+    if result.timed_out:
+        raise ValueError(f"ffprobe timed out after {PROBE_TIMEOUT}s")
+    if not result.succeeded:
+        raise ValueError(f"ffprobe exited with {result.return_code}: {' '.join(result.stderr_tail[-3:])}")
+    return output.media_info()
+
+
+async def probe_media(media_path: str) -> MediaInfo:
+    """
+    Probe duration, resolution, codecs, bitrates and keyframes of a media file. Results are cached next to the file
+    and keyed by path, size and mtime, so a file is only probed again after it changes.
+    """
+    media_info = load_cached(media_path)
+    if media_info is not None:
+        logging.debug("probe cache hit: %s", media_path)
+        return media_info
+    try:
+        key = _cache_key(media_path)
+        media_info = await run_ffprobe(media_path)
+    except OSError as err:
+        raise ValueError(f"cannot probe {media_path}: {err}")
+    store_cached(media_path, key, media_info)
+    return media_info
@@ -0,0 +1,244 @@
+import asyncio
+import collections
+import logging
+import os
+import re
+import signal
+import subprocess
+import threading
+import time
+from typing import Callable, Optional
+
+from job_scheduler import JobClass, job_scheduler
+
+STDERR_TAIL_LINES = 50
+TERMINATE_GRACE_SECONDS = 10
+READ_SIZE = 65536
+
+
+class Progress:
+    """
+    One block of ffmpeg -progress output.
+    """
+    out_time: float
+    speed: Optional[float]
+    frame: Optional[int]
+    fps: Optional[float]
+    finished: bool
+
+    def __init__(self, values: {str: str}):
+        self.out_time = _progress_time(values)
+        self.speed = _progress_number(values.get("speed", "").rstrip("x"), float)
+        self.frame = _progress_number(values.get("frame"), int)
+        self.fps = _progress_number(values.get("fps"), float)
+        self.finished = values.get("progress") == "end"
+
+    def eta(self, total_time: float) -> Optional[float]:
+        if self.speed is None or self.speed <= 0:
+            return None
+        return max(0.0, total_time - self.out_time) / self.speed
+
+
+def _progress_number(value: Optional[str], number_type):
+    try:
+        return number_type(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _progress_time(values: {str: str}) -> float:
+    # out_time_us is the precise one, older ffmpeg builds only print out_time_ms, which is in microseconds as well
+    for key in ["out_time_us", "out_time_ms"]:
+        microseconds = _progress_number(values.get(key), int)
+        if microseconds is not None:
+            return microseconds / 1000_000
+    return 0.0
+
+
+class ProcessResult:
+    argv: [str]
+    return_code: int
+    wall_time: float
+    cpu_time: float
+    peak_rss: int  # KB, as wait4 reports it, so never below the size of this process when it was spawned
+    timed_out: bool
+    stderr_tail: [str]
+
+    def __init__(self, argv: [str]):
+        self.argv = argv
+        self.return_code = -1
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.peak_rss = 0
+        self.timed_out = False
+        self.stderr_tail = []
+
+    @property
+    def succeeded(self) -> bool:
+        return self.return_code == 0 and not self.timed_out
+
+    def describe(self) -> str:
+        return f"exit {self.return_code}{' (timed out)' if self.timed_out else ''}, " \
+               f"{self.wall_time:.1f}s wall, {self.cpu_time:.1f}s cpu, {self.peak_rss // 1024}MB peak rss"
+
+
+def _exit_code(status: int) -> int:
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+async def _stream_reader(loop: asyncio.AbstractEventLoop, pipe) -> asyncio.StreamReader:
+    reader = asyncio.StreamReader(loop=loop)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader, loop=loop), pipe)
+    return reader
+
+
+async def _read_lines(reader: asyncio.StreamReader, on_line: Callable[[str], None],
+                      on_data: Optional[Callable[[bytes], None]]):
+    # ffmpeg ends its status line with \r, which would make a single endless line for StreamReader.readline
+    pending = b""
+    while True:
+        data = await reader.read(READ_SIZE)
+        if not data:
+            break
+        if on_data is not None:
+            on_data(data)
+        lines = re.split(b"[\r\n]", pending + data)
+        pending = lines.pop()
+        for line in lines:
+            if line:
+                on_line(line.decode('utf-8', errors='replace'))
+    if pending:
+        on_line(pending.decode('utf-8', errors='replace'))
+
+
+def _reap(loop: asyncio.AbstractEventLoop, pid: int, future: asyncio.Future):
+    # the process is reaped here rather than by the asyncio child watcher, wait4 is the only place its rusage is left
+    _, status, rusage = os.wait4(pid, 0)
+    loop.call_soon_threadsafe(lambda: future.done() or future.set_result((status, rusage)))
+
+
+def _signal(process: subprocess.Popen, signal_number: int):
+    try:
+        os.kill(process.pid, signal_number)
+    except ProcessLookupError:
+        pass
+
+
+async def run_process(argv: [str], log_path: Optional[str] = None, timeout: Optional[float] = None,
+                      on_progress: Optional[Callable[[Progress], None]] = None, stall_timeout: Optional[float] = None,
+                      job_class: Optional[JobClass] = None, job_name: str = "",
+                      on_output: Optional[Callable[[str], None]] = None) -> ProcessResult:
+    """
+    Run argv without a shell and wait for it. stdout and stderr are appended to log_path and the last lines of
+    stderr are kept in the result. When on_progress is given, argv should be an ffmpeg command: -progress is added
+    and every progress block is passed to it, and stall_timeout terminates it once no progress arrived for that
+    long. Otherwise every line of stdout is passed to on_output, if given, as it arrives. Past the timeout the
+    process is terminated as well, and so it is when the calling task is cancelled.
+    """
+    if on_progress is not None:
+        argv = argv[:1] + ["-progress", "pipe:1", "-nostats"] + argv[1:]
+    if job_class is not None:
+        async with job_scheduler.job(job_class, job_name) as job:
+            return await _run_process(job.wrap(argv), log_path, timeout, on_progress, stall_timeout, on_output)
+    return await _run_process(argv, log_path, timeout, on_progress, stall_timeout, on_output)
+
+
+async def _run_process(argv: [str], log_path: Optional[str], timeout: Optional[float],
+                       on_progress: Optional[Callable[[Progress], None]], stall_timeout: Optional[float],
+                       on_output: Optional[Callable[[str], None]] = None) -> ProcessResult:
+    logging.debug("running: %s", subprocess.list2cmdline(argv))
+    loop = asyncio.get_event_loop()
+    result = ProcessResult(argv)
+    log_file = open(log_path, 'ab') if log_path is not None else None
+    stderr_tail = collections.deque(maxlen=STDERR_TAIL_LINES)
+    progress_values = dict()
+    start = time.monotonic()
+    last_progress = start
+    last_out_time = -1.0
+    try:
+        process = subprocess.Popen(argv, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as err:
+        if log_file is not None:
+            log_file.close()
+        stderr_tail.append(str(err))
+        result.stderr_tail = list(stderr_tail)
+        return result
+    reaped = loop.create_future()
+    threading.Thread(target=_reap, args=(loop, process.pid, reaped), daemon=True).start()
+
+    def on_stdout(line: str):
+        nonlocal last_progress, last_out_time
+        if on_progress is None:
+            if on_output is not None:
+                on_output(line)
+            return
+        key, _, value = line.partition("=")
+        progress_values[key.strip()] = value.strip()
+        if key == "progress":
+            progress = Progress(progress_values)
+            # a hung ffmpeg keeps printing progress blocks, only a moving timestamp counts as progress
+            if progress.out_time > last_out_time:
+                last_out_time = progress.out_time
+                last_progress = time.monotonic()
+            try:
+                on_progress(progress)
+            except Exception:
+                logging.exception("progress callback of %s failed", argv[0])
+            progress_values.clear()
+
+    def on_data(data: bytes):
+        if log_file is not None:
+            log_file.write(data)
+
+    readers = None
+    try:
+        readers = asyncio.gather(
+            _read_lines(await _stream_reader(loop, process.stdout), on_stdout,
+                        None if on_progress is not None else on_data),
+            _read_lines(await _stream_reader(loop, process.stderr), stderr_tail.append, on_data)
+        )
+        while not reaped.done():
+            now = time.monotonic()
+            deadlines = []
+            if timeout is not None:
+                deadlines += [start + timeout]
+            if on_progress is not None and stall_timeout is not None:
+                deadlines += [last_progress + stall_timeout]
+            if len(deadlines) > 0 and min(deadlines) <= now:
+                result.timed_out = True
+                logging.warn("%s timed out after %.0fs, terminating", argv[0], now - start)
+                await _terminate(process, reaped)
+                break
+            await asyncio.wait([reaped], timeout=min(deadlines) - now if len(deadlines) > 0 else None)
+        await readers
+    except asyncio.CancelledError:
+        await _terminate(process, reaped)
+        process.returncode = _exit_code(reaped.result()[0])
+        if readers is not None:
+            # cancelled together with the task at shutdown, nothing else collects their error
+            await asyncio.gather(readers, return_exceptions=True)
+        raise
+    finally:
+        if log_file is not None:
+            log_file.close()
+    status, rusage = reaped.result()
+    process.returncode = result.return_code = _exit_code(status)
+    result.wall_time = time.monotonic() - start
+    result.cpu_time = rusage.ru_utime + rusage.ru_stime
+    result.peak_rss = rusage.ru_maxrss
+    result.stderr_tail = list(stderr_tail)
+    logging.debug("%s finished: %s", argv[0], result.describe())
+    return result
+
+
+async def _terminate(process: subprocess.Popen, reaped: asyncio.Future):
+    if reaped.done():
+        return
+    _signal(process, signal.SIGTERM)
+    try:
+        await asyncio.wait_for(asyncio.shield(reaped), TERMINATE_GRACE_SECONDS)
+    except asyncio.TimeoutError:
+        _signal(process, signal.SIGKILL)
+        await asyncio.shield(reaped)
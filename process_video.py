@@ -5,7 +5,10 @@ import os
 from quart import Quart, request, Response
 from quart.logging import default_handler, serving_handler
 
+from event_queue import validate_event
+from job_scheduler import job_scheduler
 from record_upload_manager import RecordUploadManager
+from webhook_dispatcher import webhook_dispatcher
 
 
 def get_free_port():
@@ -38,17 +41,43 @@ logging.getLogger('quart.app').removeHandler(default_handler)
 logging.getLogger('quart.serving').removeHandler(serving_handler)
 
 record_upload_manager = RecordUploadManager(
-    port, "./recorder_config.yaml", "recorder_save.yaml")
+    port, "./recorder_config.yaml", "recorder_save.db", yaml_save_path="recorder_save.yaml")
 
 
 @app.route('/process_video', methods=['POST'])
 async def respond_process():
-    json_request = await request.json
+    json_request = await request.get_json(silent=True)
     logging.debug(json.dumps(json_request))
-    await record_upload_manager.handle_update(json_request)
+    error = validate_event(json_request)
+    if error is not None:
+        logging.warn("invalid event: %s", error)
+        return Response(response=error, status=400)
+    if not record_upload_manager.handle_update(json_request):
+        logging.info("event %s delivered again, ignored", json_request["EventId"])
     return Response(response="", status=200)
 
 
+@app.route('/jobs', methods=['GET'])
+async def respond_jobs():
+    return Response(response=json.dumps(job_scheduler.to_dict()), status=200, mimetype="application/json")
+
+
+@app.route('/events', methods=['GET'])
+async def respond_events():
+    return Response(response=json.dumps(record_upload_manager.events.to_dict()), status=200,
+                    mimetype="application/json")
+
+
+@app.route('/webhooks', methods=['GET'])
+async def respond_webhooks():
+    return Response(response=json.dumps(webhook_dispatcher.to_dict()), status=200, mimetype="application/json")
+
+
+@app.after_serving
+async def shutdown():
+    record_upload_manager.shutdown()
+
+
 if __name__ == "__main__":
     logging.info("webhook listening on port %d", port)
     app.run(port=port)
@@ -1,11 +1,14 @@
 import asyncio
+import collections
+import datetime
 import os.path
 import sys
 import threading
 import time
 import traceback
-from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
 from string import Template
+from typing import Callable, Optional
 
 import dateutil.parser
 import yaml
@@ -13,201 +16,401 @@ import logging
 from bilibili_api import video
 
 from comment_task import CommentTask
-from recorder_config import RecorderConfig, UploaderAccount
+from encoder_probe import encoder_table, ENCODER_BENCHMARK_FILE, STARTUP_RESOLUTION
+from event_journal import EventJournal, JOURNAL_DIR
+from event_queue import EventQueue
+from recorder_config import RecoderRoom, RecorderConfig, UploaderAccount
 from recorder_manager import RecorderManager
+from review_status import REVIEW_POLL_SECONDS, ReviewStatus
 from session import Session, Video
+from session_checkpoint import CHECKPOINT_DIR, SessionCheckpoint
+from session_registry import SessionRegistry
 from subtitle_task import SubtitleTask
-from task_save import TaskSave
+from task_schedule import TaskSchedule, review_backoff
+from task_store import TaskStore
 from upload_task import UploadTask
 from webhook import Webhook
 
 
 VIDEO_UPLOAD_RETRY_TIMES = 5
+POST_RETRY_SECONDS = 60
 DANMAKU_VIDEO_WAIT_MINUTES = 6
 EARLY_VIDEO_WAIT_MINUTES = 1
 
 
+def thread_event_loop():
+    # the bilibili api wants an event loop in the thread it is called from
+    asyncio.set_event_loop(asyncio.new_event_loop())
+
+
 class RecordUploadManager:
-    def __init__(self, port, config_path, save_path):
+    def __init__(self, port, config_path, save_path, yaml_save_path: Optional[str] = None,
+                 checkpoint_dir: Optional[str] = CHECKPOINT_DIR, journal_dir: Optional[str] = JOURNAL_DIR):
         self.config_path = config_path
         self.save_path = save_path
-        with open(config_path, 'r') as file:
-            self.config = RecorderConfig(yaml.load(file, Loader=yaml.FullLoader))
-        if os.path.isfile(save_path):
-            with open(save_path, 'r') as file:
-                self.save = TaskSave.from_dict(yaml.load(file, Loader=yaml.FullLoader))
-        else:
-            logging.info("creating save file to %s", save_path)
-            self.save = TaskSave()
-            self.save_progress()
-        self.recorder_manager = RecorderManager(port, [room.id for room in self.config.rooms])
-        self.sessions: {str: Session} = dict()
+        self.checkpoint_dir = checkpoint_dir
+        self.journal = EventJournal(journal_dir) if journal_dir is not None else None
+        self.config = self.load_config(config_path)
+        self.save = TaskStore(save_path, yaml_save_path)
+        # kept with the save, not wherever the process was started from
+        encoder_table.path = os.path.join(os.path.dirname(os.path.abspath(save_path)), ENCODER_BENCHMARK_FILE)
+        self.recorder_manager = self.start_recorders(port)
+        self.sessions = SessionRegistry()
+        self.checkpoints: {str: SessionCheckpoint} = dict()
 
+        self.rooms: {int: RecoderRoom} = dict()
         self.webhooks: {int: Webhook} = dict()
         for room in self.config.rooms:
+            self.rooms[room.id] = room
             self.webhooks[room.id] = Webhook(room)
 
-        self.video_upload_queue: Queue[UploadTask] = Queue()
-        self.comment_post_queue: Queue[CommentTask] = Queue()
-        self.subtitle_post_queue: Queue[SubtitleTask] = Queue()
-        self.save_lock = threading.Lock()
-        self.video_upload_thread = threading.Thread(target=self.video_uploader)
-        self.comment_post_thread = threading.Thread(target=self.comment_poster)
-        self.subtitle_post_thread = threading.Thread(target=self.subtitle_poster)
-        self.video_processing_loop = asyncio.new_event_loop()
-        self.video_uploading_loop = asyncio.new_event_loop()
-        self.subtitle_posting_loop = asyncio.new_event_loop()
-        self.video_upload_thread.start()
-        self.comment_post_thread.start()
-        self.subtitle_post_thread.start()
-        self.video_uploading_thread = threading.Thread(target=lambda: self.video_processing_loop.run_forever())
-        self.video_uploading_thread.start()
-
-    def save_progress(self):
-        with open(self.save_path, 'w') as file:
-            yaml.dump(self.save.to_dict(), file, Dumper=yaml.Dumper)
-
-    def video_uploader(self):
-        asyncio.set_event_loop(self.video_uploading_loop)
+        # the blocking bilibili calls, uploads one at a time as before, comments and subtitles next to them
+        self.upload_executor = ThreadPoolExecutor(1, thread_name_prefix="upload", initializer=thread_event_loop)
+        self.post_executor = ThreadPoolExecutor(2, thread_name_prefix="post", initializer=thread_event_loop)
+        self.video_upload_queue: Optional[asyncio.Queue] = None
+        self.comment_schedule: Optional[TaskSchedule] = None
+        self.subtitle_schedule: Optional[TaskSchedule] = None
+        self.workers: Optional[asyncio.Future] = None
+        self.review = ReviewStatus()
+        self.loop = asyncio.new_event_loop()
+        self.events = EventQueue(self.process_event, self.loop)
+        self.ready = threading.Event()
+        self.runtime_thread = threading.Thread(target=self.run_runtime, name="runtime")
+        self.runtime_thread.start()
+        self.ready.wait()
+
+    def load_config(self, config_path) -> RecorderConfig:
+        with open(config_path, 'r') as file:
+            return RecorderConfig(yaml.load(file, Loader=yaml.FullLoader))
+
+    def start_recorders(self, port) -> Optional[RecorderManager]:
+        return RecorderManager(port, [room.id for room in self.config.rooms])
+
+    def upload(self, upload_task: UploadTask, uploaded: {str: str}) -> str:
+        return upload_task.upload(uploaded)
+
+    def video_cid(self, upload_task: UploadTask, bv_id: str) -> int:
+        v_info = video.get_video_info(bvid=bv_id, is_simple=False, is_member=True, verify=upload_task.verify)
+        return v_info['videos'][0]['cid']
+
+    def run_runtime(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.run())
+        self.loop.close()
+
+    async def run(self):
+        """
+        Everything of the manager runs on this one loop: the uploader and posters below, the recorder events, and the
+        processing of every session. It returns once shutdown cancels the workers, after cancelling the sessions being
+        processed.
+        """
+        self.video_upload_queue = asyncio.Queue()
+        self.comment_schedule = TaskSchedule()
+        self.subtitle_schedule = TaskSchedule()
+        for task_id in self.save.comment_tasks:
+            self.schedule_comment_task(task_id, time.time())
+        for task_id in self.save.subtitle_tasks:
+            self.schedule_subtitle_task(task_id, time.time())
+        if any(room.video_encoder is None for room in self.config.rooms):
+            # measure encoders while waiting for the first session, so its transcode does not have to
+            asyncio.ensure_future(encoder_table.probe(STARTUP_RESOLUTION))
+        self.resume_sessions()
+        self.workers = asyncio.gather(
+            self.video_uploader(), self.comment_poster(), self.subtitle_poster(), self.review_poller()
+        )
+        self.ready.set()
+        try:
+            await self.workers
+        except asyncio.CancelledError:
+            pass
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.upload_executor.shutdown(wait=False)
+        self.post_executor.shutdown(wait=False)
+        logging.info("manager stopped, %d sessions cancelled", len(tasks))
+
+    def shutdown(self, timeout: float = 30):
+        self.loop.call_soon_threadsafe(self.workers.cancel)
+        self.runtime_thread.join(timeout)
+
+    async def video_uploader(self):
+        loop = asyncio.get_event_loop()
         while True:
-            upload_task = self.video_upload_queue.get()
+            upload_task = await self.video_upload_queue.get()
             try:
                 first_video_comment = upload_task.session_id not in self.save.session_id_map
                 logging.info("uploading video...")
-                bv_id = upload_task.upload(self.save.session_id_map)
-                with self.save_lock:
-                    self.save.session_id_map[upload_task.session_id] = bv_id
-                    self.save_progress()
+                bv_id = await loop.run_in_executor(self.upload_executor, self.upload, upload_task,
+                                                   self.uploaded_videos(upload_task.session_id))
+                self.save.session_id_map[upload_task.session_id] = bv_id
+                self.upload_finished(upload_task)
                 if first_video_comment:
-                    self.comment_post_queue.put(
-                        CommentTask.from_upload_task(upload_task)
-                    )
-                v_info = video.get_video_info(bvid=bv_id, is_simple=False, is_member=True, verify=upload_task.verify)
-                cid = v_info['videos'][0]['cid']
-                self.subtitle_post_queue.put(
-                    SubtitleTask.from_upload_task(upload_task, bv_id, cid)
-                )
+                    self.add_comment_task(CommentTask.from_upload_task(upload_task))
+                else:
+                    # a comment task that was waiting for the video can try now
+                    self.wake_comment_tasks(lambda task: task.session_id == upload_task.session_id)
+                cid = await loop.run_in_executor(self.post_executor, self.video_cid, upload_task, bv_id)
+                subtitle_task = SubtitleTask.from_upload_task(upload_task, bv_id, cid)
+                try:
+                    await loop.run_in_executor(self.post_executor, subtitle_task.compile)
+                except Exception:
+                    # tried again when the subtitle is posted, the upload itself went fine
+                    logging.warn("cannot compile subtitle %s: %s", subtitle_task.subtitle_path, traceback.format_exc())
+                self.add_subtitle_task(subtitle_task)
             except Exception:
                 if upload_task.trial < VIDEO_UPLOAD_RETRY_TIMES:
                     upload_task.trial += 1
-                    self.video_upload_queue.put(upload_task)
+                    self.video_upload_queue.put_nowait(upload_task)
                     logging.warn("task %s uploading failed, retrying", upload_task.title)
                 else:
                     logging.error("task %s uploading failed too many times", upload_task.title)
+                    self.upload_finished(upload_task)
                 # print(traceback.format_exc())
 
-    def comment_poster(self):
-        asyncio.set_event_loop(self.video_uploading_loop)
+    def uploaded_videos(self, session_id: str) -> {str: str}:
+        """
+        The BV id of a session, if it was uploaded, for the executor threads, which do not use the save themselves.
+        """
+        bvid = self.save.session_id_map.get(session_id)
+        return {session_id: bvid} if bvid is not None else {}
+
+    def add_comment_task(self, task: CommentTask):
+        self.schedule_comment_task(self.save.add_comment_task(task), time.time())
+
+    def add_subtitle_task(self, task: SubtitleTask):
+        # only the subtitle of the latest upload of a video is worth posting
+        earlier_id = self.save.subtitle_task_ids.get(task.bvid)
+        if earlier_id is not None and self.save.subtitle_tasks[earlier_id].is_earlier_task_of(task):
+            self.save.remove_subtitle_task(earlier_id)
+            self.subtitle_schedule.remove(earlier_id)
+        self.schedule_subtitle_task(self.save.add_subtitle_task(task), time.time())
+
+    def schedule_comment_task(self, task_id: int, due: float):
+        task = self.save.comment_tasks[task_id]
+        if task.session_id not in self.save.session_id_map:
+            # nothing to comment on before the video is uploaded, which wakes the task
+            due = float("inf")
+        self.comment_schedule.schedule(task_id, min(due, task.expiry()))
+
+    def schedule_subtitle_task(self, task_id: int, due: float):
+        self.subtitle_schedule.schedule(task_id, min(due, self.save.subtitle_tasks[task_id].expiry()))
+
+    def wake_comment_tasks(self, condition: Callable[[CommentTask], bool]):
+        self.comment_schedule.wake(task_id for task_id, task in self.save.comment_tasks.items() if condition(task))
+
+    def wake_subtitle_tasks(self, condition: Callable[[SubtitleTask], bool]):
+        self.subtitle_schedule.wake(task_id for task_id, task in self.save.subtitle_tasks.items() if condition(task))
+
+    def approved(self, bvid: str):
+        """
+        A task found its video approved, the tasks waiting for the same video can try right away.
+        """
+        self.wake_comment_tasks(
+            lambda task: not task.approved and self.save.session_id_map.get(task.session_id) == bvid
+        )
+        self.wake_subtitle_tasks(lambda task: task.bvid == bvid and not task.approved)
+
+    @staticmethod
+    def retry_time(task) -> float:
+        if task.approved:
+            return time.time() + POST_RETRY_SECONDS
+        # still under review, looked at less and less often
+        task.review_trials += 1
+        return time.time() + review_backoff(task.review_trials - 1)
+
+    def under_review(self, task, bvid: Optional[str]) -> bool:
+        # the archive list says the video is not published yet, no need to look it up
+        return not task.approved and bvid is not None and self.review.published(bvid) is False
+
+    def known_published(self, task, bvid: Optional[str]) -> bool:
+        return task.approved or (bvid is not None and self.review.published(bvid) is True)
+
+    def pending_reviews(self) -> {(str, str): {str}}:
+        """
+        The videos tasks are waiting to be approved, by the cookies of the account they were uploaded with.
+        """
+        pending = collections.defaultdict(set)
+        for task in self.save.comment_tasks.values():
+            bvid = self.save.session_id_map.get(task.session_id)
+            if bvid is not None and not task.approved:
+                pending[(task.sessdata, task.csrf)].add(bvid)
+        for task in self.save.subtitle_tasks.values():
+            if not task.approved:
+                pending[(task.sessdata, task.csrf)].add(task.bvid)
+        return pending
+
+    async def review_poller(self):
+        loop = asyncio.get_event_loop()
         while True:
-            with self.save_lock:
-                while not self.comment_post_queue.empty():
-                    self.save.active_comment_tasks += [self.comment_post_queue.get()]
-                    self.save_progress()
-            try:
-                if len(self.save.active_comment_tasks) != 0:
-                    task_to_remove = []
-                    for idx, task in enumerate(self.save.active_comment_tasks):
-                        task: CommentTask
-                        logging.info("posting comment...")
-                        if task.post_comment(self.save.session_id_map):
-                            task_to_remove += [idx]
-                    if task_to_remove != 0:
-                        with self.save_lock:
-                            self.save.active_comment_tasks = [
-                                comment_task
-                                for idx, comment_task in enumerate(self.save.active_comment_tasks)
-                                if idx not in task_to_remove
-                            ]
-                            self.save_progress()
-            except Exception:
-                logging.error("comment post failed")
-                # print(traceback.format_exc())
-            finally:
-                time.sleep(60)
+            pending = self.pending_reviews()
+            self.review.forget(set().union(*pending.values()))
+            for (sessdata, csrf), bvids in pending.items():
+                for bvid in await loop.run_in_executor(self.post_executor, self.review.poll, sessdata, csrf, bvids):
+                    logging.info("video %s is published", bvid)
+                    self.approved(bvid)
+            await asyncio.sleep(REVIEW_POLL_SECONDS)
 
-    def subtitle_poster(self):
-        asyncio.set_event_loop(self.subtitle_posting_loop)
+    async def comment_poster(self):
+        loop = asyncio.get_event_loop()
         while True:
-            with self.save_lock:
-                while not self.subtitle_post_queue.empty():
-                    self.save.active_subtitle_tasks += [self.subtitle_post_queue.get()]
-                    self.save_progress()
-            try:
-                if len(self.save.active_subtitle_tasks) != 0:
-                    task_to_remove = []
-                    for idx, task in enumerate(self.save.active_subtitle_tasks):
-                        task: SubtitleTask
-                        logging.info("posting subtitle...")
-                        if task.post_subtitle():
-                            task_to_remove += [idx]
-                    if task_to_remove != 0:
-                        with self.save_lock:
-                            new_subtitle_tasks = []
-                            for idx, subtitle_task in enumerate(self.save.active_subtitle_tasks):
-                                subtitle_task: SubtitleTask
-                                append = True
-                                if idx in task_to_remove:
-                                    append = False
-                                else:
-                                    for j in task_to_remove:
-                                        removing_task = self.save.active_subtitle_tasks[j]
-                                        if subtitle_task.is_earlier_task_of(removing_task):
-                                            append = False
-                                            break
-                                if append:
-                                    new_subtitle_tasks += [subtitle_task]
-                            self.save.active_subtitle_tasks = new_subtitle_tasks
-                            self.save_progress()
-            except Exception:
-                logging.error("subtitle post failed")
-                # print(traceback.format_exc())
-            finally:
-                time.sleep(60)
+            await self.comment_schedule.wait()
+            for task_id in self.comment_schedule.pop_due():
+                task: CommentTask = self.save.comment_tasks[task_id]
+                bvid = self.save.session_id_map.get(task.session_id)
+                if self.under_review(task, bvid):
+                    if time.time() >= task.expiry():
+                        # a rejected video, or a review longer than the task waits for
+                        self.save.remove_comment_task(task_id)
+                        self.comment_schedule.remove(task_id)
+                    else:
+                        self.schedule_comment_task(task_id, self.retry_time(task))
+                    continue
+                try:
+                    logging.info("posting comment...")
+                    was_approved = task.approved
+                    if await loop.run_in_executor(self.post_executor, task.post_comment,
+                                                  self.uploaded_videos(task.session_id),
+                                                  self.known_published(task, bvid)):
+                        self.save.remove_comment_task(task_id)
+                    else:
+                        self.schedule_comment_task(task_id, self.retry_time(task))
+                        # keeps how far the comments got
+                        self.save.update_comment_task(task_id)
+                    if task.approved and not was_approved:
+                        self.approved(bvid)
+                except Exception:
+                    logging.error("comment post failed")
+                    self.schedule_comment_task(task_id, time.time() + POST_RETRY_SECONDS)
+                    # print(traceback.format_exc())
+
+    async def subtitle_poster(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await self.subtitle_schedule.wait()
+            for task_id in self.subtitle_schedule.pop_due():
+                task: SubtitleTask = self.save.subtitle_tasks.get(task_id)
+                if task is None:
+                    # replaced by a later subtitle of the same video
+                    continue
+                if self.under_review(task, task.bvid):
+                    if time.time() >= task.expiry():
+                        # a rejected video, or a review longer than the task waits for
+                        self.save.remove_subtitle_task(task_id)
+                        self.subtitle_schedule.remove(task_id)
+                    else:
+                        self.schedule_subtitle_task(task_id, self.retry_time(task))
+                    continue
+                try:
+                    logging.info("posting subtitle...")
+                    was_approved = task.approved
+                    posted = await loop.run_in_executor(self.post_executor, task.post_subtitle,
+                                                        self.known_published(task, task.bvid))
+                    if task.approved and not was_approved:
+                        self.approved(task.bvid)
+                    if task_id not in self.save.subtitle_tasks:
+                        # a later upload of the video replaced it while it was being posted
+                        continue
+                    if posted:
+                        self.save.remove_subtitle_task(task_id)
+                    else:
+                        self.schedule_subtitle_task(task_id, self.retry_time(task))
+                        self.save.update_subtitle_task(task_id)
+                except Exception:
+                    logging.error("subtitle post failed")
+                    self.schedule_subtitle_task(task_id, time.time() + POST_RETRY_SECONDS)
+                    # print(traceback.format_exc())
+
+    def queue_upload(self, session: Session, upload_task: UploadTask):
+        session.checkpoint.add_upload(session.room_config.uploader, upload_task.to_dict())
+        self.video_upload_queue.put_nowait(upload_task)
+
+    def upload_finished(self, upload_task: UploadTask):
+        checkpoint = self.checkpoints.get(upload_task.session_id)
+        if checkpoint is not None:
+            checkpoint.remove_upload(upload_task.danmaku)
+            self.release_checkpoint(checkpoint)
+
+    def release_checkpoint(self, checkpoint: SessionCheckpoint):
+        if checkpoint.closed and len(checkpoint.uploads) == 0:
+            self.checkpoints.pop(checkpoint.session_id, None)
+
+    @staticmethod
+    async def wait_after_end(session: Session, minutes: float):
+        # counted from the end of the session rather than from now, so a resumed session does not wait all over again
+        deadline = session.end_time + datetime.timedelta(minutes=minutes)
+        await asyncio.sleep(max(0.0, (deadline - datetime.datetime.now(datetime.timezone.utc)).total_seconds()))
+
+    @staticmethod
+    async def pause(minutes: float):
+        await asyncio.sleep(minutes * 60)
 
     async def session_end(self, session: Session):
-        await asyncio.sleep(EARLY_VIDEO_WAIT_MINUTES * 60)
+        try:
+            await self.process_session(session)
+        except Exception:
+            # the checkpoint is kept open, so the session is processed again after a restart
+            logging.error("session %d@%s failed: %s", session.room_id, session.session_id, traceback.format_exc())
+        self.sessions.evict(session)
+        self.release_checkpoint(session.checkpoint)
+        logging.info("session %d@%s evicted, %d sessions left", session.room_id, session.session_id,
+                     len(self.sessions))
+
+    async def process_session(self, session: Session):
+        await self.wait_after_end(session, EARLY_VIDEO_WAIT_MINUTES)
+        await session.collect_videos()
         if len(session.videos) == 0:
             logging.info("No video in session %d@%s", session.room_id, session.session_id)
+            session.checkpoint.close()
             return
         room_config = session.room_config
-        await asyncio.sleep(room_config.continue_session_minutes * 60)
-
-        self.webhooks[session.room_id].record_end(
-            session_id = session.session_id,
-            title = session.room_title,
-            name = session.room_name,
-            area_name = session.room_area_name,
-            time = session.end_time
-        )
+        await self.wait_after_end(session, EARLY_VIDEO_WAIT_MINUTES + room_config.continue_session_minutes)
+
+        if session.checkpoint.completed("record_end") is None:
+            self.webhooks[session.room_id].record_end(
+                session_id = session.session_id,
+                title = session.room_title,
+                name = session.room_name,
+                area_name = session.room_area_name,
+                time = session.end_time
+            )
+            session.checkpoint.stage_done("record_end")
 
         await self.upload_video(session)
+        session.checkpoint.close()
 
     async def upload_video(self, session: Session):
         webhook = self.webhooks[session.room_id]
+        checkpoint = session.checkpoint
         paths = session.output_path()
 
         await session.prepare()
-        width, height = session.resolution
-        webhook.prepared(
-            session_id=session.session_id,
-            width=width,
-            height=height,
-            duration=session.duration,
-            thumbnail=paths.get('thumbnail'),
-            danmaku=paths.get('xml')
-        )
+        if checkpoint.completed("prepared") is None:
+            width, height = session.resolution
+            webhook.prepared(
+                session_id=session.session_id,
+                width=width,
+                height=height,
+                duration=session.duration,
+                thumbnail=paths.get('thumbnail'),
+                danmaku=paths.get('xml')
+            )
+            checkpoint.stage_done("prepared")
 
         await session.gen_early_video()
-        webhook.video_generated(
-            session_id=session.session_id,
-            video_path=paths.get("early_video")
-        )
+        if checkpoint.completed("video_generated") is None:
+            webhook.video_generated(
+                session_id=session.session_id,
+                video_path=paths.get("early_video")
+            )
+            checkpoint.stage_done("video_generated")
 
         room_config = session.room_config
         uploader = None
         title = ""
         description = ""
-        early_upload_task = None
+        early_uploaded = checkpoint.completed("early_upload") is not None
 
         if room_config.uploader is not None:
             uploader = self.config.accounts[room_config.uploader]
@@ -229,19 +432,15 @@ class RecordUploadManager:
             title = Template(room_config.title).substitute(substitute_dict)
             temp_title = title
             i = 1
-            other_video_titles = [
-                name for session_id, name in self.save.video_name_history.items()
-                if session_id != session.session_id
-            ]
-            while temp_title in other_video_titles:
+            # sessions are only processed on the loop, so no other title is chosen in between
+            while self.save.title_taken(temp_title, session.session_id):
                 i += 1
                 temp_title = f"{temp_title}{i}"
             title = temp_title
-            with self.save_lock:
-                self.save.video_name_history[session.session_id] = title
+            self.save.set_video_name(session.session_id, title)
             description = Template(room_config.description).substitute(substitute_dict)
 
-            if session.prepared:
+            if session.prepared and not early_uploaded:
                 early_upload_task = UploadTask(
                     session_id=session.session_id,
                     video_path=paths.get("early_video"),
@@ -257,16 +456,21 @@ class RecordUploadManager:
                     danmaku=False,
                     account=uploader
                 )
-                self.video_upload_queue.put(early_upload_task)
+                self.queue_upload(session, early_upload_task)
+                checkpoint.stage_done("early_upload")
+                early_uploaded = True
 
-        await asyncio.sleep(DANMAKU_VIDEO_WAIT_MINUTES * 60)
+        if checkpoint.completed("danmaku_video") is None:
+            await self.pause(DANMAKU_VIDEO_WAIT_MINUTES)
         await session.gen_danmaku_video()
-        webhook.video_transcoded(
-            session_id = session.session_id,
-            video_path = paths.get("danmaku_video")
-        )
+        if checkpoint.completed("video_transcoded") is None:
+            webhook.video_transcoded(
+                session_id = session.session_id,
+                video_path = paths.get("danmaku_video")
+            )
+            checkpoint.stage_done("video_transcoded")
 
-        if room_config.uploader is not None:
+        if room_config.uploader is not None and checkpoint.completed("danmaku_upload") is None:
             danmaku_upload_task = UploadTask(
                 session_id=session.session_id,
                 video_path=paths.get("danmaku_video"),
@@ -282,55 +486,111 @@ class RecordUploadManager:
                 danmaku=True,
                 account=uploader
             )
-            self.video_upload_queue.put(
-                danmaku_upload_task
-            )
-            if early_upload_task is None:
-                self.comment_post_queue.put(
-                    CommentTask.from_upload_task(danmaku_upload_task)
-                )
+            self.queue_upload(session, danmaku_upload_task)
+            if not early_uploaded:
+                self.add_comment_task(CommentTask.from_upload_task(danmaku_upload_task))
+            checkpoint.stage_done("danmaku_upload")
+
+    def handle_update(self, update_json: dict) -> bool:
+        """
+        Journal and queue a validated recorder event, False if it was delivered before.
+        """
+        if self.journal is not None:
+            self.journal.append(update_json)
+        return self.events.put(update_json)
 
-    async def handle_update(self, update_json: dict):
+    def resume_sessions(self):
+        """
+        Rebuild the sessions of the last run from their checkpoints by replaying their events, and continue each one
+        from its first unfinished step. The recorders are restarted together with this process, so a session that
+        never received SessionEnded is over, and it is ended at its last event.
+        """
+        for checkpoint in SessionCheckpoint.load_all(self.checkpoint_dir):
+            self.checkpoints[checkpoint.session_id] = checkpoint
+            for upload in checkpoint.uploads:
+                if upload["account"] not in self.config.accounts:
+                    logging.warn("account %s of a queued upload is not configured anymore", upload["account"])
+                    continue
+                account = self.config.accounts[upload["account"]]
+                self.video_upload_queue.put_nowait(UploadTask.from_dict(upload["task"], account))
+            if checkpoint.closed:
+                continue
+            session = None
+            for update_json in checkpoint.events:
+                session = self.process_event(update_json, checkpoint) or session
+            if session is None:
+                logging.warn("checkpoint of session %s has no session to resume", checkpoint.session_id)
+                continue
+            logging.info("resuming session %d@%s from %d events", session.room_id, session.session_id,
+                         len(checkpoint.events))
+            if session.end_time is None:
+                session.end_time = dateutil.parser.isoparse(checkpoint.events[-1]["EventTimestamp"])
+                self.sessions.end(session)
+            session.upload_task = asyncio.ensure_future(self.session_end(session))
+
+    def process_event(self, update_json: dict, replay: Optional[SessionCheckpoint] = None) -> Optional[Session]:
+        """
+        Apply a recorder event and return the session it belongs to, on the loop. Events are added to the checkpoint of
+        their session, unless they are replayed from the checkpoint given as replay, for which no webhook is sent again.
+        """
         room_id = update_json["EventData"]["RoomId"]
         session_id = update_json["EventData"]["SessionId"]
         event_timestamp = dateutil.parser.isoparse(update_json["EventTimestamp"])
 
-        room_config = None
-        for room in self.config.rooms:
-            if room.id == room_id:
-                room_config = room
+        room_config = self.rooms.get(room_id)
         if room_config is None:
             logging.warn("Cannot find room config for %d!", room_id)
-            return
+            return None
 
         if update_json["EventType"] == "SessionStarted":
-            for session in self.sessions.values():
-                if session.room_id == room_id and session.end_time is not None and \
-                        (event_timestamp - session.end_time).total_seconds() / 60 < room_config.continue_session_minutes:
-                    self.sessions[session_id] = session
-                    if session.upload_task is not None:
-                        session.upload_task.cancel()
-                        session.upload_task = None
-                    return
-
-            session = Session(update_json, room_config)
-            self.sessions[session_id] = session
-            self.webhooks[room_id].record_start(
-                session_id = session_id,
-                title = session.room_title,
-                name = session.room_name,
-                area_name = session.room_area_name,
-                time = session.start_time
-            )
+            if replay is not None:
+                # a session only continues the one it was added to before
+                session = self.sessions.get(replay.session_id)
+            else:
+                session = self.sessions.continuable(room_id, event_timestamp, room_config.continue_session_minutes)
+            if session is not None:
+                self.sessions.continue_session(session_id, session)
+                if session.upload_task is not None:
+                    session.upload_task.cancel()
+                    session.upload_task = None
+                if replay is None:
+                    session.checkpoint.add_event(update_json)
+                    # the outputs made so far are missing the new segments
+                    session.checkpoint.clear_stages()
+                return session
+
+            checkpoint = replay if replay is not None else SessionCheckpoint(session_id, self.checkpoint_dir)
+            session = Session(update_json, room_config, checkpoint)
+            self.sessions.add(session)
+            if replay is None:
+                self.checkpoints[session_id] = checkpoint
+                checkpoint.add_event(update_json)
+                self.webhooks[room_id].record_start(
+                    session_id = session_id,
+                    title = session.room_title,
+                    name = session.room_name,
+                    area_name = session.room_area_name,
+                    time = session.start_time
+                )
+            return session
         else:
-            if session_id not in self.sessions:
-                logging.warn("session %d@%s does not exists", room_id, session_id)
-                return
-            current_session: Session = self.sessions[session_id]
+            current_session = self.sessions.get(session_id)
+            if current_session is None:
+                if self.sessions.summary(session_id) is not None:
+                    logging.warn("session %d@%s is already processed, %s ignored", room_id, session_id,
+                                 update_json["EventType"])
+                else:
+                    logging.warn("session %d@%s does not exists", room_id, session_id)
+                return None
+            if replay is None:
+                current_session.checkpoint.add_event(update_json)
             current_session.process_update(update_json)
             if update_json["EventType"] == "FileClosed":
                 new_video = Video(update_json)
-                await current_session.add_video(new_video)
+                current_session.add_video(new_video, asyncio.ensure_future(new_video.prepare()))
+                asyncio.ensure_future(current_session.collect_videos())
             elif update_json["EventType"] == "SessionEnded":
-                current_session.upload_task = \
-                    asyncio.run_coroutine_threadsafe(self.session_end(current_session), self.video_processing_loop)
+                self.sessions.end(current_session)
+                if replay is None:
+                    current_session.upload_task = asyncio.ensure_future(self.session_end(current_session))
+            return current_session
@@ -1,4 +1,5 @@
 import logging
+import os
 from typing import Optional
 from bilibili_api import Verify
 from bili_web_api import BiliBili
@@ -19,10 +20,17 @@ class UploaderAccount:
     line: str
     verify: Verify
 
-    def __init__(self, config_dict):
+    def __init__(self, config_dict, login: bool = True):
         for key, value in config_dict.items():
             self.__setattr__(key, value)
-        self.login()
+        if login:
+            self.login()
+        else:
+            # only the configuration is needed, e.g. to replay an event journal against a stub uploader
+            self.sessdata = getattr(self, "sessdata", "")
+            self.bili_jct = getattr(self, "bili_jct", "")
+            self.line = getattr(self, "line", "auto")
+            self.verify = Verify(sessdata=self.sessdata, csrf=self.bili_jct)
 
     def login(self):
         b = Bilibili()
@@ -56,6 +64,7 @@ class UploaderAccount:
 class RecoderRoom:
     id: int
     webhook: Optional[str]
+    webhook_batch: bool
     continue_session_minutes: Optional[int]
     uploader: Optional[str]
     tags: Optional[str]
@@ -65,19 +74,31 @@ class RecoderRoom:
     source: Optional[str]
     he_user_dict: Optional[str]
     he_regex_rules: Optional[str]
+    segmented_transcode: bool
+    transcode_workers: int
+    fast_progress_bar: bool
+    video_encoder: Optional[str]
+    video_encoder_preset: Optional[str]
 
     def __init__(self, config_dict):
+        self.webhook = None
+        self.webhook_batch = False
         self.uploader = None
         self.he_user_dict = None
         self.he_regex_rules = None
+        self.segmented_transcode = False
+        self.transcode_workers = max(1, (os.cpu_count() or 1) // 4)
+        self.fast_progress_bar = False
+        self.video_encoder = None
+        self.video_encoder_preset = None
         self.continue_session_minutes = DEFAULT_CONTINUE_SESSION_MINUTES
         for key, value in config_dict.items():
             self.__setattr__(key, value)
 
 
 class RecorderConfig:
-    def __init__(self, config_dict):
-        self.accounts = {name: UploaderAccount(account) for name, account in config_dict['accounts'].items()}
+    def __init__(self, config_dict, login: bool = True):
+        self.accounts = {name: UploaderAccount(account, login) for name, account in config_dict['accounts'].items()}
         self.rooms = [RecoderRoom(room) for room in config_dict['rooms']]
         for room in self.rooms:
             if room.uploader is not None:
@@ -0,0 +1,164 @@
+import argparse
+import asyncio
+import datetime
+import itertools
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import yaml
+
+from comment_task import CommentTask
+from event_journal import journal_files, read_journal
+from record_upload_manager import RecordUploadManager
+from recorder_config import RecorderConfig
+from session import Session
+from subtitle_task import SubtitleTask
+from upload_task import UploadTask
+
+REPLAY_POLL_SECONDS = 0.1
+REPLAY_REPORT_SECONDS = 10
+
+parser = argparse.ArgumentParser(description='Replay an event journal against stub uploads')
+parser.add_argument('journal', type=str, nargs='+',
+                    help='journal files, or a journal directory, whose files are replayed in the order they were '
+                         'written')
+parser.add_argument('--speed', type=float, default=0,
+                    help='how many times faster than real time the events are fed, 0 for as fast as they are handled')
+parser.add_argument('--config', type=str, default="./recorder_config.yaml", help='recorder config, accounts are not '
+                                                                                  'logged in and webhooks are not sent')
+parser.add_argument('--storage', type=str, default=".", help='directory the recordings of the journal are in')
+parser.add_argument('--work_dir', type=str, default=None,
+                    help='where the save file and checkpoints of the replay go, a temporary directory by default')
+
+
+class ReplayClock:
+    """
+    The time of the journal while it is replayed. At speed 0 it is the time of the last event fed, so a session waits
+    for exactly the events it would have waited for, however long handling them takes.
+    """
+
+    def __init__(self, speed: float):
+        self.speed = speed
+        self.journal_start = None
+        self.real_start = None
+        self.fed = float("-inf")
+        self.finished = False
+
+    def start(self, journal_time: float):
+        self.journal_start = journal_time
+        self.real_start = time.monotonic()
+
+    def now(self) -> float:
+        if self.finished:
+            return float("inf")
+        if self.speed == 0 or self.journal_start is None:
+            return self.fed
+        return self.journal_start + (time.monotonic() - self.real_start) * self.speed
+
+
+class ReplayManager(RecordUploadManager):
+    """
+    A manager without recorders, which uploads to a stub handing out made-up BV ids, and only logs the comments and
+    subtitles it would post.
+    """
+
+    def __init__(self, config_path, save_path, checkpoint_dir, clock: ReplayClock):
+        self.clock = clock
+        self.bv_ids = itertools.count(1)
+        self.uploaded: [str] = []
+        super().__init__(0, config_path, save_path, checkpoint_dir=checkpoint_dir, journal_dir=None)
+
+    def load_config(self, config_path) -> RecorderConfig:
+        with open(config_path, 'r') as file:
+            config = RecorderConfig(yaml.load(file, Loader=yaml.FullLoader), login=False)
+        for room in config.rooms:
+            room.webhook = None
+        return config
+
+    def start_recorders(self, port):
+        return None
+
+    def upload(self, upload_task: UploadTask, uploaded: {str: str}) -> str:
+        bv_id = uploaded.get(upload_task.session_id) or f"BVreplay{next(self.bv_ids):06d}"
+        logging.info("stub upload of %s to %s as %s", upload_task.video_path, bv_id, upload_task.title)
+        self.uploaded += [upload_task.video_path]
+        return bv_id
+
+    def video_cid(self, upload_task: UploadTask, bv_id: str) -> int:
+        return 0
+
+    def add_comment_task(self, task: CommentTask):
+        logging.info("stub comment on %s", task.session_id)
+
+    def add_subtitle_task(self, task: SubtitleTask):
+        logging.info("stub subtitle on %s", task.bvid)
+
+    async def wait_after_end(self, session: Session, minutes: float):
+        deadline = (session.end_time + datetime.timedelta(minutes=minutes)).timestamp()
+        while self.clock.now() < deadline:
+            await asyncio.sleep(REPLAY_POLL_SECONDS)
+
+    async def pause(self, minutes: float):
+        deadline = self.clock.now() + minutes * 60
+        while self.clock.now() < deadline:
+            await asyncio.sleep(REPLAY_POLL_SECONDS)
+
+    def events_handled(self) -> bool:
+        stats = self.events.to_dict()
+        return stats["processed"] + stats["duplicated"] == stats["received"]
+
+    def idle(self) -> bool:
+        return self.events_handled() and len(self.sessions.ended) == 0 and self.video_upload_queue.empty()
+
+
+def report(manager: ReplayManager):
+    while True:
+        time.sleep(REPLAY_REPORT_SECONDS)
+        logging.info("replay events %s, %d sessions, %d uploads", manager.events.to_dict(), len(manager.sessions),
+                     len(manager.uploaded))
+
+
+def replay(manager: ReplayManager, clock: ReplayClock, paths: [str]):
+    for journal_time, update_json in read_journal(paths):
+        if clock.journal_start is None:
+            clock.start(journal_time)
+        if clock.speed == 0:
+            clock.fed = journal_time
+        else:
+            time.sleep(max(0.0, (journal_time - clock.now()) / clock.speed))
+        manager.handle_update(update_json)
+        while clock.speed == 0 and not manager.events_handled():
+            time.sleep(REPLAY_POLL_SECONDS)
+    clock.finished = True
+    while not manager.idle():
+        time.sleep(REPLAY_POLL_SECONDS)
+
+
+def main():
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(levelname)s] %(message)s")
+    paths = []
+    for path in args.journal:
+        paths += journal_files(path) if os.path.isdir(path) else [path]
+    paths = [os.path.abspath(path) for path in paths]
+    config_path = os.path.abspath(args.config)
+    work_dir = os.path.abspath(args.work_dir or tempfile.mkdtemp(prefix="replay-"))
+    os.makedirs(work_dir, exist_ok=True)
+    os.chdir(args.storage)
+    logging.info("replaying %d journal files, writing to %s", len(paths), work_dir)
+
+    clock = ReplayClock(args.speed)
+    manager = ReplayManager(config_path, os.path.join(work_dir, "recorder_save.db"),
+                            os.path.join(work_dir, "session_checkpoints"), clock)
+    threading.Thread(target=report, args=(manager,), daemon=True).start()
+    replay(manager, clock, paths)
+    logging.info("replay finished: events %s, uploads %s, sessions still recording %s", manager.events.to_dict(),
+                 manager.uploaded, list(manager.sessions.active.keys()))
+    manager.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import logging
+import time
+from typing import Optional
+
+import requests
+
+ARCHIVE_LIST_URL = "https://member.bilibili.com/x/web/archives"
+ARCHIVE_PAGE_SIZE = 20
+ARCHIVE_MAX_PAGES = 5
+ARCHIVE_TIMEOUT = 10
+REVIEW_POLL_SECONDS = 60
+# a state older than this is not trusted anymore, the tasks look their video up themselves again
+REVIEW_STATE_SECONDS = 5 * REVIEW_POLL_SECONDS
+
+
+def fetch_archive_states(sessdata: str, csrf: str, bvids: {str}) -> {str: int}:
+    """
+    The review state of the videos of an account, from its archive list in the member centre. The list is newest
+    first and read page by page until every video asked for is found. A state of 0 or more is published, a negative
+    one is still under review, or rejected.
+    """
+    http = requests.Session()
+    http.headers.update({
+        "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 Chrome/63.0.3239.108",
+        "Referer": "https://member.bilibili.com/"
+    })
+    http.cookies.update({"SESSDATA": sessdata, "bili_jct": csrf})
+    states = {}
+    for page in range(1, ARCHIVE_MAX_PAGES + 1):
+        response = http.get(ARCHIVE_LIST_URL, params={
+            "status": "is_pubing,pubed,not_pubed", "pn": page, "ps": ARCHIVE_PAGE_SIZE
+        }, timeout=ARCHIVE_TIMEOUT)
+        response.raise_for_status()
+        result = response.json()
+        if result.get("code") != 0:
+            raise requests.RequestException(f"archive list failed: {result.get('code')} {result.get('message')}")
+        archives = (result.get("data") or {}).get("arc_audits") or []
+        for archive in archives:
+            states[archive["Archive"]["bvid"]] = archive["Archive"]["state"]
+        if bvids.issubset(states.keys()) or len(archives) < ARCHIVE_PAGE_SIZE:
+            break
+    return states
+
+
+class ReviewStatus:
+    """
+    Whether the videos that tasks are waiting for are published, polled once per cycle for each account rather than
+    once per task. Accounts are told apart by their cookies, which is what the tasks keep of them.
+    """
+
+    def __init__(self):
+        self.states: {str: (int, float)} = dict()  # by bvid, with the time it was fetched
+
+    def published(self, bvid: str) -> Optional[bool]:
+        """
+        None if the state of the video is not known, or too old.
+        """
+        state = self.states.get(bvid)
+        if state is None or time.time() - state[1] > REVIEW_STATE_SECONDS:
+            return None
+        return state[0] >= 0
+
+    def poll(self, sessdata: str, csrf: str, bvids: {str}) -> [str]:
+        """
+        Fetch the states of the videos of one account, and return the ones found published since the last poll.
+        """
+        try:
+            states = fetch_archive_states(sessdata, csrf, bvids)
+        except (requests.RequestException, ValueError, KeyError) as err:
+            logging.warn("cannot fetch the archive list: %s", err)
+            return []
+        now = time.time()
+        newly_published = []
+        for bvid in bvids:
+            if bvid not in states:
+                continue
+            if states[bvid] >= 0 and self.published(bvid) is not True:
+                newly_published += [bvid]
+            self.states[bvid] = (states[bvid], now)
+        return newly_published
+
+    def forget(self, bvids: {str}):
+        for bvid in list(self.states.keys()):
+            if bvid not in bvids:
+                del self.states[bvid]
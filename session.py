@@ -1,30 +1,80 @@
 import asyncio
 import datetime
+import math
 import os
-import sys
+import time
 import traceback
 import logging
 from asyncio import Task
 from typing import Optional
 
 import dateutil.parser
-from gpuinfo import GPUInfo
+from PIL import Image, ImageOps
 
+from artifact_cache import artifact_key, artifact_path, prune_artifacts
 from commons import BINARY_PATH
+from danmaku_pipeline import SegmentDanmaku, merge_ass, merge_segments, merge_density, peak_time
+from encoder_probe import encoder_table
+from energy_map import GRAPH_WIDTH, EnergyMap, write_density_graph, write_super_chats
+from job_scheduler import JobClass, job_scheduler, REMUX, THUMBNAIL, DANMAKU, TRANSCODE
+from media_probe import MediaInfo, probe_media
+from process_runner import Progress, ProcessResult, run_process
 from recorder_config import RecoderRoom
+from session_checkpoint import SessionCheckpoint
+from stage_graph import Stage, StageGraph
 
+CHUNK_RETRY_TIMES = 3
+MIN_CHUNK_SECONDS = 60
+MAX_PROGRESS_BAR_FPS = 10
+THUMBNAIL_TIMEOUT = 10 * 60
+DANMAKU_TIMEOUT = 2 * 60 * 60
+# an ffmpeg that reports no progress for this long is considered hung
+FFMPEG_STALL_TIMEOUT = 10 * 60
+PROGRESS_LOG_SECONDS = 60
+# session attributes a finished stage sets, restored from the checkpoint when the stage is skipped after a restart
+STAGE_STATE = {
+    "process_xml": ["he_time"],
+    "early_video": ["early_video_generated"],
+}
 
-async def async_wait_output(command):
-    logging.debug("running: %s", command)
-    process = await asyncio.create_subprocess_shell(
-        command,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE
-    )
-    return_value = await process.communicate()
-    sys.stdout.flush()
-    sys.stderr.flush()
-    return return_value
+
+async def run_stage_process(argv: [str], log_path: str, job_class: JobClass, name: str,
+                            timeout: Optional[float] = None, total_time: Optional[float] = None) -> ProcessResult:
+    """
+    Run the external process of a stage. With total_time it is an ffmpeg command and its progress and ETA are
+    logged while it runs.
+    """
+    on_progress = None
+    last_log = time.monotonic()
+    if total_time is not None:
+        def on_progress(progress: Progress):
+            nonlocal last_log
+            if time.monotonic() - last_log < PROGRESS_LOG_SECONDS or progress.finished:
+                return
+            last_log = time.monotonic()
+            eta = progress.eta(total_time)
+            logging.info("%s: %.1f%% at %sx, eta %s", name, progress.out_time / total_time * 100,
+                         progress.speed, "unknown" if eta is None else datetime.timedelta(seconds=int(eta)))
+    result = await run_process(argv, log_path, timeout, on_progress,
+                               FFMPEG_STALL_TIMEOUT if on_progress is not None else None, job_class, name)
+    if result.succeeded:
+        logging.info("%s: %s", name, result.describe())
+    else:
+        logging.warn("%s failed: %s\n%s", name, result.describe(), "\n".join(result.stderr_tail))
+    return result
+
+
+def danmaku_factory_argv(xml_path: str, ass_path: str, resolution: (int, int)) -> [str]:
+    video_res_x, video_res_y = resolution
+    font_size = max(video_res_x, video_res_y) * 55 // 1920
+    return [f"{BINARY_PATH}DanmakuFactory/DanmakuFactory",
+            "-x", str(video_res_x),
+            "-y", str(video_res_y),
+            "--ignore-warnings",
+            "-o", ass_path,
+            "-i", xml_path,
+            "--fontname", "Noto Sans CJK SC", "-S", str(font_size), "-O", "255", "-L", "1", "-D", "1",
+            "--showusernames", "true", "--showmsgbox", "false"]
 
 
 class Video:
@@ -36,6 +86,9 @@ class Video:
     video_resolution_x: int
     video_resolution_y: int
     video_length_flv: float
+    meta: MediaInfo
+    danmaku: Optional[SegmentDanmaku]
+    ass_path: Optional[str]
 
     def __init__(self, file_closed_event_json):
         flv_name = file_closed_event_json['EventData']['RelativePath']
@@ -43,6 +96,8 @@ class Video:
         self.session_id = file_closed_event_json["EventData"]["SessionId"]
         self.room_id = file_closed_event_json["EventData"]["RoomId"]
         self.video_length = file_closed_event_json["EventData"]["Duration"]
+        self.danmaku = None
+        self.ass_path = None
 
     def flv_file_path(self):
         return self.base_path + ".flv"
@@ -50,24 +105,55 @@ class Video:
     def xml_file_path(self):
         return self.base_path + ".xml"
 
+    def clean_xml_file_path(self):
+        return self.base_path + ".clean.xml"
+
     async def gen_thumbnail(self, he_time, png_file_path, video_log_path):
-        ffmpeg_command_img = f"ffmpeg -y -ss {he_time} -i \"{self.flv_file_path()}\" -vframes 1 \"{png_file_path}\"" \
-                             f" >> \"{video_log_path}\" 2>&1"
-        await async_wait_output(ffmpeg_command_img)
+        await run_stage_process(
+            ["ffmpeg", "-y", "-ss", str(he_time), "-i", self.flv_file_path(), "-vframes", "1", png_file_path],
+            video_log_path, THUMBNAIL, f"thumbnail {self.base_path}", THUMBNAIL_TIMEOUT
+        )
 
     async def query_meta(self):
-        video_length_str = await async_wait_output(
-            f'ffprobe -v error -show_entries format=duration '
-            f'-of default=noprint_wrappers=1:nokey=1 "{self.flv_file_path()}"'
-        )
-        video_resolution_str = await async_wait_output(
-            f'ffprobe -v error -select_streams v:0 -show_entries stream=width,height '
-            f'-of csv=s=x:p=0 "{self.flv_file_path()}"'
+        self.meta = await probe_media(self.flv_file_path())
+        self.video_length_flv = self.meta.duration
+        self.video_resolution = self.meta.resolution
+        self.video_resolution_x, self.video_resolution_y = self.meta.width, self.meta.height
+
+    async def gen_ass(self):
+        """
+        Render the danmaku of this segment as subtitles while the stream is still recorded, so the session only has
+        to join them. The file is named after its input and parameters, and is kept until they change.
+        """
+        if self.danmaku is None:
+            return
+        resolution = self.video_resolution_x, self.video_resolution_y
+        key = artifact_key("ass", [self.danmaku.clean_xml_path], danmaku_factory_argv("", "", resolution))
+        if key is None:
+            return
+        ass_path = artifact_path(self.base_path, key, ".ass")
+        prune_artifacts(self.base_path, ".ass", {key})
+        if not os.path.exists(ass_path):
+            part_path = artifact_path(self.base_path, key, ".part.ass")
+            result = await run_stage_process(
+                danmaku_factory_argv(self.danmaku.clean_xml_path, part_path, resolution),
+                self.base_path + ".extras.log", DANMAKU, f"ass {self.base_path}", DANMAKU_TIMEOUT
+            )
+            if not result.succeeded or not os.path.exists(part_path):
+                return
+            os.replace(part_path, ass_path)
+        self.ass_path = ass_path
+
+    async def prepare(self):
+        await self.query_meta()
+        if self.video_resolution_x == 0 or self.video_resolution_y == 0:
+            raise ValueError("resolution invalid")
+        self.danmaku = await asyncio.get_event_loop().run_in_executor(
+            None, SegmentDanmaku.load, self.xml_file_path(), self.clean_xml_file_path()
         )
-        self.video_length_flv = float(video_length_str[0].decode('utf-8').strip())
-        self.video_resolution = str(video_resolution_str[0].decode('utf-8').strip())
-        video_resolutions = self.video_resolution.split("x")
-        self.video_resolution_x, self.video_resolution_y = int(video_resolutions[0]), int(video_resolutions[1])
+        await self.gen_ass()
+        logging.info("segment %s prepared: %.1fs, %s, %d danmaku", self.flv_file_path(), self.video_length_flv,
+                     self.video_resolution, self.danmaku.danmaku_count if self.danmaku is not None else 0)
 
 
 class Session:
@@ -84,8 +170,10 @@ class Session:
     room_area_name: (str, str)
     room_config: RecoderRoom
     prepared: bool
+    energy_map: EnergyMap
+    checkpoint: SessionCheckpoint
 
-    def __init__(self, session_start_event_json, room_config=None):
+    def __init__(self, session_start_event_json, room_config=None, checkpoint: Optional[SessionCheckpoint] = None):
         if room_config is None:
             self.room_config = RecoderRoom({})
         else:
@@ -104,6 +192,12 @@ class Session:
         self.he_time = None
         self.upload_task: Optional[Task] = None
         self.prepared = False
+        self.early_video_generated = False
+        self.pending_videos: [(Video, asyncio.Future)] = []
+        self.collect_lock: Optional[asyncio.Lock] = None
+        self.energy_map = EnergyMap(self.room_config.he_user_dict, self.room_config.he_regex_rules)
+        self.energy_map_failed = False
+        self.checkpoint = checkpoint if checkpoint is not None else SessionCheckpoint(self.session_id, None)
 
     def process_update(self, update_json):
         event_data = update_json["EventData"]
@@ -113,22 +207,62 @@ class Session:
         if update_json["EventType"] == "SessionEnded":
             self.end_time = dateutil.parser.isoparse(update_json["EventTimestamp"])
 
-    async def add_video(self, video):
-        try:
-            await video.query_meta()
-            if video.video_resolution_x == 0 or video.video_resolution_y == 0:
-                raise ValueError("resolution invalid")
-            w, h = self.resolution
-            if w != 0 and h != 0:
-                if w != video.video_resolution_x or h != video.video_resolution_y:
-                    raise ValueError("unmatched resolution")
-            self.duration += video.video_length_flv
-            self.resolution = video.video_resolution_x, video.video_resolution_y
-        except ValueError as err:
-            # print(traceback.format_exc())
-            logging.warn("video %s corrupted: %s", video.flv_file_path(), err)
+    def add_video(self, video: Video, prepare_job: asyncio.Future):
+        """
+        Register a closed segment whose Video.prepare is already running in the background. Segments are collected
+        in the order they were closed.
+        """
+        self.pending_videos += [(video, prepare_job)]
+
+    async def collect_videos(self):
+        """
+        Take over the segments whose preparation finished, in the order they were closed, and add their danmaku to
+        the energy map. It runs whenever a segment is closed, so the energy map is up to date when the session ends.
+        """
+        if self.collect_lock is None:
+            self.collect_lock = asyncio.Lock()
+        async with self.collect_lock:
+            while len(self.pending_videos) != 0:
+                video, prepare_job = self.pending_videos.pop(0)
+                try:
+                    await prepare_job
+                    w, h = self.resolution
+                    if w != 0 and h != 0:
+                        if w != video.video_resolution_x or h != video.video_resolution_y:
+                            raise ValueError("unmatched resolution")
+                    offset = self.duration
+                    self.duration += video.video_length_flv
+                    self.resolution = video.video_resolution_x, video.video_resolution_y
+                except ValueError as err:
+                    # print(traceback.format_exc())
+                    logging.warn("video %s corrupted: %s", video.flv_file_path(), err)
+                    continue
+                except Exception:
+                    # nothing awaits this coroutine, an error not caught here would drop the segment silently
+                    logging.error("video %s cannot be prepared: %s", video.flv_file_path(), traceback.format_exc())
+                    continue
+                self.videos += [video]
+                await self.update_energy_map(video, offset)
+
+    async def update_energy_map(self, video: Video, offset: float):
+        if self.energy_map_failed:
             return
-        self.videos += [video]
+        danmaku = video.danmaku
+        async with job_scheduler.job(DANMAKU, f"energy map {video.base_path}"):
+            try:
+                await asyncio.get_event_loop().run_in_executor(
+                    None, self.energy_map.add_segment,
+                    danmaku.comments if danmaku is not None else [],
+                    danmaku.super_chats if danmaku is not None else [],
+                    danmaku.last_time if danmaku is not None else None,
+                    offset, video.video_length_flv
+                )
+            except Exception as err:
+                logging.error("energy map of session %s failed at %s: %s", self.session_id, video.flv_file_path(), err)
+                logging.debug(traceback.format_exc())
+                self.energy_map_failed = True
+        if danmaku is not None:
+            danmaku.comments = []  # the energy map keeps what it still needs
 
     def output_base_path(self):
         return self.videos[0].base_path + ".all"
@@ -143,56 +277,69 @@ class Session:
             "concat_file": self.output_base_path() + ".concat.txt",
             "thumbnail": self.output_base_path() + ".thumb.png",
             "he_graph": self.output_base_path() + ".he.png",
+            "he_color": self.output_base_path() + ".he_color.png",
+            "he_gray": self.output_base_path() + ".he_gray.png",
             "he_file": self.output_base_path() + ".he.txt",
             "he_range": self.output_base_path() + ".he_range.txt",
             "sc_file": self.output_base_path() + ".sc.txt",
             "sc_srt": self.output_base_path() + ".sc.srt",
-            "he_pos": self.output_base_path() + ".he_pos.txt",
             "extras_log": self.output_base_path() + ".extras.log",
             "video_log": self.output_base_path() + ".video.log",
         }
 
     async def merge_xml(self):
-        xmls = ' '.join(['"' + video.xml_file_path() + '"' for video in self.videos])
-        danmaku_merge_command = \
-            f"python3 -m danmaku_tools.merge_danmaku " \
-            f"{xmls} " \
-            f"--video_time \".flv\" " \
-            f"--output \"{self.output_path()['xml']}\" " \
-            f">> \"{self.output_path()['extras_log']}\" 2>&1"
-        await async_wait_output(danmaku_merge_command)
+        await asyncio.get_event_loop().run_in_executor(
+            None, merge_segments,
+            [video.xml_file_path() if video.danmaku is not None else None for video in self.videos],
+            self.segment_offsets(), self.output_path()['xml']
+        )
 
     async def clean_xml(self):
-        danmaku_clean_command = \
-            f"python3 -m danmaku_tools.clean_danmaku " \
-            f"{self.output_path()['xml']} " \
-            f"--output \"{self.output_path()['clean_xml']}\" " \
-            f">> \"{self.output_path()['extras_log']}\" 2>&1"
-        await async_wait_output(danmaku_clean_command)
+        await asyncio.get_event_loop().run_in_executor(
+            None, merge_segments,
+            [video.danmaku.clean_xml_path if video.danmaku is not None else None for video in self.videos],
+            self.segment_offsets(), self.output_path()['clean_xml']
+        )
+
+    def segment_offsets(self) -> [float]:
+        offsets = []
+        offset = 0.0
+        for video in self.videos:
+            offsets += [offset]
+            offset += video.video_length_flv
+        return offsets
+
+    def merged_density(self) -> [float]:
+        return merge_density(
+            [video.danmaku.density if video.danmaku is not None else [] for video in self.videos],
+            [video.video_length_flv for video in self.videos]
+        )
 
     async def process_xml(self):
-        danmaku_extras_command = \
-            f"python3 -m danmaku_tools.danmaku_energy_map " \
-            f"--graph \"{self.output_path()['he_graph']}\" " \
-            f"--he_map \"{self.output_path()['he_file']}\" " \
-            f"--sc_list \"{self.output_path()['sc_file']}\" " \
-            f"--he_time \"{self.output_path()['he_pos']}\" " \
-            f"--sc_srt \"{self.output_path()['sc_srt']}\" " \
-            f"--he_range \"{self.output_path()['he_range']}\" " + \
-            (
-                f"--user_dict \"{self.room_config.he_user_dict}\" "
-                if self.room_config.he_user_dict is not None else ""
-            ) + \
-            (
-                f"--regex_rules \"{self.room_config.he_regex_rules}\" "
-                if self.room_config.he_regex_rules is not None else ""
-            ) + \
-            f"\"{self.output_path()['clean_xml']}\" " \
-            f">> \"{self.output_path()['extras_log']}\" 2>&1"
-        await async_wait_output(danmaku_extras_command)
-        with open(self.output_path()['he_pos'], 'r') as file:
-            he_time_str = file.readline()
-            self.he_time = float(he_time_str)
+        await asyncio.get_event_loop().run_in_executor(None, self.write_energy_map)
+
+    def write_energy_map(self):
+        start = time.monotonic()
+        # drawn at the video width, so the progress bar does not have to be scaled up from a small graph
+        video_res_x, _ = self.resolution
+        graph_width = video_res_x if video_res_x > 0 else GRAPH_WIDTH
+        try:
+            write_super_chats(self.output_path(), self.energy_map.super_chats)
+            if self.energy_map_failed:
+                raise ValueError("danmaku of a segment could not be added")
+            self.energy_map.write(self.output_path(), graph_width)
+            self.he_time = float(self.energy_map.he_time())
+        except Exception as err:
+            logging.error("energy map of session %s failed, using danmaku density instead: %s", self.session_id, err)
+            logging.debug(traceback.format_exc())
+            density = self.merged_density()
+            self.he_time = peak_time(density)
+            # the danmaku video still needs a graph for its progress bar
+            write_density_graph(self.output_path()['he_graph'], density, self.energy_map.super_chats, graph_width)
+            return
+        logging.info("energy map of session %s: %d danmaku, %d high energy ranges, finished in %.1fs",
+                     self.session_id, self.energy_map.comment_count, len(self.energy_map.he_range),
+                     time.monotonic() - start)
 
     def generate_concat(self):
         concat_text = "\n".join([f"file '{video.flv_file_path()}'" for video in self.videos])
@@ -219,16 +366,20 @@ class Session:
     async def process_danmaku(self):
         video_res_x, video_res_y = self.resolution
         font_size = max(video_res_x, video_res_y) * 55 // 1920
-        danmaku_conversion_command = \
-            f"{BINARY_PATH}DanmakuFactory/DanmakuFactory " \
-            f"-x {video_res_x} " \
-            f"-y {video_res_y} " \
-            f"--ignore-warnings " \
-            f"-o \"{self.output_path()['ass']}\" " \
-            f"-i \"{self.output_path()['clean_xml']}\" " \
-            f"--fontname \"Noto Sans CJK SC\" -S {font_size} -O 255 -L 1 -D 1 --showusernames true --showmsgbox false" \
-            f">> \"{self.output_path()['extras_log']}\" 2>&1"
-        await async_wait_output(danmaku_conversion_command)
+        segments = [
+            (video.ass_path, offset) for video, offset in zip(self.videos, self.segment_offsets())
+            if video.danmaku is not None
+        ]
+        if len(segments) != 0 and all(ass_path is not None for ass_path, _ in segments):
+            await asyncio.get_event_loop().run_in_executor(
+                None, merge_ass, [ass_path for ass_path, _ in segments], [offset for _, offset in segments],
+                self.output_path()['ass']
+            )
+        else:
+            await run_stage_process(
+                danmaku_factory_argv(self.output_path()['clean_xml'], self.output_path()['ass'], self.resolution),
+                self.output_path()['extras_log'], DANMAKU, f"ass {self.session_id}", DANMAKU_TIMEOUT
+            )
 
         if not os.path.exists(self.output_path()['ass']):
             ass = \
@@ -255,71 +406,293 @@ class Session:
                 f.write(ass)
 
     async def process_early_video(self):
-        ffmpeg_command = f'''ffmpeg -y \
-        -f concat \
-        -safe 0 \
-        -i "{self.output_path()['concat_file']}" \
-        -c copy "{self.output_path()['early_video']}" >> "{self.output_path()["video_log"]}" 2>&1'''
-        await async_wait_output(ffmpeg_command)
-
-    async def process_video(self):
+        self.early_video_generated = False
+        result = await run_stage_process(
+            ["ffmpeg", "-y", "-f", "concat", "-safe", "0", "-i", self.output_path()['concat_file'],
+             "-c", "copy", self.output_path()['early_video']],
+            self.output_path()["video_log"], REMUX, f"early video {self.session_id}", total_time=self.duration
+        )
+        # a failed remux is tried once more when the early video is uploaded
+        self.early_video_generated = result.succeeded
+
+    def video_bitrate(self) -> int:
         total_time = self.duration
         max_size = 8000_000 * 8  # Kb
         audio_bitrate = 320
         video_bitrate = (max_size / total_time - audio_bitrate) - 500  # just to be safe
         max_video_bitrate = float(8000)  # BiliBili now re-encode every video anyways
-        video_bitrate = int(min(max_video_bitrate, video_bitrate))
+        return int(min(max_video_bitrate, video_bitrate))
+
+    async def video_encoder(self) -> [str]:
+        encoder, preset = await encoder_table.select(
+            self.resolution, self.room_config.video_encoder, self.room_config.video_encoder_preset
+        )
+        logging.info("session %s encodes with %s -preset %s", self.session_id, encoder, preset)
+        return ["-c:v", encoder, "-preset", preset]
+
+    def progress_bar_fps(self) -> int:
+        # the bar only has to move once per pixel, so the fast path composites it at a fraction of the video rate
+        video_res_x, _ = self.resolution
+        return max(1, min(MAX_PROGRESS_BAR_FPS, math.ceil(video_res_x / self.duration)))
+
+    def render_progress_bar(self):
+        """
+        Pre-render the coloured and the grey progress bar strips at the video width, which the classic filter graph
+        recomputes from he_graph on every frame.
+        """
+        video_res_x, _ = self.resolution
+        with Image.open(self.output_path()['he_graph']) as he_graph:
+            he_graph = he_graph.convert('RGBA')
+            bar_height = max(1, round(video_res_x * he_graph.height / he_graph.width))
+            color_bar = he_graph.resize((video_res_x, bar_height), Image.LANCZOS)
+        gray_bar = ImageOps.grayscale(color_bar).convert('RGBA')
+        gray_bar.putalpha(color_bar.getchannel('A'))
+        color_bar.save(self.output_path()['he_color'])
+        gray_bar.save(self.output_path()['he_gray'])
+
+    def danmaku_inputs(self, start: float = 0.0, length: Optional[float] = None) -> [str]:
+        length = self.duration if length is None else length
+        video_input = (["-ss", str(start)] if start != 0 else []) + \
+            ["-f", "concat", "-safe", "0", "-i", self.output_path()["concat_file"]]
+        if self.room_config.fast_progress_bar:
+            fps = str(self.progress_bar_fps())
+            return ["-loop", "1", "-framerate", fps, "-t", str(length), "-i", self.output_path()["he_color"]] + \
+                video_input + \
+                ["-loop", "1", "-framerate", fps, "-t", str(length), "-i", self.output_path()["he_gray"]]
+        return ["-loop", "1", "-t", str(length), "-i", self.output_path()["he_graph"]] + video_input
+
+    def danmaku_filter(self, start: float = 0.0, length: Optional[float] = None) -> str:
+        # start and length select a part of the timeline, so the progress bar and the subtitles stay in sync when
+        # the video is encoded in chunks
+        total_time = self.duration
+        length = total_time if length is None else length
+        t = "t" if start == 0 else f"(t+{start})"
         video_res_x, video_res_y = self.resolution
-        ffmpeg_command = f'''ffmpeg -y -loop 1 -t {total_time} \
-        -i "{self.output_path()['he_graph']}" \
-        -f concat \
-        -safe 0 \
-        -i "{self.output_path()['concat_file']}" \
-        -t {total_time} \
-        -filter_complex "
+        if self.room_config.fast_progress_bar:
+            # the mask is white right of the playhead, where the coloured strip is shown; only the small bar region
+            # is composited, at progress_bar_fps, and overlay keeps the last bar frame for the frames in between.
+            # maskedmerge works per plane, so everything is kept in planar RGB for the mask to apply to all of them
+            fps = self.progress_bar_fps()
+            with Image.open(self.output_path()['he_color']) as color_bar:
+                bar_w, bar_h = color_bar.size
+            bar_filter = f"""
+        [1:v]scale={video_res_x}:{video_res_y}:force_original_aspect_ratio=decrease,pad={video_res_x}:{video_res_y}:-1:-1:color=black[v_fixed];
+        color=black:s={bar_w}x{bar_h}:r={fps}:d={length},format=gbrap[mask_bg];
+        color=white:s={bar_w}x{bar_h}:r={fps}:d={length},format=gbrap[mask_fg];
+        [mask_bg][mask_fg]overlay=x={t}/{total_time}*W:format=rgb,format=gbrap[mask];
+        [0:v]format=gbrap[color];
+        [2:v]format=gbrap[gray];
+        [gray][color][mask]maskedmerge[bar];
+        [v_fixed][bar]overlay=y=main_h-overlay_h:eof_action=repeat[out];
+        """
+        else:
+            bar_filter = f"""
         [1:v]scale={video_res_x}:{video_res_y}:force_original_aspect_ratio=decrease,pad={video_res_x}:{video_res_y}:-1:-1:color=black[v_fixed];
         [0:v][v_fixed]scale2ref=iw:iw*(main_h/main_w)[color][ref];
         [color]split[color1][color2];
         [color1]hue=s=0[gray];
         [color2]negate=negate_alpha=1[color_neg];
         [gray]negate=negate_alpha=1[gray_neg];
-        color=black:d={total_time}[black];
+        color=black:d={length}[black];
         [black][ref]scale2ref[blackref][ref2];
         [blackref]split[blackref1][blackref2];
-        [color_neg][blackref1]overlay=x=t/{total_time}*W-W[color_crop_neg];
-        [gray_neg][blackref2]overlay=x=t/{total_time}*W[gray_crop_neg];
+        [color_neg][blackref1]overlay=x={t}/{total_time}*W-W[color_crop_neg];
+        [gray_neg][blackref2]overlay=x={t}/{total_time}*W[gray_crop_neg];
         [color_crop_neg]negate=negate_alpha=1[color_crop];
         [gray_crop_neg]negate=negate_alpha=1[gray_crop];
         [ref2][color_crop]overlay=y=main_h-overlay_h[out_color];
         [out_color][gray_crop]overlay=y=main_h-overlay_h[out];
-        [out]ass='{self.output_path()['ass']}'[out_sub]" \
-        -map "[out_sub]" -map 1:a ''' + \
-                         (" -c:v h264_nvenc -preset slow "
-                          if GPUInfo.check_empty() is not None else " -c:v libx264 -preset medium ") + \
-                         f'-b:v {video_bitrate}K' + f''' -b:a 320K -ar 44100  "{self.output_path()['danmaku_video']}" \
-                    ''' + f'>> "{self.output_path()["video_log"]}" 2>&1'
-        await async_wait_output(ffmpeg_command)
+        """
+        return bar_filter + (
+            f"[out]ass='{self.output_path()['ass']}'[out_sub]" if start == 0 else
+            f"[out]setpts=PTS+{start}/TB,ass='{self.output_path()['ass']}',setpts=PTS-{start}/TB[out_sub]"
+        )
+
+    async def process_video(self) -> bool:
+        if self.room_config.fast_progress_bar:
+            await asyncio.get_event_loop().run_in_executor(None, self.render_progress_bar)
+        if self.room_config.segmented_transcode:
+            return await self.process_video_segmented()
+        total_time = self.duration
+        result = await run_stage_process(
+            ["ffmpeg", "-y"] + self.danmaku_inputs() +
+            ["-t", str(total_time), "-filter_complex", self.danmaku_filter(), "-map", "[out_sub]", "-map", "1:a"] +
+            await self.video_encoder() +
+            ["-b:v", f"{self.video_bitrate()}K", "-b:a", "320K", "-ar", "44100", self.output_path()['danmaku_video']],
+            self.output_path()["video_log"], TRANSCODE, f"danmaku video {self.session_id}", total_time=total_time
+        )
+        return result.succeeded
+
+    def keyframe_times(self) -> [float]:
+        keyframes = []
+        for video, offset in zip(self.videos, self.segment_offsets()):
+            keyframes += [offset + keyframe for keyframe in video.meta.keyframes]
+        return keyframes
+
+    def transcode_chunks(self, chunk_count: int) -> [(float, float)]:
+        """
+        Split the session timeline into about chunk_count parts, cutting at keyframes so every chunk starts on a
+        clean frame.
+        """
+        total_time = self.duration
+        target = total_time / chunk_count
+        keyframes = self.keyframe_times()
+        if len(keyframes) == 0:
+            keyframes = [target * i for i in range(1, chunk_count)]
+        boundaries = [0.0]
+        for keyframe in keyframes:
+            if keyframe - boundaries[-1] >= target and total_time - keyframe >= target / 2:
+                boundaries += [keyframe]
+        boundaries += [total_time]
+        return [(boundaries[i], boundaries[i + 1] - boundaries[i]) for i in range(len(boundaries) - 1)]
+
+    def transcode_inputs(self) -> [str]:
+        if self.room_config.fast_progress_bar:
+            progress_bar = [self.output_path()['he_color'], self.output_path()['he_gray']]
+        else:
+            progress_bar = [self.output_path()['he_graph']]
+        return [video.flv_file_path() for video in self.videos] + progress_bar + [self.output_path()['ass']]
+
+    def chunk_job(self, start: float, length: float, video_encoder: [str], inputs_key: Optional[str]) -> ([str], str):
+        """
+        The encoding arguments of a chunk and its key. Chunks are named after their inputs and the encoding arguments,
+        so the chunks that were finished before a restart or a failed join are not encoded again.
+        """
+        threads = max(1, (os.cpu_count() or 1) // self.room_config.transcode_workers)
+        argv = ["ffmpeg", "-y"] + self.danmaku_inputs(start, length) + \
+            ["-t", str(length), "-filter_complex", self.danmaku_filter(start, length), "-map", "[out_sub]",
+             "-an", "-vsync", "passthrough", "-threads", str(threads)] + video_encoder + \
+            ["-b:v", f"{self.video_bitrate()}K"]
+        return argv, artifact_key("chunk", [], [inputs_key, argv])
+
+    async def process_video_chunk(self, idx: int, length: float, argv: [str], key: str,
+                                  inputs_key: Optional[str]) -> Optional[str]:
+        """
+        Encode a chunk and return its path.
+        """
+        chunk_path = artifact_path(self.output_base_path() + ".bar", key, ".mp4")
+        if inputs_key is not None and os.path.exists(chunk_path):
+            logging.info("chunk %d of session %s was encoded before, reused", idx, self.session_id)
+            return chunk_path
+        part_path = artifact_path(self.output_base_path() + ".bar", key, ".part.mp4")
+        for trial in range(CHUNK_RETRY_TIMES):
+            result = await run_stage_process(argv + [part_path], self.output_path()["video_log"], TRANSCODE,
+                                             f"chunk {idx} of {self.session_id}", total_time=length)
+            if result.succeeded and os.path.exists(part_path):
+                os.replace(part_path, chunk_path)
+                return chunk_path
+            logging.warn("chunk %d of session %s failed, trial %d", idx, self.session_id, trial + 1)
+        return None
+
+    async def process_video_segmented(self) -> bool:
+        workers = self.room_config.transcode_workers
+        chunks = self.transcode_chunks(max(1, min(workers * 2, int(self.duration // MIN_CHUNK_SECONDS))))
+        logging.info("transcoding session %s in %d chunks with %d workers", self.session_id, len(chunks), workers)
+        semaphore = asyncio.Semaphore(workers)
+        video_encoder = await self.video_encoder()
+        inputs_key = await asyncio.get_event_loop().run_in_executor(
+            None, artifact_key, "transcode", self.transcode_inputs()
+        )
+        jobs = [self.chunk_job(start, length, video_encoder, inputs_key) for start, length in chunks]
+        # chunks of a session that was continued since, or encoded with other parameters
+        prune_artifacts(self.output_base_path() + ".bar", ".mp4", {key for _, key in jobs})
+
+        async def encode(idx, length, argv, key):
+            async with semaphore:
+                return await self.process_video_chunk(idx, length, argv, key, inputs_key)
+
+        chunk_paths = await asyncio.gather(*[
+            encode(idx, length, argv, key) for idx, ((_, length), (argv, key)) in enumerate(zip(chunks, jobs))
+        ])
+        if not all(chunk_paths):
+            logging.error("session %s has chunks failed too many times", self.session_id)
+            return False
+        chunk_list_path = self.output_base_path() + ".bar.parts.txt"
+        with open(chunk_list_path, 'w') as chunk_list:
+            chunk_list.write("\n".join([f"file '{chunk_path}'" for chunk_path in chunk_paths]))
+        # chunks are joined without re-encoding, the audio is encoded once for the whole timeline. That encode is
+        # what makes it a transcode rather than a remux, it counts against the shared limit like the chunks did
+        result = await run_stage_process(
+            ["ffmpeg", "-y",
+             "-f", "concat", "-safe", "0", "-i", chunk_list_path,
+             "-f", "concat", "-safe", "0", "-i", self.output_path()['concat_file'],
+             "-t", str(self.duration),
+             "-map", "0:v", "-map", "1:a", "-c:v", "copy", "-b:a", "320K", "-ar", "44100",
+             self.output_path()['danmaku_video']],
+            self.output_path()["video_log"], TRANSCODE, f"join chunks {self.session_id}", total_time=self.duration
+        )
+        if result.succeeded:
+            for chunk_path in chunk_paths:
+                os.remove(chunk_path)
+            os.remove(chunk_list_path)
+        return result.succeeded
+
+    def prepare_graph(self) -> StageGraph:
+        # the early video only depends on the FLV list, so it is remuxed while the danmaku tools are still running.
+        # The energy map was built while recording, so the thumbnail does not wait for the merged XML either
+        return StageGraph(f"prepare {self.room_id}@{self.session_id}") \
+            .add("merge_xml", self.merge_xml, outputs=["xml"]) \
+            .add("clean_xml", self.clean_xml, outputs=["clean_xml"]) \
+            .add("process_xml", self.process_xml,
+                 outputs=["he_graph", "he_file", "he_range", "sc_file", "sc_srt", "he_pos"]) \
+            .add("process_danmaku", self.process_danmaku, inputs=["clean_xml"], outputs=["ass"]) \
+            .add("process_thumbnail", self.process_thumbnail, inputs=["he_pos"], outputs=["thumbnail"]) \
+            .add("generate_concat", self.generate_concat, outputs=["concat_file"]) \
+            .add("early_video", self.process_early_video, inputs=["concat_file"], outputs=["early_video"])
 
     async def prepare(self):
+        await self.collect_videos()
         if len(self.videos) == 0:
             logging.warn("no videos in session %s", self.session_id)
             return
-        await self.merge_xml()
-        await self.clean_xml()
-        await self.process_xml()
-        await self.process_danmaku()
-        await self.process_thumbnail()
-        self.generate_concat()
+        self.prepared = False
+        self.early_video_generated = False
+        graph = self.prepare_graph()
+        # stages are added in dependency order, a stage is only skipped if everything it consumes was skipped too
+        available = set()
+        for stage in graph.stages.values():
+            if all(artifact in available for artifact in stage.inputs) and self.resume_stage(stage.name):
+                graph.done.add(stage.name)
+                available.update(stage.outputs)
+        if len(graph.done) != len(graph.stages):
+            # the danmaku video is made from all of them
+            self.checkpoint.forget("danmaku_video")
+        await graph.run(available, on_stage_done=self.stage_done)
         self.prepared = True
 
+    def stage_paths(self, stage: Stage) -> [str]:
+        output_path = self.output_path()
+        return [output_path[artifact] for artifact in stage.outputs if artifact in output_path]
+
+    def stage_done(self, stage: Stage):
+        self.record_stage(stage.name, self.stage_paths(stage))
+
+    def record_stage(self, name: str, output_paths: [str]):
+        self.checkpoint.stage_done(name, output_paths,
+                                   {attr: getattr(self, attr) for attr in STAGE_STATE.get(name, [])})
+
+    def resume_stage(self, name: str) -> bool:
+        values = self.checkpoint.completed(name)
+        if values is None:
+            return False
+        for attr, value in values.items():
+            setattr(self, attr, value)
+        logging.info("%s of session %s finished before the restart, skipped", name, self.session_id)
+        return True
+
     async def gen_early_video(self):
         if not self.prepared:
             logging.error("session %s is not prepared", self.session_id)
             return
-        await self.process_early_video()
+        if not self.early_video_generated:
+            await self.process_early_video()
+            self.record_stage("early_video", [self.output_path()['early_video']])
 
     async def gen_danmaku_video(self):
         if not self.prepared:
             logging.error("session %s is not prepared", self.session_id)
             return
-        await self.process_video()
+        if self.resume_stage("danmaku_video"):
+            return
+        if await self.process_video():
+            self.record_stage("danmaku_video", [self.output_path()['danmaku_video']])
@@ -0,0 +1,175 @@
+import json
+import logging
+import os
+from typing import Any, Optional
+
+import yaml
+
+CHECKPOINT_DIR = "session_checkpoints"
+EVENTS_SUFFIX = ".events.jsonl"
+
+
+def fingerprint(path: str) -> Optional[list]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class SessionCheckpoint:
+    """
+    What is needed to pick a session up again after a restart, in two files per session: the recorder events it
+    received, which rebuild its segment list, appended one JSON line at a time, and a small YAML file rewritten on every
+    other change, with the steps that finished together with the size and mtime of the files they wrote, and its
+    uploads that are still queued. A checkpoint without a directory is only kept in memory. Once the session is
+    closed, both files are removed as soon as no upload is left.
+    """
+
+    def __init__(self, session_id: str, directory: Optional[str] = CHECKPOINT_DIR):
+        self.session_id = session_id
+        self.path = os.path.join(directory, f"{session_id}.yaml") if directory is not None else None
+        self.events_path = os.path.join(directory, f"{session_id}{EVENTS_SUFFIX}") if directory is not None else None
+        self.events: [dict] = []
+        self.stages: {str: {str: Any}} = dict()
+        self.uploads: [dict] = []
+        self.closed = False
+
+    def to_dict(self):
+        # the events are in their own file
+        return {
+            "session_id": self.session_id,
+            "stages": self.stages,
+            "uploads": self.uploads,
+            "closed": self.closed
+        }
+
+    @staticmethod
+    def from_dict(save_dict, directory: Optional[str] = CHECKPOINT_DIR) -> 'SessionCheckpoint':
+        checkpoint = SessionCheckpoint(save_dict["session_id"], directory)
+        checkpoint.stages = save_dict.get("stages", {})
+        checkpoint.uploads = save_dict.get("uploads", [])
+        checkpoint.closed = save_dict.get("closed", False)
+        if "events" in save_dict:
+            # written by an earlier version, which kept the events in the YAML file
+            checkpoint.events = save_dict["events"]
+            checkpoint.write_events()
+            checkpoint.save()
+        else:
+            checkpoint.read_events()
+        return checkpoint
+
+    @staticmethod
+    def load_all(directory: Optional[str] = CHECKPOINT_DIR) -> ['SessionCheckpoint']:
+        if directory is None or not os.path.isdir(directory):
+            return []
+        checkpoints = []
+        for file_name in sorted(os.listdir(directory)):
+            if not file_name.endswith(".yaml"):
+                continue
+            try:
+                with open(os.path.join(directory, file_name), 'r') as file:
+                    checkpoints += [SessionCheckpoint.from_dict(yaml.load(file, Loader=yaml.FullLoader), directory)]
+            except (OSError, yaml.YAMLError, KeyError, TypeError) as err:
+                logging.warn("cannot read checkpoint %s: %s", file_name, err)
+        return checkpoints
+
+    def read_events(self):
+        broken = False
+        try:
+            with open(self.events_path, 'r') as file:
+                for line in file:
+                    try:
+                        self.events += [json.loads(line)]
+                    except ValueError:
+                        broken = True
+        except FileNotFoundError:
+            return
+        if broken:
+            # the last line of a crash is cut short, rewritten so the next event does not go on the end of it
+            logging.warn("skipping a broken event in %s", self.events_path)
+            self.write_events()
+
+    def write_events(self):
+        try:
+            os.makedirs(os.path.dirname(self.events_path), exist_ok=True)
+            with open(self.events_path + ".tmp", 'w') as file:
+                for event in self.events:
+                    file.write(json.dumps(event) + "\n")
+            os.replace(self.events_path + ".tmp", self.events_path)
+        except OSError as err:
+            logging.warn("cannot write checkpoint events %s: %s", self.events_path, err)
+
+    def save(self):
+        if self.path is None:
+            return
+        try:
+            if self.closed and len(self.uploads) == 0:
+                for path in [self.events_path, self.path]:
+                    if os.path.exists(path):
+                        os.remove(path)
+                return
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + ".tmp", 'w') as file:
+                yaml.dump(self.to_dict(), file, Dumper=yaml.Dumper)
+            os.replace(self.path + ".tmp", self.path)
+        except OSError as err:
+            logging.warn("cannot write checkpoint %s: %s", self.path, err)
+
+    def add_event(self, update_json: dict):
+        self.events += [update_json]
+        if self.path is None or (self.closed and len(self.uploads) == 0):
+            return
+        try:
+            if not os.path.exists(self.path):
+                # the state file is what marks a checkpoint, it is written before the first event
+                self.save()
+            with open(self.events_path, 'a') as file:
+                file.write(json.dumps(update_json) + "\n")
+        except OSError as err:
+            logging.warn("cannot write checkpoint events %s: %s", self.events_path, err)
+
+    def stage_done(self, name: str, output_paths: [str] = (), values: {str: Any} = None):
+        """
+        Record a finished step with the fingerprints of its outputs. A step whose outputs are missing is not
+        recorded, so it runs again after a restart.
+        """
+        outputs = {path: fingerprint(path) for path in output_paths}
+        if any(output is None for output in outputs.values()):
+            logging.debug("%s of session %s left no output, not recorded", name, self.session_id)
+            return
+        self.stages[name] = {"outputs": outputs, "values": values or {}}
+        self.save()
+
+    def completed(self, name: str) -> Optional[{str: Any}]:
+        """
+        The values recorded with a finished step, or None if it has not finished or any of its outputs changed since.
+        """
+        stage = self.stages.get(name)
+        if stage is None:
+            return None
+        for path, output in stage["outputs"].items():
+            if fingerprint(path) != output:
+                logging.info("output %s of %s changed, running it again", path, name)
+                return None
+        return stage["values"]
+
+    def forget(self, name: str):
+        if self.stages.pop(name, None) is not None:
+            self.save()
+
+    def clear_stages(self):
+        self.stages = dict()
+        self.save()
+
+    def add_upload(self, account: str, task_dict: dict):
+        self.uploads += [{"account": account, "task": task_dict}]
+        self.save()
+
+    def remove_upload(self, danmaku: bool):
+        self.uploads = [upload for upload in self.uploads if upload["task"]["danmaku"] != danmaku]
+        self.save()
+
+    def close(self):
+        self.closed = True
+        self.save()
@@ -0,0 +1,92 @@
+import collections
+import datetime
+from typing import Optional
+
+from session import Session
+
+MAX_SESSION_SUMMARIES = 1000
+
+
+class SessionSummary:
+    """
+    What is kept of a session once it is evicted, enough to recognise late events for it.
+    """
+    session_id: str
+    room_id: int
+    start_time: datetime.datetime
+    end_time: Optional[datetime.datetime]
+    duration: float
+    video_count: int
+
+    def __init__(self, session: Session):
+        self.session_id = session.session_id
+        self.room_id = session.room_id
+        self.start_time = session.start_time
+        self.end_time = session.end_time
+        self.duration = session.duration
+        self.video_count = len(session.videos)
+
+
+class SessionRegistry:
+    """
+    The sessions of the manager, indexed by every session id the recorder gave them, and by room for the ones being
+    recorded and the ones that ended and may still be continued. A session is evicted once it is processed, so only
+    a bounded number of summaries is left of it. Events and evictions are both handled on the loop of the manager.
+    """
+
+    def __init__(self):
+        self.sessions: {str: Session} = dict()
+        self.session_ids: {str: [str]} = dict()  # every id of a session, by its first one
+        self.active: {int: Session} = dict()
+        self.ended: {int: {str: Session}} = collections.defaultdict(dict)  # by room, then by first session id
+        self.summaries: {str: SessionSummary} = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.session_ids)
+
+    def get(self, session_id: str) -> Optional[Session]:
+        return self.sessions.get(session_id)
+
+    def summary(self, session_id: str) -> Optional[SessionSummary]:
+        return self.summaries.get(session_id)
+
+    def add(self, session: Session):
+        self.sessions[session.session_id] = session
+        self.session_ids[session.session_id] = [session.session_id]
+        self.active[session.room_id] = session
+
+    def continue_session(self, session_id: str, session: Session):
+        self.sessions[session_id] = session
+        self.session_ids[session.session_id] += [session_id]
+        self._remove_ended(session)
+        self.active[session.room_id] = session
+
+    def end(self, session: Session):
+        if self.active.get(session.room_id) is session:
+            del self.active[session.room_id]
+        self.ended[session.room_id][session.session_id] = session
+
+    def continuable(self, room_id: int, timestamp: datetime.datetime, minutes: float) -> Optional[Session]:
+        for session in self.ended.get(room_id, {}).values():
+            if (timestamp - session.end_time).total_seconds() / 60 < minutes:
+                return session
+        return None
+
+    def evict(self, session: Session):
+        summary = SessionSummary(session)
+        for session_id in self.session_ids.pop(session.session_id, []):
+            del self.sessions[session_id]
+            self.summaries[session_id] = summary
+        if self.active.get(session.room_id) is session:
+            del self.active[session.room_id]
+        self._remove_ended(session)
+        while len(self.summaries) > MAX_SESSION_SUMMARIES:
+            self.summaries.popitem(last=False)
+
+    def _remove_ended(self, session: Session):
+        room_sessions = self.ended.get(session.room_id)
+        if room_sessions is None:
+            return
+        room_sessions.pop(session.session_id, None)
+        if len(room_sessions) == 0:
+            del self.ended[session.room_id]
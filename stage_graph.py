@@ -0,0 +1,98 @@
+import asyncio
+import inspect
+import logging
+import time
+from typing import Callable, Iterable, Optional
+
+
+class Stage:
+    name: str
+    inputs: [str]
+    outputs: [str]
+
+    def __init__(self, name: str, func: Callable, inputs: Iterable[str] = (), outputs: Iterable[str] = ()):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.duration: Optional[float] = None
+
+    async def run(self):
+        start = time.monotonic()
+        try:
+            result = self.func()
+            if inspect.isawaitable(result):
+                await result
+        finally:
+            self.duration = time.monotonic() - start
+
+
+class StageGraph:
+    """
+    Runs a set of stages as a dependency graph. Every stage declares the artifacts it consumes and produces, and a
+    stage is started as soon as all of its inputs have been produced, so independent stages run at the same time.
+    Stages already in done are skipped, their outputs have to be passed to run as available.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.stages: {str: Stage} = dict()
+        self.done: {str} = set()
+
+    def add(self, name: str, func: Callable, inputs: Iterable[str] = (), outputs: Iterable[str] = ()):
+        assert name not in self.stages, f"duplicated stage {name}"
+        self.stages[name] = Stage(name, func, inputs, outputs)
+        return self
+
+    def check(self, available: Iterable[str] = ()):
+        producible = set(available)
+        for stage in self.stages.values():
+            producible.update(stage.outputs)
+        for stage in self.stages.values():
+            missing = [artifact for artifact in stage.inputs if artifact not in producible]
+            if len(missing) != 0:
+                raise ValueError(f"stage {stage.name} of {self.name} depends on unknown artifacts {missing}")
+
+    async def run(self, available: Iterable[str] = (), on_stage_done: Optional[Callable[[Stage], None]] = None):
+        self.check(available)
+        artifacts = set(available)
+        pending = {name: stage for name, stage in self.stages.items() if name not in self.done}
+        running: {asyncio.Future: Stage} = dict()
+        error: Optional[BaseException] = None
+        graph_start = time.monotonic()
+
+        while True:
+            if error is None:
+                for name, stage in list(pending.items()):
+                    if all(artifact in artifacts for artifact in stage.inputs):
+                        del pending[name]
+                        logging.debug("stage %s of %s started", name, self.name)
+                        running[asyncio.ensure_future(stage.run())] = stage
+            if len(running) == 0:
+                break
+            try:
+                finished, _ = await asyncio.wait(running.keys(), return_when=asyncio.FIRST_COMPLETED)
+            except asyncio.CancelledError:
+                for future in running.keys():
+                    future.cancel()
+                raise
+            for future in finished:
+                stage = running.pop(future)
+                if future.cancelled():
+                    error = error or asyncio.CancelledError()
+                elif future.exception() is not None:
+                    logging.error("stage %s of %s failed after %.1fs: %s",
+                                  stage.name, self.name, stage.duration, future.exception())
+                    error = error or future.exception()
+                else:
+                    logging.info("stage %s of %s finished in %.1fs", stage.name, self.name, stage.duration)
+                    self.done.add(stage.name)
+                    artifacts.update(stage.outputs)
+                    if on_stage_done is not None:
+                        on_stage_done(stage)
+
+        if error is not None:
+            raise error
+        if len(pending) != 0:
+            raise RuntimeError(f"stages {list(pending.keys())} of {self.name} can never start")
+        logging.info("%s finished in %.1fs", self.name, time.monotonic() - graph_start)
@@ -1,5 +1,6 @@
 import datetime
 import json
+import os
 import traceback
 from typing import Any
 
@@ -22,6 +23,11 @@ class SubtitleTask:
         self.sessdata = verify.sessdata
         self.csrf = verify.csrf
         self.error_count = 0
+        self.approved = False  # the video passed review, known once it could be looked up
+        self.review_trials = 0
+
+    def expiry(self) -> float:
+        return (self.start_date + datetime.timedelta(hours=HOURS_THRESHOLD)).timestamp()
 
     def to_dict(self):
         return vars(self)
@@ -43,20 +49,13 @@ class SubtitleTask:
         comment_task = SubtitleTask(upload_task.subtitle_path, bvid, cid, upload_task.verify)
         return comment_task
 
-    def is_earlier_task_of(self, new_task: 'SubtitleTask'):
-        return new_task.bvid == self.bvid and new_task.start_date > self.start_date
+    def payload_path(self) -> str:
+        return self.subtitle_path + ".json"
 
-    def post_subtitle(self) -> bool:
-        if (datetime.datetime.now(datetime.timezone.utc) - self.start_date).total_seconds() / 60 / 60 > HOURS_THRESHOLD:
-            return True
-        if self.error_count > ERROR_THRESHOLD:
-            return True
-        try:
-            video.get_video_info(self.bvid)
-        except bilibili_api.exceptions.BilibiliApiException:  # Video not published yet
-            return False
-        self.error_count += 1
-        verify = Verify(self.sessdata, self.csrf)
+    def compile(self):
+        """
+        Build the subtitle body bilibili takes from the SRT file once, so a retry only reads it back.
+        """
         with open(self.subtitle_path) as srt_file:
             srt_obj = srt.parse(srt_file.read())
         srt_json = {
@@ -77,7 +76,35 @@ class SubtitleTask:
                 "content": srt_single_obj.content
             }
             srt_json["body"] += [srt_single_obj_body]
-        srt_json_str = json.dumps(srt_json)
+        with open(self.payload_path() + ".tmp", 'w', encoding='utf-8') as file:
+            json.dump(srt_json, file, ensure_ascii=False, separators=(',', ':'))
+        os.replace(self.payload_path() + ".tmp", self.payload_path())
+
+    def payload(self) -> str:
+        # compiled again if the SRT file was written after it, or the task comes from an older save
+        if not os.path.isfile(self.payload_path()) or \
+                os.path.getmtime(self.payload_path()) < os.path.getmtime(self.subtitle_path):
+            self.compile()
+        with open(self.payload_path(), 'r', encoding='utf-8') as file:
+            return file.read()
+
+    def is_earlier_task_of(self, new_task: 'SubtitleTask'):
+        return new_task.bvid == self.bvid and new_task.start_date > self.start_date
+
+    def post_subtitle(self, published: bool = False) -> bool:
+        if (datetime.datetime.now(datetime.timezone.utc) - self.start_date).total_seconds() / 60 / 60 > HOURS_THRESHOLD:
+            return True
+        if self.error_count > ERROR_THRESHOLD:
+            return True
+        if not published:
+            try:
+                video.get_video_info(self.bvid)
+            except bilibili_api.exceptions.BilibiliApiException:  # Video not published yet
+                return False
+        self.approved = True
+        self.error_count += 1
+        verify = Verify(self.sessdata, self.csrf)
+        srt_json_str = self.payload()
         print(f"posting subtitles on {self.cid} of {self.bvid}")
         try:
             video.save_subtitle(srt_json_str, bvid=self.bvid, cid=self.cid, verify=verify)
@@ -85,6 +112,7 @@ class SubtitleTask:
             # noinspection PyUnresolvedReferences
             if hasattr(e, 'code') and (e.code == 79022 or e.code == -404 or e.code == 502):  # video not approved yet
                 self.error_count -= 1
+                self.approved = False
                 return False
             else:
                 print(traceback.format_exc())
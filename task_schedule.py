@@ -0,0 +1,75 @@
+import asyncio
+import heapq
+import random
+import time
+from typing import Iterable, Optional
+
+REVIEW_RETRY_SECONDS = 60
+REVIEW_RETRY_MAX_SECONDS = 60 * 60
+REVIEW_RETRY_JITTER = 0.2
+# 60s doubled 6 times is past the hour already
+REVIEW_RETRY_MAX_DOUBLINGS = 6
+
+
+def review_backoff(trials: int) -> float:
+    """
+    How long to wait before looking at a video under review again, doubled after every look and spread by a random
+    jitter, so the tasks of one upload do not all come due together.
+    """
+    delay = min(REVIEW_RETRY_MAX_SECONDS, REVIEW_RETRY_SECONDS * 2 ** min(trials, REVIEW_RETRY_MAX_DOUBLINGS))
+    return delay * random.uniform(1 - REVIEW_RETRY_JITTER, 1 + REVIEW_RETRY_JITTER)
+
+
+class TaskSchedule:
+    """
+    When each task is due next, in a heap, so a poster only wakes up for the tasks it can attempt. Rescheduling a task
+    pushes a new entry and leaves the old one, which is dropped when it comes up. Created on the loop it is used from.
+    """
+
+    def __init__(self):
+        self.heap: [(float, int)] = []
+        self.due: {int: float} = dict()
+        self.changed = asyncio.Event()
+
+    def __len__(self):
+        return len(self.due)
+
+    def schedule(self, task_id: int, due: float):
+        self.due[task_id] = due
+        heapq.heappush(self.heap, (due, task_id))
+        self.changed.set()
+
+    def wake(self, task_ids: Iterable[int]):
+        now = time.time()
+        for task_id in task_ids:
+            if task_id in self.due:
+                self.schedule(task_id, now)
+
+    def remove(self, task_id: int):
+        self.due.pop(task_id, None)
+
+    def next_due(self) -> Optional[float]:
+        while len(self.heap) > 0 and self.due.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if len(self.heap) > 0 else None
+
+    def pop_due(self) -> [int]:
+        now = time.time()
+        task_ids = []
+        while self.next_due() is not None and self.heap[0][0] <= now:
+            _, task_id = heapq.heappop(self.heap)
+            del self.due[task_id]
+            task_ids += [task_id]
+        return task_ids
+
+    async def wait(self):
+        """
+        Until a task is due, or the schedule changed.
+        """
+        self.changed.clear()
+        next_due = self.next_due()
+        timeout = None if next_due is None else max(0.0, next_due - time.time())
+        try:
+            await asyncio.wait_for(self.changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
@@ -0,0 +1,163 @@
+import collections
+import logging
+import os
+import sqlite3
+from collections.abc import Mapping
+from typing import Optional
+
+import yaml
+
+from comment_task import CommentTask
+from subtitle_task import SubtitleTask
+from task_save import TaskSave
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS uploads (session_id TEXT PRIMARY KEY, bvid TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS video_names (session_id TEXT PRIMARY KEY, title TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS video_names_title ON video_names (title);
+-- ids are never reused, a task removed while it is being posted is not mistaken for the task after it
+CREATE TABLE IF NOT EXISTS comment_tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL, task TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS comment_tasks_session_id ON comment_tasks (session_id);
+CREATE TABLE IF NOT EXISTS subtitle_tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, bvid TEXT NOT NULL, task TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS subtitle_tasks_bvid ON subtitle_tasks (bvid);
+CREATE TABLE IF NOT EXISTS imports (path TEXT PRIMARY KEY);
+"""
+
+
+def dump_task(task) -> str:
+    # yaml rather than json, the tasks hold datetimes
+    return yaml.dump(task.to_dict(), Dumper=yaml.Dumper)
+
+
+def load_task(task: str) -> dict:
+    return yaml.load(task, Loader=yaml.FullLoader)
+
+
+class SessionIdMap(Mapping):
+    """
+    The BV id of every uploaded session, read from the store on every lookup.
+    """
+
+    def __init__(self, store: 'TaskStore'):
+        self.store = store
+
+    def __getitem__(self, session_id: str) -> str:
+        bvid = self.store.query_one("SELECT bvid FROM uploads WHERE session_id = ?", (session_id,))
+        if bvid is None:
+            raise KeyError(session_id)
+        return bvid
+
+    def __setitem__(self, session_id: str, bvid: str):
+        self.store.execute("INSERT OR REPLACE INTO uploads (session_id, bvid) VALUES (?, ?)", (session_id, bvid))
+
+    def __iter__(self):
+        return iter([row[0] for row in self.store.query("SELECT session_id FROM uploads")])
+
+    def __len__(self) -> int:
+        return self.store.query_one("SELECT COUNT(*) FROM uploads")
+
+
+class TaskStore:
+    """
+    What the manager keeps across restarts, in SQLite in WAL mode. Every change is its own small transaction, so a
+    save no longer grows with the history, and a crash loses at most the change being written. The BV ids and titles
+    stay on disk, indexed by session id and title. The pending comment and subtitle tasks are few and are also kept
+    in memory, by their row id. The YAML save of an earlier version is imported once, and left as it was. Once the
+    manager runs, the store is only used on its loop.
+    """
+
+    def __init__(self, path: str, yaml_path: Optional[str] = None):
+        self.path = path
+        # opened before the loop of the manager starts, and used on it afterwards
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self.session_id_map = SessionIdMap(self)
+        if yaml_path is not None and os.path.isfile(yaml_path) and \
+                self.query_one("SELECT 1 FROM imports WHERE path = ?", (os.path.abspath(yaml_path),)) is None:
+            self.import_yaml(yaml_path)
+        self.comment_tasks: {int: CommentTask} = collections.OrderedDict(
+            (task_id, CommentTask.from_dict(load_task(task)))
+            for task_id, task in self.query("SELECT id, task FROM comment_tasks ORDER BY id")
+        )
+        self.subtitle_tasks: {int: SubtitleTask} = collections.OrderedDict()
+        self.subtitle_task_ids: {str: int} = dict()  # the latest subtitle task of each video, by bvid
+        for task_id, task in self.query("SELECT id, task FROM subtitle_tasks ORDER BY id"):
+            task = SubtitleTask.from_dict(load_task(task))
+            # saves of earlier versions keep every subtitle of a video until the latest one is posted
+            if task.bvid in self.subtitle_task_ids:
+                self.remove_subtitle_task(self.subtitle_task_ids[task.bvid])
+            self.subtitle_tasks[task_id] = task
+            self.subtitle_task_ids[task.bvid] = task_id
+
+    def query(self, sql: str, parameters=()) -> list:
+        return self.db.execute(sql, parameters).fetchall()
+
+    def query_one(self, sql: str, parameters=()):
+        rows = self.query(sql, parameters)
+        return rows[0][0] if len(rows) > 0 else None
+
+    def execute(self, sql: str, parameters=()) -> int:
+        return self.db.execute(sql, parameters).lastrowid
+
+    def import_yaml(self, yaml_path: str):
+        with open(yaml_path, 'r') as file:
+            task_save = TaskSave.from_dict(yaml.load(file, Loader=yaml.FullLoader))
+        self.db.execute("BEGIN")
+        self.db.executemany("INSERT OR IGNORE INTO uploads (session_id, bvid) VALUES (?, ?)",
+                            task_save.session_id_map.items())
+        self.db.executemany("INSERT OR IGNORE INTO video_names (session_id, title) VALUES (?, ?)",
+                            task_save.video_name_history.items())
+        self.db.executemany("INSERT INTO comment_tasks (session_id, task) VALUES (?, ?)",
+                            [(task.session_id, dump_task(task)) for task in task_save.active_comment_tasks])
+        self.db.executemany("INSERT INTO subtitle_tasks (bvid, task) VALUES (?, ?)",
+                            [(task.bvid, dump_task(task)) for task in task_save.active_subtitle_tasks])
+        self.db.execute("INSERT INTO imports (path) VALUES (?)", (os.path.abspath(yaml_path),))
+        self.db.execute("COMMIT")
+        logging.info("imported %d uploads and %d titles from %s", len(task_save.session_id_map),
+                     len(task_save.video_name_history), yaml_path)
+
+    def set_video_name(self, session_id: str, title: str):
+        self.execute("INSERT OR REPLACE INTO video_names (session_id, title) VALUES (?, ?)", (session_id, title))
+
+    def title_taken(self, title: str, session_id: str) -> bool:
+        """
+        Whether a session other than this one was uploaded with this title.
+        """
+        return self.query_one("SELECT 1 FROM video_names WHERE title = ? AND session_id != ?",
+                              (title, session_id)) is not None
+
+    def add_comment_task(self, task: CommentTask) -> int:
+        task_id = self.execute("INSERT INTO comment_tasks (session_id, task) VALUES (?, ?)",
+                               (task.session_id, dump_task(task)))
+        self.comment_tasks[task_id] = task
+        return task_id
+
+    def update_comment_task(self, task_id: int):
+        self.execute("UPDATE comment_tasks SET task = ? WHERE id = ?",
+                     (dump_task(self.comment_tasks[task_id]), task_id))
+
+    def remove_comment_task(self, task_id: int):
+        self.execute("DELETE FROM comment_tasks WHERE id = ?", (task_id,))
+        del self.comment_tasks[task_id]
+
+    def add_subtitle_task(self, task: SubtitleTask) -> int:
+        task_id = self.execute("INSERT INTO subtitle_tasks (bvid, task) VALUES (?, ?)", (task.bvid, dump_task(task)))
+        self.subtitle_tasks[task_id] = task
+        self.subtitle_task_ids[task.bvid] = task_id
+        return task_id
+
+    def update_subtitle_task(self, task_id: int):
+        self.execute("UPDATE subtitle_tasks SET task = ? WHERE id = ?",
+                     (dump_task(self.subtitle_tasks[task_id]), task_id))
+
+    def remove_subtitle_task(self, task_id: int):
+        self.execute("DELETE FROM subtitle_tasks WHERE id = ?", (task_id,))
+        task = self.subtitle_tasks.pop(task_id)
+        if self.subtitle_task_ids.get(task.bvid) == task_id:
+            del self.subtitle_task_ids[task.bvid]
@@ -0,0 +1,32 @@
+import unittest
+
+from energy_map import RegexRules
+
+
+class RegexRulesTest(unittest.TestCase):
+    def test_chained_rules_apply_in_order(self):
+        rules = RegexRules([("哈+", "哈哈"), ("哈哈", "笑")])
+        self.assertIsNone(rules.combined)
+        self.assertEqual(rules.apply("哈哈哈哈"), "笑")
+        self.assertEqual(rules.apply("好哈哈哈"), "好笑")
+
+    def test_group_replacement_applies_in_order(self):
+        rules = RegexRules([("(草)+", r"\1"), ("草", "grass")])
+        self.assertIsNone(rules.combined)
+        self.assertEqual(rules.apply("草草草"), "grass")
+
+    def test_independent_rules_combine(self):
+        rules = RegexRules([("哈+", "哈哈"), ("草+", "草"), ("awsl", "阿伟死了")])
+        self.assertIsNotNone(rules.combined)
+        self.assertEqual(rules.apply("哈哈哈哈草草awsl"), "哈哈草阿伟死了")
+        self.assertEqual(rules.apply("哈哈哈哈草草awsl"), self.sequential(rules, "哈哈哈哈草草awsl"))
+
+    @staticmethod
+    def sequential(rules: RegexRules, danmaku: str) -> str:
+        for pattern, (_, replacement) in zip(rules.patterns, rules.rules):
+            danmaku = pattern.sub(replacement, danmaku)
+        return danmaku
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -28,6 +28,20 @@ class UploadTask:
         self.verify = self.account.verify
         self.trial = 0
 
+    def to_dict(self):
+        # the account is configured, not saved, it is looked up again when the task is loaded
+        return {key: value for key, value in vars(self).items() if key not in ["account", "verify"]}
+
+    @staticmethod
+    def from_dict(save_dict, account: UploaderAccount) -> 'UploadTask':
+        upload_task = UploadTask(
+            save_dict['session_id'], save_dict['video_path'], save_dict['thumbnail_path'], save_dict['sc_path'],
+            save_dict['he_path'], save_dict['subtitle_path'], save_dict['title'], save_dict['source'],
+            save_dict['description'], save_dict['tag'], save_dict['channel_id'], save_dict['danmaku'], account
+        )
+        upload_task.trial = save_dict.get('trial', 0)
+        return upload_task
+
     def upload(self, session_dict: {str: str}):
         def on_progress(update):
             print(update)
@@ -1,10 +1,8 @@
 import os
 import datetime
-import requests
-import logging
-import json
 
 from recorder_config import RecoderRoom
+from webhook_dispatcher import webhook_dispatcher
 
 
 STORAGE_PATH = "/storage"
@@ -19,10 +17,7 @@ class Webhook:
     def request(self, path: str, data: dict = {}):
         webhook = self.room.webhook
         if webhook is not None:
-            url = webhook + path
-            logging.debug("webhook requesting %s with %s",
-                          url, json.dumps(data))
-            requests.post(url, json=data)
+            webhook_dispatcher.send(webhook, path, data, self.room.webhook_batch)
 
     def relpath(self, path: str):
         return os.path.relpath(path, os.path.join(STORAGE_PATH, str(self.room.id)))
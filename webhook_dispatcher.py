@@ -0,0 +1,150 @@
+import json
+import logging
+import queue
+import threading
+import time
+
+import requests
+
+WEBHOOK_QUEUE_SIZE = 1000
+WEBHOOK_TIMEOUT = 10
+WEBHOOK_RETRY_TIMES = 5
+WEBHOOK_RETRY_SECONDS = 2  # doubled after every failed try
+WEBHOOK_MAX_BATCH = 50
+WEBHOOK_BATCH_PATH = "/batch"
+
+
+class WebhookEvent:
+    path: str
+    data: dict
+    queued_at: float
+
+    def __init__(self, path: str, data: dict):
+        self.path = path
+        self.data = data
+        self.queued_at = time.monotonic()
+
+
+class EndpointStats:
+    queued: int
+    delivered: int
+    failed: int
+    dropped: int
+    total_latency: float
+    max_latency: float
+
+    def __init__(self):
+        self.queued = 0
+        self.delivered = 0
+        self.failed = 0
+        self.dropped = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def to_dict(self):
+        return {
+            "queued": self.queued,
+            "delivered": self.delivered,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "average_latency": self.total_latency / self.delivered if self.delivered > 0 else 0.0,
+            "max_latency": self.max_latency
+        }
+
+
+class WebhookEndpoint:
+    """
+    Delivers the events of one webhook URL in order from its own thread, over a pooled keep-alive connection. A
+    failed request is retried with backoff, which only holds back the events of this endpoint.
+    """
+
+    def __init__(self, url: str, batch: bool):
+        self.url = url
+        self.batch = batch
+        self.events: queue.Queue[WebhookEvent] = queue.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+        self.stats = EndpointStats()
+        self.http = requests.Session()
+        self.thread = threading.Thread(target=self.deliver_loop, daemon=True)
+        self.thread.start()
+
+    def put(self, event: WebhookEvent):
+        try:
+            self.events.put_nowait(event)
+            self.stats.queued = self.events.qsize()
+        except queue.Full:
+            self.stats.dropped += 1
+            logging.warn("webhook %s is %d events behind, %s dropped", self.url, WEBHOOK_QUEUE_SIZE, event.path)
+
+    def next_events(self) -> [WebhookEvent]:
+        events = [self.events.get()]
+        while self.batch and len(events) < WEBHOOK_MAX_BATCH:
+            try:
+                events += [self.events.get_nowait()]
+            except queue.Empty:
+                break
+        self.stats.queued = self.events.qsize()
+        return events
+
+    def post(self, events: [WebhookEvent]):
+        if self.batch:
+            url = self.url + WEBHOOK_BATCH_PATH
+            data = [{"path": event.path, "data": event.data} for event in events]
+        else:
+            url = self.url + events[0].path
+            data = events[0].data
+        logging.debug("webhook requesting %s with %s", url, json.dumps(data))
+        response = self.http.post(url, json=data, timeout=WEBHOOK_TIMEOUT)
+        response.raise_for_status()
+
+    def deliver(self, events: [WebhookEvent]) -> bool:
+        for trial in range(WEBHOOK_RETRY_TIMES):
+            try:
+                self.post(events)
+                return True
+            except requests.RequestException as err:
+                logging.warn("webhook %s failed, trial %d: %s", self.url, trial + 1, err)
+                if trial + 1 < WEBHOOK_RETRY_TIMES:
+                    time.sleep(WEBHOOK_RETRY_SECONDS * 2 ** trial)
+        return False
+
+    def deliver_loop(self):
+        while True:
+            events = self.next_events()
+            if not self.deliver(events):
+                self.stats.failed += len(events)
+                logging.error("webhook %s failed too many times, %s dropped", self.url,
+                              ", ".join(event.path for event in events))
+                continue
+            now = time.monotonic()
+            for event in events:
+                latency = now - event.queued_at
+                self.stats.delivered += 1
+                self.stats.total_latency += latency
+                self.stats.max_latency = max(self.stats.max_latency, latency)
+
+
+class WebhookDispatcher:
+    """
+    Sends webhook events without blocking the caller. Every webhook URL gets a bounded queue and a delivery thread,
+    so a slow or dead consumer neither stalls the event loops nor holds back the other webhooks.
+    """
+
+    def __init__(self):
+        self.endpoints: {str: WebhookEndpoint} = dict()
+        self.lock = threading.Lock()
+
+    def endpoint(self, url: str, batch: bool) -> WebhookEndpoint:
+        with self.lock:
+            if url not in self.endpoints:
+                self.endpoints[url] = WebhookEndpoint(url, batch)
+            return self.endpoints[url]
+
+    def send(self, url: str, path: str, data: dict, batch: bool = False):
+        self.endpoint(url, batch).put(WebhookEvent(path, data))
+
+    def to_dict(self):
+        with self.lock:
+            return {url: endpoint.stats.to_dict() for url, endpoint in self.endpoints.items()}
+
+
+webhook_dispatcher = WebhookDispatcher()